@@ -22,12 +22,13 @@ import sys
 sys.path.append('..')
 
 # %%
+import json
 import requests
 import uuid
 from src.persist.load import session_from_file
 from src.persist.save import to_file
-from src.preproc import session_to_chatml, event_source_role
-from src.postproc import parse_constrained_message
+from src.preproc import IncrementalChatML, active_branch, event_source_role
+from src.postproc import IncrementalMessageParser, parse_constrained_message
 from src.run.execute import IPythonExecutor
 from src.run.format import LLMFormatter
 from src.types import Session, HumanMsg, ExecutionResult, CodeFragment, ResumeFrom, SessionEvent, AssistantThought, AssistantAction, ExecutionResult
@@ -35,11 +36,13 @@ from src.types import Session, HumanMsg, ExecutionResult, CodeFragment, ResumeFr
 
 # %%
 # Start an inference server with the `src.server` module.
-SERVER_URL = "http://127.0.0.1:8000/generate"
+SERVER_URL = "http://127.0.0.1:8000"
 
 # %%
 max_seq_length = 16000
 max_new_tokens = 4096
+# Responses per request. The first one is shown; the others are there to regenerate, instantly.
+n_alternatives = 3
 
 # %%
 from IPython.display import clear_output
@@ -47,30 +50,77 @@ from IPython.display import clear_output
 executor = IPythonExecutor()
 formatter = LLMFormatter()
 session = Session(events=[])
+# The session as a conversation, updated with new events only.
+chatml = IncrementalChatML(session)
+# Other responses to the latest request, for `regenerate`.
+alternatives = []
+# The conversation as the server holds it: we only send what changed.
+remote = {"session_id": None, "conversation": []}
 
 
 # The following is not the greatest code; does the job for now.
 
-def _process_session_events():
-    global session
-
-    # Convert session to ChatML
-    conversation = session_to_chatml(session)
-
-    # Send to remote server
-    response = requests.post(
-        SERVER_URL,
-        json={
-            "conversation": conversation,
-            "max_new_tokens": max_new_tokens
-        }
-    ).json()
-    raw_response = response["response"]
+def _sync_remote_conversation(conversation):
+    """Bring the server's copy of the conversation up to date. Returns the session ID."""
+    synced = remote["conversation"]
+    n_common = 0
+    while n_common < min(len(synced), len(conversation)) and synced[n_common] == conversation[n_common]:
+        n_common += 1
+
+    session_url = f"{SERVER_URL}/sessions/{remote['session_id']}"
+    try:
+        if remote["session_id"] is None:
+            raise KeyError
+        if n_common < len(synced):
+            requests.post(f"{session_url}/rewind", json={"n_messages": n_common}).raise_for_status()
+        if n_common < len(conversation):
+            requests.post(
+                f"{session_url}/messages", json={"messages": conversation[n_common:]}
+            ).raise_for_status()
+    except (KeyError, requests.HTTPError):
+        # No session yet, or the server forgot about it: upload everything.
+        response = requests.post(f"{SERVER_URL}/sessions", json={"conversation": conversation})
+        response.raise_for_status()
+        remote["session_id"] = response.json()["session_id"]
+    remote["conversation"] = list(conversation)
+    return remote["session_id"]
+
+
+def _process_session_events(raw_response=None):
+    global session, alternatives
+
+    if raw_response is None:
+        # Convert session to ChatML
+        conversation = chatml.conversation()
+
+        # Send what's new to remote server, and show the first response as it comes
+        session_id = _sync_remote_conversation(conversation)
+        deltas = [[] for _ in range(n_alternatives)]
+        # Events of the first response, parsed as it comes.
+        parser = IncrementalMessageParser()
+        with requests.post(
+            f"{SERVER_URL}/sessions/{session_id}/generate/stream",
+            json={
+                "max_new_tokens": max_new_tokens,
+                "n": n_alternatives,
+            },
+            stream=True,
+        ) as response:
+            for line in response.iter_lines():
+                if line:
+                    delta = json.loads(line)
+                    deltas[delta["index"]].append(delta["text"])
+                    if delta["index"] == 0:
+                        print(delta["text"], end="", flush=True)
+                        parser.feed(delta["text"])
+        raw_response, *alternatives = ["".join(d) for d in deltas]
+        parser.close()
+        assistant_events_body = parser.events
+    else:
+        assistant_events_body = parse_constrained_message(raw_response)
     # Uncomment for debugging:
     # print("Raw LLM response:", raw_response)
 
-    # Parse response into events
-    assistant_events_body = parse_constrained_message(raw_response)
     assistant_session_events = [SessionEvent(event_id=str(uuid.uuid4()), body=e) for e in assistant_events_body]
 
     # Add all events to session
@@ -108,6 +158,7 @@ def process_user_input(query: str):
     global session
 
     # Create and add user message, with a new event ID
+    alternatives.clear()
     if query:
         msg = HumanMsg(query)
         session_event = SessionEvent(event_id=str(uuid.uuid4()), body=msg)
@@ -116,38 +167,32 @@ def process_user_input(query: str):
 
 
 def regenerate_assistant_response():
-    """Regenerate the assistant's last response."""
+    """Regenerate the assistant's last response. The previous one stays in the session, abandoned."""
     global session
 
-    # Remove assistant events since the last user message.
-    # Go backwards
-    original_len = len(session.events)
-    i = len(session.events) - 1
+    # Resume from the last user message, going backwards over the assistant's events.
     regenerate_from_event_id = None
-    while i >= 0:
-        session_event = session.events[i]
-        print(session_event)
-        match session_event.body:
-            case AssistantThought() | AssistantAction() | CodeFragment() | ExecutionResult():
-                session.events.pop(i)
-            case _:
-                regenerate_from_event_id = session_event.event_id
-                break
-        i -= 1
-    removed_count = original_len - len(session.events)
-    print(f"Removed {removed_count} assistant events for regeneration.")
-    input()
-
-    if regenerate_from_event_id:
-        resume_event = ResumeFrom(from_event_id=regenerate_from_event_id)
-        session_event = SessionEvent(event_id=str(uuid.uuid4()), body=resume_event)
-        session.events.append(session_event)
-
-    # Re-run the processing with the current session history.
-    if session.events:
-        _process_session_events()
-    else:
+    for indices in reversed(active_branch(session)):
+        for i in reversed(indices):
+            match session.events[i].body:
+                case AssistantThought() | AssistantAction() | CodeFragment() | ExecutionResult():
+                    continue
+                case _:
+                    regenerate_from_event_id = session.events[i].event_id
+            break
+        if regenerate_from_event_id:
+            break
+
+    if not regenerate_from_event_id:
         print("No user query found in session to regenerate response for.")
+        return
+
+    resume_event = ResumeFrom(from_event_id=regenerate_from_event_id)
+    session.append(SessionEvent(event_id=str(uuid.uuid4()), body=resume_event))
+
+    # Re-run the processing with the resumed session history.
+    # Same history as the last request: its other responses are still good, if any is left.
+    _process_session_events(alternatives.pop(0) if alternatives else None)
 
 
 def save_session():
@@ -0,0 +1,5 @@
+"""
+Performance benchmarks.
+
+Each submodule is runnable with `python -m src.bench.<name>`, and prints its results as a plain text table.
+"""
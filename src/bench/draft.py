@@ -0,0 +1,71 @@
+"""
+Constraint overhead of a draft step, as the response grows.
+
+At every step, `DraftModel` forks each row's constraint, and pushes the tokens it drafts to
+the fork. That should cost the same whatever the length of the response so far. For
+comparison, the same with a deep copy of the constraint, as forks used to be made.
+
+    python -m src.bench.draft --tokenizer unsloth/Phi-4 --n-tokens 8192
+"""
+
+import argparse
+import copy
+import time
+
+from transformers import AutoTokenizer
+
+from src.generate.constrain import RowConstraint
+from src.bench.enforcer import FILLER
+
+
+def deep_copy(constraint: RowConstraint) -> RowConstraint:
+    return copy.deepcopy(constraint, {id(constraint.tokenizer): constraint.tokenizer})
+
+
+def feed(constraint: RowConstraint, tokens: list[int]):
+    """Tokens, but those the constraint forces, as in decoding."""
+    for token in tokens:
+        forced = constraint.next_forced()
+        constraint.push(forced if forced is not None else token)
+
+
+def draft_steps(tokenizer, n_tokens: int, every: int, n_draft: int, repeat: int):
+    """
+    Every `every` tokens of a response, how long a draft step takes, in seconds: with forks,
+    and with deep copies. Yields `(n_tokens_so_far, fork_seconds, deepcopy_seconds)`.
+    """
+    stream = tokenizer.encode(FILLER, add_special_tokens=False)
+    stream = (stream * (n_tokens // len(stream) + 1))[: n_tokens + n_draft]
+    constraint = RowConstraint(tokenizer)
+    for start in range(0, n_tokens, every):
+        feed(constraint, stream[start : start + every])
+        draft = stream[start + every : start + every + n_draft]
+        timings = []
+        for fork in [RowConstraint.fork, deep_copy]:
+            t0 = time.perf_counter()
+            for _ in range(repeat):
+                feed(fork(constraint), draft)
+            timings.append((time.perf_counter() - t0) / repeat)
+        yield constraint.n_tokens, *timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tokenizer", default="unsloth/Phi-4")
+    parser.add_argument("--n-tokens", type=int, default=8192)
+    parser.add_argument("--every", type=int, default=1024)
+    parser.add_argument("--n-draft", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    print(f"{'tokens':>8} | {'fork (us)':>10} | {'deepcopy (us)':>14}")
+    print("-" * 38)
+    for n_tokens, fork, deepcopy in draft_steps(
+        tokenizer, args.n_tokens, args.every, args.n_draft, args.repeat
+    ):
+        print(f"{n_tokens:>8} | {fork * 1e6:>10.1f} | {deepcopy * 1e6:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Per-token overhead of `StructuredEnforcer` as the response grows.
+
+The model is taken out of the loop: we replay a long, pre-tokenized response through
+the enforcer, honoring whatever tokens it forces, and time each call.
+Per-token latency should stay flat, regardless of response length.
+
+    python -m src.bench.enforcer --tokenizer unsloth/Phi-4 --n-tokens 8192
+"""
+
+import argparse
+import time
+from statistics import mean
+
+import torch
+from transformers import AutoTokenizer
+
+from src.generate.constrain import StructuredEnforcer
+
+# Something thought-like, with multi-byte characters thrown in.
+FILLER = (
+    "Let's look at `df.groupby('région')` — the totals don't add up, "
+    "so maybe some rows are duplicated 🤔. I'll check `len(df)` vs. `df.drop_duplicates()`.\n"
+)
+
+
+def replay(tokenizer, n_tokens: int) -> list[float]:
+    """
+    Feed `n_tokens` tokens through a fresh enforcer. Returns per-call latencies, in seconds.
+    """
+    stream = tokenizer.encode(FILLER, add_special_tokens=False)
+    stream = (stream * (n_tokens // len(stream) + 1))[:n_tokens]
+
+    enforcer = StructuredEnforcer(tokenizer)
+    vocab_size = len(tokenizer)
+
+    # Preallocated, so that growing the sequence is free.
+    prompt = tokenizer.encode("Hi!", add_special_tokens=False)
+    ids = torch.zeros((1, len(prompt) + n_tokens + 64), dtype=torch.long)
+    ids[0, : len(prompt)] = torch.tensor(prompt)
+    length = len(prompt)
+
+    latencies = []
+    scores = torch.zeros((1, vocab_size))
+    while length < ids.shape[1] and stream:
+        scores.zero_()
+        t0 = time.perf_counter()
+        out = enforcer(ids[:, :length], scores)
+        latencies.append(time.perf_counter() - t0)
+
+        allowed = torch.isfinite(out[0]).nonzero()
+        ids[0, length] = allowed.item() if len(allowed) == 1 else stream.pop(0)
+        length += 1
+
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tokenizer", default="unsloth/Phi-4")
+    parser.add_argument("--n-tokens", type=int, default=8192)
+    parser.add_argument("--bucket", type=int, default=512)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    latencies = replay(tokenizer, args.n_tokens)
+
+    print(f"{'tokens':>14} | {'mean (us)':>10} | {'max (us)':>10}")
+    print("-" * 40)
+    for start in range(0, len(latencies), args.bucket):
+        bucket = latencies[start : start + args.bucket]
+        span = f"{start}-{start + len(bucket)}"
+        print(f"{span:>14} | {mean(bucket) * 1e6:>10.1f} | {max(bucket) * 1e6:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Extracting the code block of a response: our fence scanner vs. rendering Markdown to HTML.
+
+`extract_code_from_markdown` used to render the response with `markdown2`, then parse the
+HTML back with `BeautifulSoup`, to find one code block. `find_code_block` scans the text once,
+then `normalize_code` gives the same code as before.
+Here, both on responses of growing length.
+
+    python -m src.bench.fence --lengths 1000,10000,100000
+"""
+
+import argparse
+import timeit
+
+from src.postproc import extract_code_from_markdown
+
+CODE_LINE = "print(df[df['région'] == 'Île-de-France'].describe())  # <b>&</b>\n"
+
+
+def via_markdown(md_text: str) -> str:
+    """What `extract_code_from_markdown` used to do."""
+    import markdown2
+    from bs4 import BeautifulSoup
+
+    html = markdown2.markdown(md_text, extras=["fenced-code-blocks"])
+    code_blocks = BeautifulSoup(html, "html.parser").find_all("code")
+    if not code_blocks:
+        raise ValueError("No code block found in markdown")
+    if len(code_blocks) > 1:
+        raise ValueError("Multiple code blocks found in markdown")
+    return code_blocks[0].get_text()
+
+
+def response(n_chars: int) -> str:
+    """The part of a response after `</action>`, with about `n_chars` characters of code."""
+    code = CODE_LINE * max(1, n_chars // len(CODE_LINE))
+    return f"```python\n{code}```"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--lengths", default="100,1000,10000,100000")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'chars':>8} | {'markdown (us)':>14} | {'scanner (us)':>13} | {'speedup':>8}")
+    print("-" * 53)
+    for n_chars in map(int, args.lengths.split(",")):
+        text = response(n_chars)
+        assert extract_code_from_markdown(text) == via_markdown(text)
+        timings = []
+        for fn in [via_markdown, extract_code_from_markdown]:
+            number = max(1, 100_000 // n_chars)
+            best = min(timeit.repeat(lambda: fn(text), number=number, repeat=args.repeat))
+            timings.append(best / number)
+        markdown, scanner = timings
+        print(f"{len(text):>8} | {markdown * 1e6:>14.1f} | {scanner * 1e6:>13.1f} | {markdown / scanner:>7.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""
+Load test of a running `src.server`, replaying real conversations.
+
+Conversations are built from session XML files: one request per assistant turn, with the
+conversation up to it as the prompt. Requests go out at `--concurrency` at most, either
+back to back (closed loop), or arriving at `--rate` requests per second on average
+(Poisson arrivals, open loop).
+
+Latencies count from when a request was due, not from when it went out: when the server
+can't keep up, waiting for a free slot is part of what clients would see. Time-to-first-token
+is that of the first text the model sampled: what the constraint forces at first (`<thought>`)
+is streamed back before the prefill is even done, and doesn't count.
+
+    python -m src.bench.load --url http://localhost:8000 --concurrency 8 --n-requests 200
+    python -m src.bench.load --rate 2 --concurrency 32 --json load.json
+
+For a quick run without a GPU, against the fake backend:
+
+    python -m src.server --model "fake://replay?tps=40&prefill_ms=300"
+"""
+
+import argparse
+import asyncio
+import glob
+import json
+import logging
+import random
+import time
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional
+
+import httpx
+
+from src.persist.load import session_from_file
+from src.preproc import session_to_chatml
+from src.types import Conversation
+
+log = logging.getLogger(__name__)
+
+PERCENTILES = (50, 95, 99)
+
+
+@dataclass
+class RequestResult:
+    # Seconds since the request was due.
+    ttft: Optional[float] = None
+    latency: Optional[float] = None
+    n_tokens: int = 0
+    # HTTP status, or exception name. None if all went well.
+    error: Optional[str] = None
+
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        """Decoding speed as seen by the client: after the first token, if we know when it came."""
+        if self.error is not None or self.latency is None:
+            return None
+        duration = self.latency - (self.ttft or 0)
+        return self.n_tokens / duration if duration > 0 else None
+
+
+def conversations(pattern: str) -> List[Conversation]:
+    """Conversations up to each assistant turn, excluded."""
+    convs = []
+    for path in sorted(glob.glob(pattern)):
+        try:
+            conversation = session_to_chatml(session_from_file(path))
+        except Exception as e:
+            # Typically, a Git LFS pointer that wasn't pulled.
+            log.warning(f"Skipping {path}: {e}")
+            continue
+        convs += [conversation[:i] for i, msg in enumerate(conversation) if msg["role"] == "assistant"]
+    return convs
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """Linear interpolation between closest ranks, like `numpy.percentile`."""
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+async def send(
+    client: httpx.AsyncClient, conversation: Conversation, max_new_tokens: int, stream: bool, due: float
+) -> RequestResult:
+    result = RequestResult()
+    body = {"conversation": conversation, "max_new_tokens": max_new_tokens}
+    try:
+        if stream:
+            async with client.stream("POST", "/generate/stream", json=body) as response:
+                if response.status_code != 200:
+                    result.error = str(response.status_code)
+                    return result
+                async for line in response.aiter_lines():
+                    if not line:
+                        continue
+                    delta = json.loads(line)
+                    if result.ttft is None and delta["text"] and not delta.get("forced"):
+                        result.ttft = time.perf_counter() - due
+                    result.n_tokens += delta.get("n_tokens", 0)
+        else:
+            response = await client.post("/generate", json=body)
+            if response.status_code != 200:
+                result.error = str(response.status_code)
+                return result
+            result.n_tokens = response.json().get("n_tokens", 0)
+        result.latency = time.perf_counter() - due
+    except httpx.HTTPError as e:
+        result.error = type(e).__name__
+    return result
+
+
+async def run(
+    url: str,
+    convs: List[Conversation],
+    n_requests: int,
+    concurrency: int,
+    rate: Optional[float],
+    max_new_tokens: int,
+    stream: bool = True,
+    seed: int = 0,
+    timeout: float = 600,
+) -> tuple[List[RequestResult], float]:
+    """Results of each request, and how long it all took, in seconds."""
+    rng = random.Random(seed)
+    slots = asyncio.Semaphore(concurrency)
+    start = time.perf_counter()
+
+    async with httpx.AsyncClient(
+        base_url=url,
+        timeout=timeout,
+        limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency),
+    ) as client:
+
+        async def one(conversation: Conversation, due: float) -> RequestResult:
+            async with slots:
+                return await send(client, conversation, max_new_tokens, stream, due)
+
+        tasks = []
+        due = start
+        for i in range(n_requests):
+            if rate:
+                due += rng.expovariate(rate)
+                await asyncio.sleep(max(due - time.perf_counter(), 0))
+            else:
+                # Closed loop: due as soon as there's a slot.
+                await slots.acquire()
+                slots.release()
+                due = time.perf_counter()
+            tasks.append(asyncio.create_task(one(convs[i % len(convs)], due)))
+            # Let it grab its slot before the next one is considered.
+            await asyncio.sleep(0)
+        results = await asyncio.gather(*tasks)
+
+    return list(results), time.perf_counter() - start
+
+
+def summarize(results: List[RequestResult], elapsed: float) -> Dict:
+    ok = [r for r in results if r.error is None]
+    errors: Dict[str, int] = {}
+    for r in results:
+        if r.error is not None:
+            errors[r.error] = errors.get(r.error, 0) + 1
+
+    def stats(values: List[float]) -> Dict[str, Optional[float]]:
+        return {f"p{p}": percentile(values, p) for p in PERCENTILES}
+
+    n_tokens = sum(r.n_tokens for r in ok)
+    return {
+        "n_requests": len(results),
+        "n_ok": len(ok),
+        "errors": errors,
+        "elapsed": elapsed,
+        "requests_per_second": len(ok) / elapsed if elapsed else None,
+        "tokens_per_second": n_tokens / elapsed if elapsed else None,
+        "n_tokens": n_tokens,
+        "ttft": stats([r.ttft for r in ok if r.ttft is not None]),
+        "latency": stats([r.latency for r in ok]),
+        "request_tokens_per_second": stats(
+            [tps for r in ok if (tps := r.tokens_per_second) is not None]
+        ),
+    }
+
+
+def format_table(summary: Dict) -> str:
+    def cell(value: Optional[float], scale: float = 1) -> str:
+        return f"{value * scale:>9.1f}" if value is not None else f"{'-':>9}"
+
+    header = f"{'':>20} | " + " | ".join(f"{f'p{p}':>9}" for p in PERCENTILES)
+    lines = [header, "-" * len(header)]
+    for key, label, scale in [
+        ("ttft", "TTFT (ms)", 1000),
+        ("latency", "latency (ms)", 1000),
+        ("request_tokens_per_second", "tokens/s (request)", 1),
+    ]:
+        row = " | ".join(cell(summary[key][f"p{p}"], scale) for p in PERCENTILES)
+        lines.append(f"{label:>20} | {row}")
+    lines.append("-" * len(header))
+
+    errors = ", ".join(f"{k}: {v}" for k, v in sorted(summary["errors"].items())) or "none"
+    lines.append(
+        f"{summary['n_ok']}/{summary['n_requests']} requests in {summary['elapsed']:.1f}s: "
+        f"{summary['requests_per_second']:.2f} req/s, {summary['tokens_per_second']:.1f} tokens/s "
+        f"overall; errors: {errors}"
+    )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--sessions", default="data/sessions/validated/*.xml")
+    parser.add_argument("--n-requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8, help="Max requests in flight")
+    parser.add_argument(
+        "--rate", type=float, default=None,
+        help="Mean arrival rate, in requests per second. Back to back if not set.",
+    )
+    parser.add_argument("--max-new-tokens", type=int, default=512)
+    parser.add_argument(
+        "--no-stream", action="store_true",
+        help="Use /generate instead of /generate/stream: no time-to-first-token then.",
+    )
+    parser.add_argument("--shuffle", action="store_true", help="Replay turns in random order")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=600, help="Per request, in seconds")
+    parser.add_argument("--json", default=None, help="Also write the summary there")
+    args = parser.parse_args()
+
+    convs = conversations(args.sessions)
+    if not convs:
+        parser.error(f"No conversations found in {args.sessions} (Git LFS files not pulled?)")
+    if args.shuffle:
+        random.Random(args.seed).shuffle(convs)
+
+    results, elapsed = asyncio.run(
+        run(
+            args.url,
+            convs,
+            n_requests=args.n_requests,
+            concurrency=args.concurrency,
+            rate=args.rate,
+            max_new_tokens=args.max_new_tokens,
+            stream=not args.no_stream,
+            seed=args.seed,
+            timeout=args.timeout,
+        )
+    )
+    summary = summarize(results, elapsed)
+    summary["config"] = {k: v for k, v in vars(args).items() if k != "json"}
+    summary["requests"] = [asdict(r) for r in results]
+
+    print(format_table(summary))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Speculative decoding with prompt lookup, on real conversations.
+
+For each assistant turn of the validated sessions, we generate a response to the conversation
+so far, with and without prompt lookup, and compare: how many guesses the model accepted,
+how many tokens each forward pass yielded, and how long it took.
+Greedy decoding, so both responses should be identical.
+
+    python -m src.bench.speculate --model unsloth/Phi-4 --max-turns 20
+"""
+
+import argparse
+import glob
+import time
+
+from src.generate.decode import DecodeStats, Sampler, decode_batch
+from src.generate.constrain import StructuredEnforcer
+from src.generate.llm import LLM
+from src.generate.speculate import PromptLookup
+from src.persist.load import session_from_file
+from src.preproc import session_to_chatml
+
+
+def assistant_turns(pattern: str):
+    """Conversations up to each assistant turn, excluded."""
+    for path in sorted(glob.glob(pattern)):
+        conversation = session_to_chatml(session_from_file(path))
+        for i, msg in enumerate(conversation):
+            if msg["role"] == "assistant":
+                yield path, conversation[:i]
+
+
+def run(llm: LLM, prompt, max_new_tokens: int, drafter) -> tuple[list[int], DecodeStats, float]:
+    stats = DecodeStats()
+    t0 = time.perf_counter()
+    batch = llm.backend.new_decoder(
+        StructuredEnforcer(llm.tokenizer, llm.state_masks),
+        # Greedy: prompt lookup doesn't change the output.
+        Sampler(),
+        stop_token_ids=llm._stop_token_ids(),
+        pad_token_id=llm._pad_token_id(),
+        stats=stats,
+        drafter=drafter,
+    )
+    (output,) = decode_batch(batch, [prompt], max_new_tokens)
+    return output, stats, time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--model", default="unsloth/Phi-4")
+    parser.add_argument("--chat-template", default="phi-4")
+    parser.add_argument("--sessions", default="data/sessions/validated/*.xml")
+    parser.add_argument("--max-turns", type=int, default=20)
+    parser.add_argument("--max-new-tokens", type=int, default=512)
+    parser.add_argument("--n-draft", type=int, default=8)
+    args = parser.parse_args()
+
+    llm = LLM(args.model, args.chat_template, max_seq_length=16000)
+
+    print(
+        f"{'session':>24} | {'turn':>4} | {'tokens':>6} | {'accepted':>8} | "
+        f"{'tok/fwd':>7} | {'base tok/fwd':>12} | {'speedup':>7} | same"
+    )
+    print("-" * 94)
+    totals = {True: DecodeStats(), False: DecodeStats()}
+    times = {True: 0.0, False: 0.0}
+    for n, (path, conversation) in enumerate(assistant_turns(args.sessions)):
+        if n >= args.max_turns:
+            break
+        prompt = llm.prompt_tokens(conversation)
+        results = {}
+        for speculate in [False, True]:
+            drafter = PromptLookup(n_draft=args.n_draft) if speculate else None
+            results[speculate] = run(llm, prompt, args.max_new_tokens, drafter)
+
+        (base, base_stats, base_time), (output, stats, elapsed) = results[False], results[True]
+        for speculate, (_, s, t) in results.items():
+            total = totals[speculate]
+            total.n_generated += s.n_generated
+            total.n_forward += s.n_forward
+            total.n_drafted += s.n_drafted
+            total.n_accepted += s.n_accepted
+            times[speculate] += t
+
+        name = path.rsplit("/", 1)[-1].removesuffix(".xml")[:24]
+        print(
+            f"{name:>24} | {len(conversation):>4} | {stats.n_generated:>6} | "
+            f"{stats.acceptance_rate:>8.0%} | {stats.tokens_per_forward:>7.2f} | "
+            f"{base_stats.tokens_per_forward:>12.2f} | {base_time / elapsed:>6.2f}x | "
+            f"{'yes' if output == base else 'NO'}"
+        )
+
+    spec, base = totals[True], totals[False]
+    print("-" * 94)
+    print(
+        f"Accepted {spec.n_accepted}/{spec.n_drafted} guesses ({spec.acceptance_rate:.0%}); "
+        f"{spec.tokens_per_forward:.2f} tokens per forward pass, vs. {base.tokens_per_forward:.2f}; "
+        f"{times[False] / max(times[True], 1e-9):.2f}x faster overall"
+    )
+
+
+if __name__ == "__main__":
+    main()
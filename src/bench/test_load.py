@@ -0,0 +1,85 @@
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+
+from .load import RequestResult, format_table, percentile, send, summarize
+
+
+def test_ttft_skips_forced():
+    """Time-to-first-token is that of sampled text, not of the `<thought>` forced upfront."""
+    lines = [
+        {"text": "<thought>", "state": "THOUGHT_CONTENT", "n_tokens": 3, "forced": True, "index": 0},
+        {"text": "Hi", "state": "THOUGHT_CONTENT", "n_tokens": 1, "forced": False, "index": 0},
+    ]
+
+    async def body():
+        for line in lines:
+            await asyncio.sleep(0.05)
+            yield (json.dumps(line) + "\n").encode()
+
+    async def main():
+        transport = httpx.MockTransport(lambda request: httpx.Response(200, content=body()))
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await send(client, [], 16, stream=True, due=time.perf_counter())
+
+    result = asyncio.run(main())
+    assert result.error is None
+    assert result.n_tokens == 4
+    # Two deltas, 50ms apart: the second one counts.
+    assert 0.09 < result.ttft <= result.latency
+
+
+def test_percentile():
+    assert percentile([], 50) is None
+    assert percentile([3.0], 99) == 3.0
+    assert percentile([4.0, 1.0, 3.0, 2.0], 50) == 2.5
+    assert percentile([1.0, 2.0, 3.0, 4.0], 0) == 1.0
+    assert percentile([1.0, 2.0, 3.0, 4.0], 100) == 4.0
+    assert percentile([1.0, 2.0, 3.0, 4.0], 95) == pytest.approx(3.85)
+
+
+def test_summary():
+    results = [
+        RequestResult(ttft=0.1, latency=1.1, n_tokens=100),
+        RequestResult(ttft=0.3, latency=2.3, n_tokens=100),
+        # No time-to-first-token: requests to /generate.
+        RequestResult(latency=0.5, n_tokens=10),
+        RequestResult(error="429"),
+        RequestResult(error="429"),
+        RequestResult(error="ReadTimeout"),
+    ]
+    summary = summarize(results, elapsed=4.0)
+    # As written by `--json`.
+    assert json.loads(json.dumps(summary)) == summary
+    assert summary["n_requests"] == 6
+    assert summary["n_ok"] == 3
+    assert summary["errors"] == {"429": 2, "ReadTimeout": 1}
+    assert summary["n_tokens"] == 210
+    assert summary["requests_per_second"] == 0.75
+    assert summary["tokens_per_second"] == 52.5
+    assert summary["ttft"]["p50"] == pytest.approx(0.2)
+    assert summary["latency"]["p50"] == pytest.approx(1.1)
+    # 100 tokens in 1s, in 2s, and 10 tokens in 0.5s.
+    assert summary["request_tokens_per_second"]["p50"] == pytest.approx(50.0)
+
+    table = format_table(summary)
+    lines = table.splitlines()
+    assert [cell.strip() for cell in lines[0].split("|")[1:]] == ["p50", "p95", "p99"]
+    rows = {line.split("|")[0].strip(): line.split("|")[1:] for line in lines[2:5]}
+    assert list(rows) == ["TTFT (ms)", "latency (ms)", "tokens/s (request)"]
+    assert float(rows["TTFT (ms)"][0]) == 200.0
+    assert float(rows["latency (ms)"][0]) == 1100.0
+    assert float(rows["tokens/s (request)"][0]) == 50.0
+    assert lines[-1] == (
+        "3/6 requests in 4.0s: 0.75 req/s, 52.5 tokens/s overall; errors: 429: 2, ReadTimeout: 1"
+    )
+
+
+def test_summary_all_failed():
+    summary = summarize([RequestResult(error="ConnectError")], elapsed=0.1)
+    assert summary["ttft"] == {"p50": None, "p95": None, "p99": None}
+    table = format_table(summary)
+    assert "TTFT (ms)" in table and "-" in table.splitlines()[2].split("|")[1]
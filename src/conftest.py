@@ -0,0 +1,142 @@
+"""
+Shared fixtures for generation tests.
+
+Everything here is built locally, in a fraction of a second: no downloads, no GPU.
+"""
+
+import random
+from types import SimpleNamespace
+from typing import Sequence
+
+import pytest
+import torch
+from tokenizers import Tokenizer, models, trainers, pre_tokenizers, decoders
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+# Enough for the BPE merges to cover our tags, fences, and some multi-byte characters.
+_CORPUS = [
+    "<thought>Let me think about it.</thought>\n<action>List files</action>\n"
+    "```python\nimport os\nprint(os.listdir('.'))\n```\n",
+    "héllo wörld, 日本語, émoji 🎉",
+] * 50
+
+_CHAT_TEMPLATE = (
+    "{% for m in messages %}<|im_start|>{{ m['role'] }}\n{{ m['content'] }}<|im_end|>\n{% endfor %}"
+    "{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}"
+)
+
+
+@pytest.fixture(scope="session")
+def tiny_tokenizer():
+    """A small byte-level BPE tokenizer with a ChatML-like template."""
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=400,
+        special_tokens=["<|endoftext|>", "<|im_start|>", "<|im_end|>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    tokenizer.train_from_iterator(_CORPUS, trainer)
+
+    wrapped = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        eos_token="<|im_end|>",
+        pad_token="<|endoftext|>",
+    )
+    wrapped.chat_template = _CHAT_TEMPLATE
+    return wrapped
+
+
+@pytest.fixture(scope="session")
+def tiny_llama(tiny_tokenizer):
+    """A randomly-initialized, two-layer Llama. Outputs are gibberish, but real."""
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=len(tiny_tokenizer),
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=4096,
+    )
+    return LlamaForCausalLM(config).eval()
+
+
+class ScriptedLM:
+    """
+    Stand-in for a causal LM, which always "wants" to write `script` as its response.
+    `script` may also be a function of the prompt text, e.g. to script each row of a batch differently.
+
+    At each step, it looks at what the response is so far (everything after the last
+    assistant header), and strongly favors the first token of what is left to write.
+    Forced tokens that agree with the script are followed seamlessly.
+
+    Its "KV cache" holds the tokens seen so far, in place of keys and values, in the legacy
+    format: a single layer, with shape `(batch, 1, seq, 1)`. Like attention, it only
+    looks at positions that the attention mask lets through.
+    """
+
+    device = torch.device("cpu")
+
+    def __init__(self, tokenizer, script: str, header: str = "<|im_start|>assistant\n"):
+        self.tokenizer = tokenizer
+        self.script = script
+        self.header = header
+        self.n_calls = 0
+
+    def next_token(self, token_ids) -> int:
+        text = self.tokenizer.decode(token_ids)
+        prompt, _, response = text.rpartition(self.header)
+        script = self.script(prompt) if callable(self.script) else self.script
+        if not script.startswith(response) or response == script:
+            return self.tokenizer.eos_token_id
+        rest = script[len(response) :]
+        return self.tokenizer.encode(rest, add_special_tokens=False)[0]
+
+    def forward(self, input_ids, attention_mask=None, past_key_values=None, **kwargs):
+        self.n_calls += 1
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        seen = input_ids[:, None, :, None]
+        if past_key_values is not None:
+            seen = torch.cat([past_key_values[0][0], seen], dim=2)
+        attended = attention_mask.bool()
+
+        # At each real position of the chunk, the prediction for what follows it.
+        logits = torch.zeros((*input_ids.shape, len(self.tokenizer)))
+        n_past = seen.shape[2] - input_ids.shape[1]
+        for i in range(input_ids.shape[0]):
+            for j in range(input_ids.shape[1]):
+                end = n_past + j + 1
+                if attended[i, end - 1]:
+                    context = seen[i, 0, :end][attended[i, :end]]
+                    logits[i, j, self.next_token(context[:, 0].tolist())] = 10.0
+        past_key_values = ((seen, seen),)
+        return SimpleNamespace(logits=logits, past_key_values=past_key_values)
+
+    __call__ = forward
+
+
+@pytest.fixture
+def scripted_lm(tiny_tokenizer):
+    """Factory: `scripted_lm(script) -> ScriptedLM`."""
+    return lambda script: ScriptedLM(tiny_tokenizer, script)
+
+
+# Building blocks for random texts: biased toward what matters, i.e. fences, blank lines, whitespace.
+_PIECES = ["```", "```python\n", "\n```", "`", "``", "\n", " ", "\t", "\r", "x", "python", "é", "🎉"]
+
+
+@pytest.fixture
+def random_text():
+    """
+    Factory: `random_text(rng) -> str`, for fuzzing anything that deals with code fences.
+    `pieces` replaces what texts are made of.
+    """
+
+    def make(rng: random.Random, pieces: Sequence[str] = _PIECES) -> str:
+        return "".join(rng.choice(pieces) for _ in range(rng.randint(0, 30)))
+
+    return make
@@ -0,0 +1,77 @@
+"""
+Inference backends: what actually runs the model.
+
+`LLM` takes care of everything else: the constraint, sampling, speculation, KV cache reuse...
+A backend loads a model and its tokenizer, and creates decoding loops (`BatchDecoder`s) for them.
+
+- `UnslothBackend`: transformers models, through Unsloth, on CUDA. The default.
+- `LlamaCppBackend`: GGUF files (e.g. from `save_pretrained_gguf`), through llama.cpp, on CPU.
+- `FakeBackend`: `fake://...`, scripted responses on a timer, for load tests. No model at all.
+"""
+
+from abc import ABC, abstractmethod
+from typing import Optional, Set
+
+import torch
+
+from ..constrain import StructuredEnforcer
+from ..decode import BatchDecoder, DecodeStats, Sampler
+from ..kv import KVPool
+from ..lora import Adapters
+
+
+class Backend(ABC):
+    """What `LLM` needs from an inference engine."""
+
+    # Chat template included.
+    tokenizer = None
+    # Sampling defaults and stop tokens, as with `model.generate`.
+    generation_config = None
+    # Where logits, and thus constraint masks, live.
+    device = torch.device("cpu")
+    # Most sequences worth decoding together, if there's a limit.
+    max_batch_size: Optional[int] = None
+    # Whether it can check guessed tokens in a single forward pass (speculative decoding),
+    # and hand KV caches over to a `KVPool`.
+    speculative = True
+    reuses_kv = True
+    # LoRA adapters that requests may choose from, if it can switch between adapters.
+    adapters: Optional[Adapters] = None
+
+    @abstractmethod
+    def new_decoder(
+        self,
+        enforcer: Optional[StructuredEnforcer],
+        sampler: Sampler,
+        stop_token_ids: Set[int],
+        pad_token_id: int,
+        jump_forward: bool = True,
+        stats: Optional[DecodeStats] = None,
+        kv_pool: Optional[KVPool] = None,
+        drafter=None,
+    ) -> BatchDecoder:
+        ...
+
+
+def load_backend(
+    model_name: str,
+    chat_template: str,
+    max_seq_length: int,
+    tokenizer_name: Optional[str] = None,
+) -> Backend:
+    """
+    The backend for `model_name`: llama.cpp for a `.gguf` file, a fake one for `fake://...`,
+    Unsloth otherwise. Imported lazily: none of them is needed for the others.
+    """
+    if model_name.startswith("fake://"):
+        from .fake import FakeBackend
+
+        return FakeBackend(model_name)
+    if model_name.endswith(".gguf"):
+        from .llamacpp import LlamaCppBackend
+
+        return LlamaCppBackend(model_name, max_seq_length, tokenizer_name)
+
+    from .unsloth import UnslothBackend
+
+    return UnslothBackend(model_name, chat_template, max_seq_length)
@@ -0,0 +1,274 @@
+"""
+A stand-in for a real model, to load-test and profile everything around it without a GPU:
+the server, the client, the parse/execute loop.
+
+    uv run -m src.server --model "fake://?tps=40&prefill_ms=300&length=400"
+    uv run -m src.server --model "fake://replay?tps=40"
+
+Responses follow the structure `StructuredEnforcer` expects, and go through the real
+decoding loop: constraint, jump-forward, batching, streaming. Only the forward passes are
+faked, taking as long as configured. Responses are deterministic: they only depend on the
+prompt and the seed.
+
+Query parameters:
+- `tps`: decoding speed, in tokens per second for each sequence (forward passes per second,
+  really). 0 for as fast as possible.
+- `prefill_ms`: latency of each prefill, on top of `prefill_tps`.
+- `prefill_tps`: prompt tokens processed per second. 0 for no per-token cost.
+- `length`, `length_sigma`: response lengths, in tokens, are log-normally distributed around
+  `length`.
+- `seed`.
+- `sessions`: a glob of session XML files, whose assistant turns are replayed: the actual
+  response for a conversation found in them, another one otherwise.
+  `fake://replay` means the validated sessions.
+- `tokenizer`: a Hugging Face tokenizer, with a chat template. By default, a byte-level
+  ChatML tokenizer built on the spot: no downloads.
+"""
+
+import glob
+import hashlib
+import logging
+import math
+import random
+import re
+import time
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlsplit
+
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+from torch import Tensor
+from transformers import AutoTokenizer, GenerationConfig, PreTrainedTokenizerFast
+
+from ..decode import BatchDecoder, DecodeRow
+from . import Backend
+
+log = logging.getLogger(__name__)
+
+VALIDATED_SESSIONS = "data/sessions/validated/*.xml"
+
+CHATML_TEMPLATE = (
+    "{% for m in messages %}<|im_start|>{{ m['role'] }}\n{{ m['content'] }}<|im_end|>\n{% endfor %}"
+    "{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}"
+)
+
+# An assistant message, as flattened by `session_to_chatml`.
+_ASSISTANT_RE = re.compile(
+    r"<thought>(.*?)</thought>\s*<action>(.*?)</action>\s*```python\n(.*?)\n```", re.DOTALL
+)
+
+_WORDS = (
+    "let me look at the data first then check the shape of each column and "
+    "see whether any values are missing before plotting the distribution"
+).split()
+
+
+def byte_level_tokenizer() -> PreTrainedTokenizerFast:
+    """One token per byte, plus ChatML's special tokens."""
+    alphabet = sorted(pre_tokenizers.ByteLevel.alphabet())
+    vocab = {"<|endoftext|>": 0, "<|im_start|>": 1, "<|im_end|>": 2}
+    vocab.update({char: i + 3 for i, char in enumerate(alphabet)})
+    tokenizer = Tokenizer(models.BPE(vocab=vocab, merges=[]))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+
+    wrapped = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        eos_token="<|im_end|>",
+        pad_token="<|endoftext|>",
+        additional_special_tokens=["<|im_start|>"],
+    )
+    wrapped.chat_template = CHATML_TEMPLATE
+    return wrapped
+
+
+def render(thought: str, action: str, code: str) -> str:
+    """A response, exactly as the constraint has it generated, minus the final newline and EOS."""
+    return f"<thought>{thought}</thought>\n<action>{action}</action>\n```python\n{code}\n```"
+
+
+class FakeBackend(Backend):
+    # Scripted responses don't need any cache, and can't make use of one.
+    reuses_kv = False
+
+    def __init__(self, url: str):
+        parsed = urlsplit(url)
+        params = {k: v[-1] for k, v in parse_qs(parsed.query).items()}
+        self.tps = float(params.get("tps", 50))
+        self.prefill_latency = float(params.get("prefill_ms", 100)) / 1000
+        self.prefill_tps = float(params.get("prefill_tps", 0))
+        self.length = int(params.get("length", 200))
+        self.length_sigma = float(params.get("length_sigma", 0.5))
+        self.seed = int(params.get("seed", 0))
+
+        if "tokenizer" in params:
+            self.tokenizer = AutoTokenizer.from_pretrained(params["tokenizer"])
+        else:
+            self.tokenizer = byte_level_tokenizer()
+        # Greedy: the scripted token always wins.
+        self.generation_config = GenerationConfig(eos_token_id=self.tokenizer.eos_token_id)
+
+        # Prompt hash -> response, for the conversations found in sessions.
+        self.replies: Dict[str, str] = {}
+        self.replay: List[str] = []
+        sessions = params.get("sessions", VALIDATED_SESSIONS if parsed.netloc == "replay" else None)
+        if sessions is not None:
+            self._load_sessions(sessions)
+
+        # Characters per token, to turn a length in tokens into text.
+        sample = " ".join(_WORDS)
+        self._chars_per_token = len(sample) / len(self.tokenizer.encode(sample))
+
+    def new_decoder(self, *args, **kwargs) -> BatchDecoder:
+        return FakeDecoder(self, *args, **kwargs)
+
+    def response(self, prompt: List[int], sample: int = 0) -> str:
+        """What to say after `prompt`. Other `sample`s are alternative responses."""
+        key = _hash(prompt)
+        if key in self.replies and sample == 0:
+            return self.replies[key]
+        rng = random.Random(f"{self.seed}:{key}:{sample}" if sample else f"{self.seed}:{key}")
+        if self.replay:
+            return rng.choice(self.replay)
+
+        n_chars = self._chars_per_token * rng.lognormvariate(
+            math.log(self.length), self.length_sigma
+        )
+        thought = _words(rng, n_chars * 0.6)
+        action = _words(rng, min(n_chars * 0.1, 40))
+        lines = ["x = 0"]
+        while sum(len(line) + 1 for line in lines) < n_chars * 0.3:
+            lines.append(rng.choice([f"x = x * {rng.randint(2, 9)} + 1", "print(x)"]))
+        return render(thought.capitalize() + ".", action.capitalize(), "\n".join(lines))
+
+    def _load_sessions(self, pattern: str):
+        # Not needed otherwise, and heavier.
+        from src.persist.load import session_from_file
+        from src.preproc import session_to_chatml
+
+        for path in sorted(glob.glob(pattern)):
+            try:
+                conversation = session_to_chatml(session_from_file(path))
+            except Exception as e:
+                log.warning(f"Skipping {path}: {e}")
+                continue
+            for i, msg in enumerate(conversation):
+                if msg["role"] != "assistant" or not (m := _ASSISTANT_RE.search(msg["content"])):
+                    continue
+                reply = render(*(group.strip("\n") for group in m.groups()))
+                prompt = self.tokenizer.apply_chat_template(
+                    conversation[:i], add_generation_prompt=True
+                )
+                self.replies[_hash(prompt)] = reply
+                self.replay.append(reply)
+        log.info(f"Replaying {len(self.replay)} assistant turns from {pattern}")
+
+
+class _Script:
+    """What's left to say for a row, as tokens, kept in sync with what it actually got."""
+
+    def __init__(self, tokenizer, text: str):
+        self.tokenizer = tokenizer
+        self.text = text
+        # What's left is `tokens[pos:]`.
+        self.tokens = tokenizer.encode(text, add_special_tokens=False)
+        self.pos = 0
+        self.n_seen = 0
+
+    def next(self, j: int) -> Optional[int]:
+        return self.tokens[self.pos + j] if self.pos + j < len(self.tokens) else None
+
+    def sync(self, generated: List[int]):
+        for i in range(self.n_seen, len(generated)):
+            if generated[i] == self.next(0):
+                self.pos += 1
+            else:
+                # Forced tokens may be tokenized differently: start over from the text.
+                said = self.tokenizer.decode(generated[: i + 1])
+                rest = self.text[len(said) :] if self.text.startswith(said) else ""
+                self.tokens, self.pos = self.tokenizer.encode(rest, add_special_tokens=False), 0
+        self.n_seen = len(generated)
+
+
+class FakeDecoder(BatchDecoder):
+    """`BatchDecoder` whose "forward passes" predict each row's scripted response, on a timer."""
+
+    def __init__(self, backend: FakeBackend, *args, **kwargs):
+        super().__init__(backend, *args, **kwargs)
+        assert self.kv_pool is None, "Nothing to cache"
+        self.backend = backend
+        self._scripts: Dict[DecodeRow, _Script] = {}
+
+    def remove(self, rows: List[DecodeRow]):
+        super().remove(rows)
+        for row in rows:
+            self._scripts.pop(row, None)
+
+    def _prefill(self, row: DecodeRow) -> Tensor:
+        prompt = row.sequence[: len(row.sequence) - len(row.generated)]
+        self._scripts[row] = _Script(self.tokenizer, self.backend.response(prompt))
+        delay = self.backend.prefill_latency
+        if self.backend.prefill_tps:
+            delay += len(row.sequence) / self.backend.prefill_tps
+        time.sleep(delay)
+
+        self.stats.n_forward += 1
+        self.stats.n_prefilled += len(row.sequence)
+        row.prefilled = True
+        row.n_fed = len(row.sequence)
+        return self._logits(row, [])
+
+    def _share_prefill(self, row: DecodeRow, leader: DecodeRow, logits: Tensor) -> Tensor:
+        prompt = row.sequence[: len(row.sequence) - len(row.generated)]
+        sample = sum(1 for r in self._scripts if r.prefill_from is leader) + 1
+        self._scripts[row] = _Script(self.tokenizer, self.backend.response(prompt, sample))
+        row.prefilled = True
+        row.n_fed = len(row.sequence)
+        return self._logits(row, [])
+
+    def _forward_batch(self, rows: List[DecodeRow], drafts: List[List[int]]) -> List[Tensor]:
+        if self.backend.tps:
+            time.sleep(1 / self.backend.tps)
+        self.stats.n_forward += 1
+        self._chunk_padding = [0 for _ in rows]
+        logits = []
+        for row, draft in zip(rows, drafts):
+            row.n_fed = len(row.sequence) + len(draft)
+            logits.append(self._logits(row, draft))
+        return logits
+
+    def _reject(self, rows: List[DecodeRow], drafts: List[List[int]], n_accepted: List[int]):
+        # No KV cache to mask: just the bookkeeping.
+        for i, (row, draft) in enumerate(zip(rows, drafts)):
+            self.stats.n_drafted += len(draft)
+            self.stats.n_accepted += n_accepted[i]
+            row.n_drafted += len(draft)
+            row.n_accepted += n_accepted[i]
+            row.n_fed -= len(draft) - n_accepted[i]
+
+    @property
+    def tokenizer(self):
+        return self.backend.tokenizer
+
+    def _logits(self, row: DecodeRow, draft: List[int]) -> Tensor:
+        """Next-token logits of `row`, then after each guess, assuming the previous ones right."""
+        script = self._scripts[row]
+        script.sync(row.generated)
+        logits = torch.zeros((len(draft) + 1, len(self.tokenizer)))
+        right = True
+        for j in range(len(draft) + 1):
+            token = script.next(j) if right else None
+            logits[j, token if token is not None else self.tokenizer.eos_token_id] = 100.0
+            right = j < len(draft) and token == draft[j]
+        return logits
+
+
+def _hash(tokens: List[int]) -> str:
+    return hashlib.sha1(str(tokens).encode()).hexdigest()
+
+
+def _words(rng: random.Random, n_chars: float) -> str:
+    words = []
+    while sum(len(w) + 1 for w in words) < n_chars or not words:
+        words.append(rng.choice(_WORDS))
+    return " ".join(words)
@@ -0,0 +1,122 @@
+"""
+GGUF models through llama.cpp, on CPU: for machines without a GPU.
+
+Needs `llama-cpp-python`, which isn't a dependency by default:
+
+    uv pip install llama-cpp-python
+
+llama.cpp only gives us next-token logits: sampling, the constraint and jump-forward are
+applied on top, by the same code as for other backends. That's llama.cpp's logits processor
+hook, in effect, but with the whole state machine rather than a grammar: a GBNF grammar
+can't express "a code block ends at the first line that is only a fence" as simply, and
+wouldn't share masks with the other backends.
+"""
+
+import logging
+import os
+from typing import List, Optional
+
+import numpy as np
+import torch
+from torch import Tensor
+from transformers import AutoTokenizer, GenerationConfig
+
+from ..decode import BatchDecoder, DecodeRow
+from ..kv import common_prefix_length
+from . import Backend
+
+log = logging.getLogger(__name__)
+
+
+class LlamaCppBackend(Backend):
+    """
+    `model_path` is a `.gguf` file. Its tokenizer, chat template included, is loaded with
+    transformers from `tokenizer_name`, by default the file's directory, where
+    `save_pretrained_gguf` puts it.
+    """
+
+    # A llama.cpp context holds one sequence: rows would evict each other's KV cache.
+    max_batch_size = 1
+    speculative = False
+    reuses_kv = False
+
+    def __init__(
+        self, model_path: str, max_seq_length: int, tokenizer_name: Optional[str] = None
+    ):
+        try:
+            from llama_cpp import Llama
+        except ImportError as e:
+            raise ImportError(
+                "GGUF models need llama-cpp-python: `uv pip install llama-cpp-python`"
+            ) from e
+
+        tokenizer_name = tokenizer_name or os.path.dirname(os.path.abspath(model_path))
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+        if self.tokenizer.chat_template is None:
+            raise ValueError(f"The tokenizer in {tokenizer_name} has no chat template")
+        try:
+            self.generation_config = GenerationConfig.from_pretrained(tokenizer_name)
+        except OSError:
+            # Greedy.
+            self.generation_config = GenerationConfig()
+        if self.generation_config.eos_token_id is None:
+            self.generation_config.eos_token_id = self.tokenizer.eos_token_id
+
+        log.info(f"Loading {model_path} with llama.cpp")
+        self.model = Llama(
+            model_path=model_path, n_ctx=max_seq_length, n_gpu_layers=0, verbose=False
+        )
+
+    def new_decoder(self, *args, **kwargs) -> BatchDecoder:
+        return LlamaCppDecoder(self.model, *args, **kwargs)
+
+
+class LlamaCppDecoder(BatchDecoder):
+    """
+    `BatchDecoder` over a llama.cpp model.
+
+    Rows are evaluated one after the other, in llama.cpp's single-sequence context. Whatever
+    a row shares with what was evaluated last is kept: the previous turn of a conversation,
+    and with a single row, everything but the new tokens.
+    """
+
+    def __init__(self, model, *args, **kwargs):
+        super().__init__(model, *args, **kwargs)
+        assert self.kv_pool is None, "llama.cpp keeps its own KV cache"
+        assert self.drafter is None, "No speculative decoding with llama.cpp"
+
+    def _prefill(self, row: DecodeRow) -> Tensor:
+        row.prefilled = True
+        return self._eval(row, prefill=True)
+
+    def _share_prefill(self, row: DecodeRow, leader: DecodeRow, logits: Tensor) -> Tensor:
+        # Nothing to copy: the next evaluation of `row` reuses whatever it shares with the context.
+        row.prefilled = True
+        row.n_fed = len(row.sequence)
+        return logits
+
+    def _forward_batch(self, rows: List[DecodeRow], drafts: List[List[int]]) -> List[Tensor]:
+        return [self._eval(row) for row in rows]
+
+    def _reject(self, rows: List[DecodeRow], drafts: List[List[int]], n_accepted: List[int]):
+        # No guesses, and no KV cache of ours to mask.
+        pass
+
+    def _eval(self, row: DecodeRow, prefill: bool = False) -> Tensor:
+        """Next-token logits of `row`, shape `(1, vocab)`."""
+        llama = self.model
+        # At least one token to evaluate, for its logits.
+        n_past = common_prefix_length(llama.input_ids[: llama.n_tokens].tolist(), row.sequence)
+        n_past = min(n_past, len(row.sequence) - 1)
+        if prefill:
+            self.stats.n_reused += n_past
+            self.stats.n_prefilled += len(row.sequence) - n_past
+
+        # Evaluation starts by discarding the KV cache past `n_tokens`.
+        llama.n_tokens = n_past
+        llama.eval(row.sequence[n_past:])
+        self.stats.n_forward += 1
+        row.n_fed = len(row.sequence)
+
+        logits = np.array(llama.scores[llama.n_tokens - 1], dtype=np.float32)
+        return torch.from_numpy(logits)[None]
@@ -0,0 +1,90 @@
+import time
+
+from src.generate.llm import LLM
+from src.persist.load import session_from_file
+from src.postproc import parse_constrained_message
+from src.preproc import session_to_chatml
+from src.types import AssistantAction, AssistantThought, CodeFragment
+
+FAST = "fake://?tps=0&prefill_ms=0"
+
+SESSION = """<session>
+    <events>
+        <msg from="user">How many files are there?</msg>
+        <thought>Let me count them.</thought>
+        <action>Count files</action>
+        <code>import os
+print(len(os.listdir('.')))</code>
+        <result>42</result>
+    </events>
+</session>
+"""
+
+
+def _conversation(question: str):
+    return [{"role": "system", "content": "Be helpful."}, {"role": "user", "content": question}]
+
+
+def _parse(response: str):
+    return parse_constrained_message(response.removesuffix("\n<|im_end|>"))
+
+
+def test_structured_and_deterministic():
+    llm = LLM(FAST)
+    conversations = [_conversation(f"Question {i}?") for i in range(4)]
+    responses = llm.generate(conversations, max_new_tokens=4000)
+    for response in responses:
+        events = _parse(response)
+        assert [type(e) for e in events] == [AssistantThought, AssistantAction, CodeFragment]
+        assert response.endswith("```\n<|im_end|>")
+
+    assert len(set(responses)) == len(responses)
+    assert LLM(FAST).generate(conversations[0], max_new_tokens=4000) == responses[0]
+    # Same output, streamed.
+    deltas = list(llm.generate_stream(conversations[0], max_new_tokens=4000))
+    assert "".join(d.text for d in deltas) == responses[0]
+
+
+def test_lengths():
+    short = LLM(FAST + "&length=50&length_sigma=0").generate(_conversation("Hi"), 4000)
+    long = LLM(FAST + "&length=500&length_sigma=0").generate(_conversation("Hi"), 4000)
+    assert 3 * len(short) < len(long)
+
+
+def test_timing():
+    llm = LLM("fake://?tps=200&prefill_ms=100&length=20&length_sigma=0")
+    start = time.perf_counter()
+    llm.generate(_conversation("Hi"), max_new_tokens=4000)
+    elapsed = time.perf_counter() - start
+    # One forward pass per sampled token, jump-forward aside.
+    assert elapsed > 0.1 + 20 / 200
+
+
+def test_replay(tmp_path):
+    (tmp_path / "session.xml").write_text(SESSION)
+    llm = LLM(FAST + f"&sessions={tmp_path}/*.xml")
+    assert len(llm.backend.replay) == 1
+
+    # Replay keys on the exact conversation, as flattened by `session_to_chatml`.
+    conversation = session_to_chatml(session_from_file(tmp_path / "session.xml"))
+    response = llm.generate(conversation[:2], max_new_tokens=4000)
+    thought, action, code = _parse(response)
+    assert thought.text == "Let me count them."
+    assert action.text == "Count files"
+    assert code.code.strip() == "import os\nprint(len(os.listdir('.')))"
+
+    # Another conversation: one of the replayed responses all the same.
+    assert llm.generate(_conversation("Other?"), max_new_tokens=4000) == response
+
+
+def test_samples():
+    llm = LLM(FAST)
+    prompt = llm.prompt_tokens(_conversation("Hi"))
+    batch = llm.batch_decoder()
+    rows = batch.add_samples(prompt, 4000, 3)
+    while batch.rows:
+        batch.step()
+    responses = [llm.tokenizer.decode(row.generated) for row in rows]
+    # The first is the usual response; the others, alternatives.
+    assert responses[0] == llm.generate(_conversation("Hi"), max_new_tokens=4000)
+    assert len(set(responses)) == 3
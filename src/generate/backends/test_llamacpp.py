@@ -0,0 +1,73 @@
+import os
+
+import numpy as np
+import pytest
+
+from src.postproc import parse_constrained_message
+from ..constrain import StructuredEnforcer
+from ..decode import Sampler, decode_batch
+from .llamacpp import LlamaCppDecoder
+
+SCRIPT = "<thought>Hi!</thought>\n<action>Nothing</action>\n```python\n1\n```"
+
+
+class ContextLM:
+    """
+    Stand-in for `llama_cpp.Llama`, on top of a `ScriptedLM`: a single-sequence context,
+    with what `LlamaCppDecoder` uses of it.
+    """
+
+    def __init__(self, lm, n_ctx: int = 512):
+        self.lm = lm
+        self.input_ids = np.zeros(n_ctx, dtype=np.intc)
+        self.scores = np.zeros((n_ctx, len(lm.tokenizer)), dtype=np.single)
+        self.n_tokens = 0
+        self.n_evaluated = 0
+
+    def eval(self, tokens):
+        for token in tokens:
+            self.input_ids[self.n_tokens] = token
+            self.n_tokens += 1
+            context = self.input_ids[: self.n_tokens].tolist()
+            self.scores[self.n_tokens - 1] = 0
+            self.scores[self.n_tokens - 1, self.lm.next_token(context)] = 10
+        self.n_evaluated += len(tokens)
+
+
+def test_decoder(tiny_tokenizer, scripted_lm):
+    llama = ContextLM(scripted_lm(SCRIPT))
+    prompt = tiny_tokenizer.apply_chat_template(
+        [{"role": "user", "content": "Hi"}], add_generation_prompt=True
+    )
+    for turn in range(2):
+        batch = LlamaCppDecoder(
+            llama,
+            StructuredEnforcer(tiny_tokenizer),
+            Sampler(),
+            stop_token_ids={tiny_tokenizer.eos_token_id},
+            pad_token_id=tiny_tokenizer.pad_token_id,
+        )
+        (output,) = decode_batch(batch, [prompt], 100)
+        assert tiny_tokenizer.decode(output) == SCRIPT + "\n<|im_end|>"
+        if turn:
+            # Same prompt, and forced tokens after it: only the last one is evaluated again.
+            assert batch.stats.n_reused >= len(prompt) - 1
+            assert batch.stats.n_prefilled == 1
+
+
+# A real model, e.g. from `save_pretrained_gguf`, with its tokenizer next to it.
+GGUF = os.environ.get("KYZEL_TEST_GGUF")
+
+
+@pytest.mark.skipif(not GGUF, reason="KYZEL_TEST_GGUF: no GGUF model to test with")
+def test_smoke():
+    pytest.importorskip("llama_cpp")
+    from ..llm import LLM
+
+    llm = LLM(GGUF, max_seq_length=4096)
+    conversation = [
+        {"role": "system", "content": "You are an IPython REPL assistant."},
+        {"role": "user", "content": "Print the first 5 squares."},
+    ]
+    response = llm.generate(conversation, max_new_tokens=256)
+    parse_constrained_message(response.split("<|im_end|>")[0])
@@ -0,0 +1,68 @@
+import os
+
+import pytest
+import torch
+
+from ..decode import DecodeStats, Sampler, decode_batch
+from ..kv import KVPool
+from ..speculate import PromptLookup
+
+# A model Unsloth can load, e.g. `unsloth/Phi-4` or `run/phi4/lora`, and its chat template.
+MODEL = os.environ.get("KYZEL_TEST_UNSLOTH_MODEL")
+CHAT_TEMPLATE = os.environ.get("KYZEL_TEST_CHAT_TEMPLATE", "phi-4")
+
+MAX_NEW_TOKENS = 48
+
+
+@pytest.mark.skipif(not MODEL, reason="KYZEL_TEST_UNSLOTH_MODEL: no model to test with")
+def test_same_as_generate():
+    """
+    Greedy, the decoding loop gives what `model.generate` gives, on Unsloth's fast inference
+    path: it has its own KV buffers and attention masks. Tested elsewhere on a plain
+    transformers model only; here, with what the loop does differently from `generate`:
+    rows of different lengths, padded, with explicit position IDs; several tokens per forward
+    pass; caches reused from a previous sequence.
+    """
+    pytest.importorskip("unsloth")
+    if not torch.cuda.is_available():
+        pytest.skip("Unsloth needs CUDA")
+    from ..llm import LLM
+
+    llm = LLM(MODEL, CHAT_TEMPLATE, max_seq_length=4096)
+    model = llm.backend.model
+    prompts = [
+        llm.prompt_tokens([{"role": "user", "content": question}])
+        for question in [
+            "Count from 1 to 20, one number per line.",
+            "Write a Python function that tells whether a number is prime, and explain it.",
+        ]
+    ]
+    expected = [
+        model.generate(
+            torch.tensor([prompt], device=model.device),
+            max_new_tokens=MAX_NEW_TOKENS,
+            do_sample=False,
+            repetition_penalty=1.0,
+            pad_token_id=llm._pad_token_id(),
+        )[0, len(prompt) :].tolist()
+        for prompt in prompts
+    ]
+
+    def decode(prompts, **kwargs):
+        # No constraint: `generate` has none.
+        batch = llm.backend.new_decoder(
+            None,
+            Sampler(),
+            stop_token_ids=llm._stop_token_ids(),
+            pad_token_id=llm._pad_token_id(),
+            **kwargs,
+        )
+        return decode_batch(batch, prompts, MAX_NEW_TOKENS)
+
+    assert decode(prompts[:1]) == expected[:1]
+    assert decode(prompts) == expected
+    assert decode(prompts, drafter=PromptLookup(min_ngram=1)) == expected
+    pool, stats = KVPool(), DecodeStats()
+    decode(prompts, kv_pool=pool)
+    assert decode(prompts, kv_pool=pool, stats=stats) == expected
+    assert stats.n_reused > 0
@@ -0,0 +1,31 @@
+"""
+Transformers models, loaded in 4-bit and patched for fast inference by Unsloth. CUDA only.
+"""
+
+from unsloth import FastLanguageModel
+from unsloth.chat_templates import get_chat_template
+
+from ..decode import BatchDecoder
+from ..lora import Adapters
+from . import Backend
+
+
+class UnslothBackend(Backend):
+    def __init__(self, model_name: str, chat_template: str, max_seq_length: int):
+        model, tokenizer = FastLanguageModel.from_pretrained(
+            model_name=model_name,
+            max_seq_length=max_seq_length,
+            load_in_4bit=True,
+        )
+        self.tokenizer = get_chat_template(
+            tokenizer, chat_template
+        ) # CAREFUL wrt mistmatches...
+        FastLanguageModel.for_inference(model)
+        self.model = model
+        self.generation_config = model.generation_config
+        self.device = model.device
+        # More LoRA adapters on top of this model, once registered: see `src.generate.lora`.
+        self.adapters = Adapters(model)
+
+    def new_decoder(self, *args, **kwargs) -> BatchDecoder:
+        return BatchDecoder(self.model, *args, adapters=self.adapters, **kwargs)
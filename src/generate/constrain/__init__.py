@@ -1,25 +1,22 @@
-from enum import Enum, auto
 from transformers import LogitsProcessor
+import torch
 from torch import Tensor, FloatTensor
+import copy
 import logging
 from typing import List, Tuple, Optional
 
-from .logit_utils import force_token
+from src.postproc.fence import CodeBlockScanner, code_start
+from .logit_utils import force_tokens
+from .detok import IncrementalDetokenizer
+from .state import State
+from .masks import load_state_masks
 
 logger = logging.getLogger(__name__)
 
-# Verbatim start of a code block. This is a constant.
-code_start = "```python\n"
-
-
-class State(Enum):
-    START = auto()
-    THOUGHT_CONTENT = auto()
-    ACTION_OPEN = auto()
-    ACTION_CONTENT = auto()
-    CODE_FENCE_START = auto()
-    CODE_CONTENT = auto()
-    DONE = auto()
+# Closing tags we look for in the generated text.
+# When checking for them, we only look at new text, plus this many characters
+# before it, in case a tag is split across steps.
+_TAG_LOOKBEHIND = max(len("</thought>"), len("</action>")) - 1
 
 
 def get_code_block_status(text: str) -> Tuple[bool, bool]:
@@ -51,9 +48,14 @@ def get_code_block_status(text: str) -> Tuple[bool, bool]:
     return True, False
 
 
-def get_next_state(state: State, text: str) -> Tuple[State, Optional[str]]:
+def get_next_state(
+    state: State, text: str, code_block: Optional[CodeBlockScanner] = None
+) -> Tuple[State, Optional[str]]:
     """
     Returns (new_state, forced_sequence)
+
+    If `code_block` is given, `text` is only what was generated since the previous call:
+    the scanner keeps track of the rest.
     """
     match state:
         case State.START:
@@ -72,32 +74,78 @@ def get_next_state(state: State, text: str) -> Tuple[State, Optional[str]]:
             return State.CODE_CONTENT, None
 
         case State.CODE_CONTENT:
-            has_content, should_end = get_code_block_status(text)
+            if code_block is not None:
+                has_content, should_end = code_block.feed(text)
+            else:
+                has_content, should_end = get_code_block_status(text)
             if has_content and should_end:
                 return State.DONE, "\n"
 
     return state, None
 
 
-class StructuredEnforcer(LogitsProcessor):
-    def __init__(self, tokenizer):
-        assert hasattr(tokenizer, "eos_token_id") and tokenizer.eos_token_id is not None
+class RowConstraint:
+    """
+    The state machine for a single sequence of the batch.
+    """
 
+    def __init__(self, tokenizer):
         self.tokenizer = tokenizer
-        self.eos_token_id = tokenizer.eos_token_id
 
         # State of our state machine.
         self.state = State.START
 
-        # The position, as a token index, of the first token generated after this instance was created.
-        self.start_pos = None
-
         # If any, pending tokens whose generation we want to force.
         self._tokens_to_force = []
 
+        # Running text of the response, updated one token at a time.
+        # Re-decoding the whole response at every step would be quadratic.
+        self._detok = IncrementalDetokenizer(tokenizer)
+
+        # Character offsets into the response text:
+        # - where the current state was entered;
+        # - up to where `get_next_state` has already looked, in the current state;
+        # - where the code fence was requested (`State.CODE_FENCE_START`).
+        self._state_pos = 0
+        self._checked_pos = 0
+        self._fence_pos = 0
+
+        # Looks for the end of the code block, one text delta at a time.
+        self._code_block = CodeBlockScanner()
+
         # For debugging / the future.
         self._token_history: List[Tuple[int, str]] = []  # [(id, text)]
 
+    @property
+    def text(self) -> str:
+        """All text generated so far. O(n), don't call this at every step."""
+        return self._detok.text
+
+    @property
+    def n_tokens(self) -> int:
+        """Number of tokens generated so far."""
+        return self._detok.n_tokens
+
+    def fork(self) -> "RowConstraint":
+        """
+        An independent copy, to try tokens out without committing to them.
+
+        Done at every step of speculative decoding: it has to cost the same whatever the length
+        of the response. Only the end of the text comes along, from as far back as the state
+        machine may still look. The token history starts over.
+        """
+        fork = copy.copy(self)
+        fork._detok = self._detok.fork(self._look_from())
+        fork._tokens_to_force = list(self._tokens_to_force)
+        fork._code_block = copy.copy(self._code_block)
+        fork._token_history = []
+        return fork
+
+    def push(self, new_token: int):
+        """Take a newly generated token into account."""
+        self._log_new_token(new_token)
+        self._detok.push(new_token)
+
     def _pop_forced(self) -> Optional[int]:
         """
         Utility function to pop the next token to force, if any.
@@ -106,7 +154,138 @@ class StructuredEnforcer(LogitsProcessor):
             return None
         return self._tokens_to_force.pop(0)
 
-    def __call__(self, input_ids: Tensor, scores: FloatTensor) -> FloatTensor:
+    def _unchecked_text(self) -> str:
+        """
+        The part of the response text that `get_next_state` hasn't seen yet in the current state.
+        """
+        return self._detok.text_from(self._look_from())
+
+    def _look_from(self) -> int:
+        """Where `_unchecked_text` starts, in the current state."""
+        if self.state == State.CODE_CONTENT:
+            # The scanner remembers everything else.
+            return self._checked_pos
+
+        # Looking for a closing tag: include enough of the already-seen text to catch one split across steps.
+        return max(self._state_pos, self._checked_pos - _TAG_LOOKBEHIND)
+
+    def _transition(self):
+        """
+        Given the current state and the text generated so far, what should we do next?
+        Runs the state machine until it settles, or until it wants to force a sequence.
+        """
+        while not self._tokens_to_force:
+            new_state, string_to_force = get_next_state(
+                self.state, self._unchecked_text(), self._code_block
+            )
+            self._checked_pos = len(self._detok)
+            if new_state == self.state:
+                return
+
+            logger.debug(f"State transition: {self.state} -> {new_state}")
+            self.state = new_state
+            self._state_pos = self._checked_pos = len(self._detok)
+            if new_state == State.CODE_FENCE_START:
+                self._fence_pos = self._state_pos
+            if new_state == State.CODE_CONTENT:
+                # The scanner needs to see the opening fence.
+                self._checked_pos = self._fence_pos
+
+            if string_to_force:
+                # Can't encode nothing.
+                self._tokens_to_force = self.tokenizer.encode(
+                    string_to_force, add_special_tokens=False
+                )
+
+    def next_forced(self) -> Optional[int]:
+        """
+        The next token to force, if any, after updating the state machine if needed.
+        """
+        if not self._tokens_to_force:
+            self._transition()
+        return self._pop_forced()
+
+    def _log_new_token(self, new_token: int):
+        """
+        Just there for debugging.
+        """
+        token_text = self.tokenizer.decode([new_token])
+        self._token_history.append((new_token, token_text))
+        logger.debug(f"Token {len(self._token_history)}: {new_token} -> {token_text!r}")
+
+
+class StructuredEnforcer(LogitsProcessor):
+    """
+    Enforces the response structure, for each sequence of the batch independently.
+
+    Can be used as a regular `LogitsProcessor`, or driven explicitly (see `feed`, `process`
+    and `take_forced`) by a decoding loop that doesn't keep all sequences the same length.
+    """
+
+    def __init__(self, tokenizer, masks: Optional[Tensor] = None):
+        """
+        `masks`, if given, are per-state vocabulary masks, from `load_state_masks(tokenizer)`.
+        Without them, only EOS is masked.
+        """
+        assert hasattr(tokenizer, "eos_token_id") and tokenizer.eos_token_id is not None
+
+        self.tokenizer = tokenizer
+        self.eos_token_id = tokenizer.eos_token_id
+
+        # Banned tokens for each state, once adapted to the shape and device of the scores.
+        self._masks = masks
+        self._banned: Optional[Tensor] = None
+
+        # One state machine per sequence, created upon seeing the batch size.
+        self.rows: List[RowConstraint] = []
+
+        # The position, as a token index, of the first token generated after this instance was created.
+        # Only used as a `LogitsProcessor`.
+        self.start_pos = None
+
+    def start(self, batch_size: int):
+        """
+        Set up one state machine per sequence.
+        Done implicitly on the first call, when used as a `LogitsProcessor`.
+        """
+        if not self.rows:
+            self.rows = [RowConstraint(self.tokenizer) for _ in range(batch_size)]
+        assert len(self.rows) == batch_size, "Batch size changed during generation"
+
+    def add_row(self) -> RowConstraint:
+        """A new sequence joins the batch, as the last row."""
+        self.rows.append(RowConstraint(self.tokenizer))
+        return self.rows[-1]
+
+    def select_rows(self, indices: List[int]):
+        """Keep these rows only, in this order: the others left the batch."""
+        self.rows = [self.rows[i] for i in indices]
+
+    @property
+    def state(self) -> State:
+        """State of the first (usually, only) sequence."""
+        return self.rows[0].state if self.rows else State.START
+
+    @property
+    def states(self) -> List[State]:
+        return [row.state for row in self.rows]
+
+    @property
+    def text(self) -> str:
+        """All text generated so far for the first (usually, only) sequence."""
+        return self.rows[0].text if self.rows else ""
+
+    def feed(self, row: int, tokens: List[int]):
+        """Take into account newly generated tokens for sequence `row`."""
+        for token in tokens:
+            self.rows[row].push(token)
+
+    def _consume(self, input_ids: Tensor):
+        """
+        Take into account the tokens generated since the previous call.
+        """
+        self.start(input_ids.shape[0])
+
         # Initialize start position if needed
         # A given instance will be called many times, with growing `input_ids`.
         # The very first `input_ids` give us the true starting point.
@@ -114,22 +293,26 @@ class StructuredEnforcer(LogitsProcessor):
             self.start_pos = input_ids.shape[1]
             logger.debug(f"Generation starts at position {self.start_pos}")
 
-        # By default, EOS is forbidden.
-        scores[0, self.eos_token_id] = float("-inf")
+        # Usually exactly one token, none on the first call.
+        # Only those are decoded; the detokenizer keeps track of the rest.
+        for i, row in enumerate(self.rows):
+            self.feed(i, input_ids[i, self.start_pos + row.n_tokens :].tolist())
+
+    def __call__(self, input_ids: Tensor, scores: FloatTensor) -> FloatTensor:
+        self._consume(input_ids)
+        return self.process(scores)
 
-        # All tokens generated since the first __call__
-        # This will be empty in the first __call__!... Handle that.
-        if generated_tokens := input_ids[0, self.start_pos :].tolist():
-            # For debugging.
-            new_token = generated_tokens[-1]
-            assert new_token is not None
-            self._log_new_token(new_token)
+    def process(self, scores: FloatTensor, rows: Optional[List[int]] = None) -> FloatTensor:
+        """
+        Constrain `scores` (shape `(batch, vocab)`), given all tokens fed so far.
 
-            # All text generated by the assistant so far.
-            generated_text = self.tokenizer.decode(generated_tokens)
-        else:
-            # First __call__.
-            generated_text = ""
+        `rows` tells which sequence each row of `scores` is for, when not all of them
+        are there, in order (e.g. when verifying speculative tokens of some sequences only).
+        """
+        if rows is None:
+            self.start(scores.shape[0])
+            rows = range(len(self.rows))
+        constraints = [self.rows[i] for i in rows]
 
         # If we have a "forced sequence", we're completely overriding the model's behavior temporarily.
         # This is a "whitelist" rather than a "blacklist" approach.
@@ -138,37 +321,67 @@ class StructuredEnforcer(LogitsProcessor):
         # artificially insert tokens that we know should be there.
         # We do this, as usual, through the logits.
         #
-        # We'll hit this branch in multiple __call__s, as we force one token at a time,
+        # We'll hit this branch in multiple calls, as we force one token at a time,
         # until the sequence is exhausted.
-        if next_forced_token := self._pop_forced():
-            return force_token(scores, next_forced_token)
+        # `take_forced` offers a faster alternative.
+        forced_rows, forced_tokens = [], []
+        for i, row in enumerate(constraints):
+            token = row.next_forced()
+            # Force EOS if done: fully deterministic.
+            # Note that if this were checked before forced sequences, we'd get an extra token...
+            if token is None and row.state == State.DONE:
+                token = self.eos_token_id
+            if token is not None:
+                forced_rows.append(i)
+                forced_tokens.append(token)
+
+        if (banned := self._banned_for(scores)) is not None:
+            state_indices = torch.tensor(
+                [row.state.value - 1 for row in constraints], device=scores.device
+            )
+            scores.masked_fill_(banned[state_indices], float("-inf"))
+        else:
+            # By default, EOS is forbidden.
+            scores[:, self.eos_token_id] = float("-inf")
 
-        # Given the current state and the text generated so far, what should we do next?
-        new_state, string_to_force = get_next_state(self.state, generated_text)
-        if new_state != self.state:
-            logger.debug(f"State transition: {self.state} -> {new_state}")
-            self.state = new_state
+        if forced_rows:
+            force_tokens(scores, forced_rows, forced_tokens)
 
-            if string_to_force:
-                # Can't encode nothing.
-                self._tokens_to_force = self.tokenizer.encode(
-                    string_to_force, add_special_tokens=False
-                )
+        return scores
 
-            # Reevaluate our logit forcing in light of the new state.
-            return self.__call__(input_ids, scores)
+    def _banned_for(self, scores: FloatTensor) -> Optional[Tensor]:
+        """
+        Per-state banned tokens, matching `scores` in width and device.
+        """
+        if self._masks is None:
+            return None
 
-        # Force EOS if done: fully deterministic.
-        # Note that if this were at the beginning of the function, we'd get an extra token...
-        if self.state == State.DONE:
-            return force_token(scores, self.eos_token_id)
+        if self._banned is None or self._banned.shape[1] != scores.shape[-1]:
+            banned = ~self._masks[:, : scores.shape[-1]]
+            # The model may have more logits than the tokenizer has tokens: those aren't real tokens.
+            if (n_missing := scores.shape[-1] - banned.shape[1]) > 0:
+                padding = torch.ones((banned.shape[0], n_missing), dtype=torch.bool)
+                banned = torch.cat([banned, padding.to(banned.device)], dim=1)
+            self._banned = banned.to(scores.device)
 
-        return scores
+        return self._banned
 
-    def _log_new_token(self, new_token: int):
+    def take_forced(self, row: int = 0) -> List[int]:
         """
-        Just there for debugging.
+        Jump-forward: all the tokens that must come next in sequence `row`, whatever the model says.
+
+        That is, the rest of any forced sequence, what it leads to, and EOS once done.
+        They are fed to the state machine right away. The caller must append them to the
+        sequence as if they had been generated, which can be done with a single forward
+        pass instead of one per token.
         """
-        token_text = self.tokenizer.decode([new_token])
-        self._token_history.append((new_token, token_text))
-        logger.debug(f"Token {len(self._token_history)}: {new_token} -> {token_text!r}")
+        constraint = self.rows[row]
+        forced = []
+        while (token := constraint.next_forced()) is not None:
+            forced.append(token)
+            constraint.push(token)
+
+        if constraint.state == State.DONE:
+            forced.append(self.eos_token_id)
+
+        return forced
@@ -0,0 +1,112 @@
+"""
+Incremental detokenization: token IDs in, text deltas out, at constant cost per token.
+
+Decoding tokens one at a time and concatenating the results is *wrong*: a single
+character may be split across several byte-level tokens (each decoding to U+FFFD on
+its own), and some tokenizers decode a token differently depending on what precedes
+it (e.g. SentencePiece's leading-space handling).
+
+Re-decoding the whole sequence at every step is correct, but quadratic overall.
+
+Instead, we keep two offsets into the token list, as done by most inference servers:
+- `prefix_offset`: start of a small window of already-emitted tokens, decoded only to
+  provide left context;
+- `read_offset`: end of the already-emitted tokens.
+
+At each step, we decode `tokens[prefix_offset:]` and `tokens[prefix_offset:read_offset]`:
+whatever the former adds on top of the latter is new text. If it ends with an incomplete
+character, we hold it back until more tokens arrive.
+"""
+
+from typing import List
+
+# Emitted by the tokenizer's decoder for incomplete byte sequences.
+REPLACEMENT_CHAR = "\ufffd"
+
+
+class IncrementalDetokenizer:
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+
+        # All tokens pushed so far; in a fork, only those from `_n_dropped` on.
+        self.token_ids: List[int] = []
+        self._n_dropped = 0
+
+        # See module docstring.
+        self._prefix_offset = 0
+        self._read_offset = 0
+
+        # Emitted text, as a list of deltas.
+        # Joining is deferred: appending to a single growing string would copy it every step.
+        self._chunks: List[str] = []
+        self._len = 0
+
+    def push(self, token_id: int) -> str:
+        """
+        Feed one token. Returns the newly-decodable text, possibly empty.
+        """
+        self.token_ids.append(token_id)
+
+        prefix_text = self.tokenizer.decode(
+            self.token_ids[self._prefix_offset : self._read_offset]
+        )
+        new_text = self.tokenizer.decode(self.token_ids[self._prefix_offset :])
+
+        # Incomplete multi-byte character: wait for the next token(s).
+        if len(new_text) <= len(prefix_text) or new_text.endswith(REPLACEMENT_CHAR):
+            return ""
+
+        delta = new_text[len(prefix_text) :]
+        self._prefix_offset = self._read_offset
+        self._read_offset = len(self.token_ids)
+
+        self._chunks.append(delta)
+        self._len += len(delta)
+        return delta
+
+    def fork(self, keep_from: int) -> "IncrementalDetokenizer":
+        """
+        An independent copy, for the text from character `keep_from` on: `text_from` doesn't
+        go back any further, and `text` is only that part. It costs as much as what's kept, and
+        the few tokens still needed as context, rather than as much as everything so far.
+        """
+        fork = IncrementalDetokenizer(self.tokenizer)
+        fork.token_ids = self.token_ids[self._prefix_offset :]
+        fork._n_dropped = self._n_dropped + self._prefix_offset
+        fork._read_offset = self._read_offset - self._prefix_offset
+        kept = self.text_from(keep_from)
+        fork._chunks = [kept] if kept else []
+        fork._len = self._len
+        return fork
+
+    @property
+    def n_tokens(self) -> int:
+        """Number of tokens pushed so far."""
+        return self._n_dropped + len(self.token_ids)
+
+    def __len__(self) -> int:
+        """Length of the text emitted so far, in characters."""
+        return self._len
+
+    @property
+    def text(self) -> str:
+        """All text emitted so far. O(n): avoid calling this at every step."""
+        if len(self._chunks) > 1:
+            self._chunks = ["".join(self._chunks)]
+        return self._chunks[0] if self._chunks else ""
+
+    def text_from(self, pos: int) -> str:
+        """
+        Text emitted so far, starting at character `pos`.
+        Only walks the chunks that overlap with the requested range.
+        """
+        pos = max(pos, 0)
+        parts = []
+        end = self._len
+        for chunk in reversed(self._chunks):
+            if end <= pos:
+                break
+            start = end - len(chunk)
+            parts.append(chunk[max(pos - start, 0) :])
+            end = start
+        return "".join(reversed(parts))
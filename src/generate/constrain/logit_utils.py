@@ -1,10 +1,13 @@
+from typing import List
+
 from torch import FloatTensor
 
 
-def force_token(scores: FloatTensor, token_id: int) -> FloatTensor:
+def force_tokens(scores: FloatTensor, rows: List[int], token_ids: List[int]) -> FloatTensor:
     """
-    Enforce generation of `token_id`: set its score to 0 and all others to -inf.
+    Enforce generation of `token_ids[i]` in row `rows[i]`: set its score to 0 and all others to -inf.
+    Other rows are left untouched.
     """
-    scores.fill_(float("-inf"))
-    scores[0, token_id] = 0
+    scores[rows] = float("-inf")
+    scores[rows, token_ids] = 0
     return scores
@@ -0,0 +1,119 @@
+"""
+Per-state vocabulary masks: which tokens may be sampled in each `State`.
+
+Forcing handles what *must* come next. Masks handle what must *not*: EOS before we're done,
+chat-template special tokens in the middle of a response, or a token that would open a
+second `<thought>`. Applying them costs a single tensor operation per step.
+
+Building them means decoding the whole vocabulary, which takes a while for large vocabularies.
+We do it once per tokenizer, and cache the result on disk.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import torch
+from torch import Tensor
+
+from .state import State
+
+log = logging.getLogger(__name__)
+
+# Tokens containing any of these can't be sampled in the given state.
+# A tag can still be produced piecewise: this only catches tokens that contain it whole.
+BANNED_SUBSTRINGS: Dict[State, List[str]] = {
+    State.START: [],
+    State.THOUGHT_CONTENT: ["<thought>", "<action>"],
+    State.ACTION_OPEN: ["<thought>", "</thought>", "<action>"],
+    State.ACTION_CONTENT: ["<thought>", "</thought>", "<action>"],
+    State.CODE_FENCE_START: [],
+    State.CODE_CONTENT: [],
+    State.DONE: [],
+}
+
+
+def default_cache_dir() -> Path:
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "kyzel" / "state_masks"
+
+
+def tokenizer_hash(tokenizer) -> str:
+    """
+    Identifies a tokenizer and the masking rules, for caching purposes.
+    Two tokenizers with the same vocabulary and special tokens yield the same masks.
+    """
+    h = hashlib.sha256()
+    h.update(type(tokenizer).__name__.encode())
+    h.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode())
+    h.update(json.dumps([tokenizer.eos_token_id, *_special_ids(tokenizer)]).encode())
+    h.update(json.dumps({s.name: v for s, v in BANNED_SUBSTRINGS.items()}).encode())
+    return h.hexdigest()[:32]
+
+
+def _special_ids(tokenizer) -> List[int]:
+    """Special tokens: those of the chat template, padding, etc."""
+    ids = set(tokenizer.all_special_ids)
+    ids.update(i for i, t in tokenizer.added_tokens_decoder.items() if t.special)
+    return sorted(ids)
+
+
+def compile_state_masks(tokenizer) -> Tensor:
+    """
+    Walk the vocabulary once.
+    Returns a `(len(State), len(tokenizer))` boolean tensor: `True` where a token is allowed.
+    Row `i` is for the state whose `value` is `i + 1`.
+    """
+    vocab_size = len(tokenizer)
+    texts = tokenizer.batch_decode([[i] for i in range(vocab_size)])
+
+    masks = torch.ones((len(State), vocab_size), dtype=torch.bool)
+    special_ids = torch.tensor(_special_ids(tokenizer), dtype=torch.long)
+    for state in State:
+        row = masks[state.value - 1]
+        if state == State.DONE:
+            # Nothing but EOS.
+            row.fill_(False)
+            row[tokenizer.eos_token_id] = True
+            continue
+
+        row[special_ids] = False
+        row[tokenizer.eos_token_id] = False
+        if banned := BANNED_SUBSTRINGS[state]:
+            row[[i for i, t in enumerate(texts) if any(b in t for b in banned)]] = False
+
+    return masks
+
+
+def load_state_masks(tokenizer, cache_dir: Optional[Path] = None) -> Tensor:
+    """
+    `compile_state_masks`, cached on disk.
+    """
+    cache_dir = Path(cache_dir) if cache_dir is not None else default_cache_dir()
+    path = cache_dir / f"{tokenizer_hash(tokenizer)}.pt"
+
+    if path.exists():
+        try:
+            masks = torch.load(path, weights_only=True)
+            if masks.shape == (len(State), len(tokenizer)):
+                log.debug(f"Loaded state masks from {path}")
+                return masks
+        except Exception as e:
+            log.warning(f"Ignoring unreadable state mask cache {path}: {e}")
+
+    log.info("Compiling state masks over the vocabulary...")
+    masks = compile_state_masks(tokenizer)
+
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        torch.save(masks, tmp_path)
+        tmp_path.replace(path)
+        log.info(f"Saved state masks to {path}")
+    except OSError as e:
+        log.warning(f"Could not cache state masks to {path}: {e}")
+
+    return masks
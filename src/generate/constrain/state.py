@@ -0,0 +1,11 @@
+from enum import Enum, auto
+
+
+class State(Enum):
+    START = auto()
+    THOUGHT_CONTENT = auto()
+    ACTION_OPEN = auto()
+    ACTION_CONTENT = auto()
+    CODE_FENCE_START = auto()
+    CODE_CONTENT = auto()
+    DONE = auto()
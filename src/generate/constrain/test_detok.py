@@ -0,0 +1,41 @@
+from .detok import IncrementalDetokenizer
+
+
+def test_matches_full_decode(tiny_tokenizer):
+    text = "<thought>héllo 日本語 🎉🎉 wörld</thought>\n```python\nprint('é')\n```\n"
+    token_ids = tiny_tokenizer.encode(text, add_special_tokens=False)
+
+    detok = IncrementalDetokenizer(tiny_tokenizer)
+    deltas = [detok.push(t) for t in token_ids]
+
+    assert "".join(deltas) == text
+    assert detok.text == text
+    assert len(detok) == len(text)
+    # Never emits partial characters.
+    assert not any("�" in d for d in deltas)
+
+
+def test_text_from(tiny_tokenizer):
+    text = "abc 日本語 def " * 10
+    detok = IncrementalDetokenizer(tiny_tokenizer)
+    for t in tiny_tokenizer.encode(text, add_special_tokens=False):
+        detok.push(t)
+
+    for pos in [0, 1, 5, len(text) - 3, len(text), len(text) + 5]:
+        assert detok.text_from(pos) == text[pos:]
+
+
+def test_fork(tiny_tokenizer):
+    text = "<thought>héllo 日本語 🎉🎉 wörld</thought>\n```python\nprint('é')\n```\n"
+    token_ids = tiny_tokenizer.encode(text, add_special_tokens=False)
+    for i in range(len(token_ids)):
+        detok = IncrementalDetokenizer(tiny_tokenizer)
+        for t in token_ids[:i]:
+            detok.push(t)
+        keep_from = max(0, len(detok) - 3)
+        fork = detok.fork(keep_from)
+        # Same deltas from there on, with only the end of the text.
+        assert [fork.push(t) for t in token_ids[i:]] == [detok.push(t) for t in token_ids[i:]]
+        assert fork.text_from(keep_from) == text[keep_from:]
+        assert len(fork) == len(text)
+        assert fork.n_tokens == len(token_ids)
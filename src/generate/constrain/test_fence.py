@@ -0,0 +1,45 @@
+import random
+
+import pytest
+
+from src.postproc.fence import CodeBlockScanner
+from . import get_code_block_status
+
+
+def _random_split(rng: random.Random, text: str) -> list[str]:
+    cuts = sorted(rng.sample(range(len(text) + 1), rng.randint(0, min(len(text), 8))))
+    bounds = [0, *cuts, len(text)]
+    return [text[a:b] for a, b in zip(bounds, bounds[1:])]
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_equivalent_to_get_code_block_status(seed, random_text):
+    """After every delta, the scanner agrees with the stateless function on the full text so far."""
+    rng = random.Random(seed)
+    for _ in range(500):
+        text = random_text(rng)
+        scanner = CodeBlockScanner()
+        seen = ""
+        for delta in _random_split(rng, text):
+            seen += delta
+            assert scanner.feed(delta) == get_code_block_status(seen), repr(seen)
+
+
+@pytest.mark.parametrize(
+    "text,expected",
+    [
+        ("", (False, False)),
+        ("```python\n", (True, False)),
+        ("```python\nprint(1)\n```", (True, True)),
+        ("```python\nprint(1)\n```  \n", (True, True)),
+        ("```python\n  \n```\n", (False, True)),
+        ("```python\nx\n ```\n", (True, False)),
+        ("```python\nx\n```py\n", (True, False)),
+    ],
+)
+def test_char_by_char(text, expected):
+    scanner = CodeBlockScanner()
+    status = (False, False)
+    for c in text:
+        status = scanner.feed(c)
+    assert status == expected == get_code_block_status(text)
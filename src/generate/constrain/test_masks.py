@@ -0,0 +1,58 @@
+import copy
+
+import torch
+
+from . import State, StructuredEnforcer
+from .masks import compile_state_masks, load_state_masks
+
+
+def _with_tag_tokens(tokenizer):
+    """Most real vocabularies have a few tokens containing whole tags."""
+    tokenizer = copy.deepcopy(tokenizer)
+    tokenizer.add_tokens(["<thought>", "<action>"])
+    return tokenizer
+
+
+def test_compile(tiny_tokenizer):
+    tokenizer = _with_tag_tokens(tiny_tokenizer)
+    masks = compile_state_masks(tokenizer)
+    eos = tokenizer.eos_token_id
+    im_start = tokenizer.convert_tokens_to_ids("<|im_start|>")
+    thought = tokenizer.convert_tokens_to_ids("<thought>")
+
+    assert masks.shape == (len(State), len(tokenizer))
+    for state in State:
+        row = masks[state.value - 1]
+        if state == State.DONE:
+            assert row.nonzero().flatten().tolist() == [eos]
+        else:
+            assert not row[eos] and not row[im_start]
+
+    assert not masks[State.THOUGHT_CONTENT.value - 1, thought]
+    assert masks[State.CODE_CONTENT.value - 1, thought]
+
+
+def test_disk_cache(tiny_tokenizer, tmp_path):
+    masks = load_state_masks(tiny_tokenizer, cache_dir=tmp_path)
+    assert len(list(tmp_path.glob("*.pt"))) == 1
+    assert torch.equal(load_state_masks(tiny_tokenizer, cache_dir=tmp_path), masks)
+
+    # Different vocabulary, different entry.
+    load_state_masks(_with_tag_tokens(tiny_tokenizer), cache_dir=tmp_path)
+    assert len(list(tmp_path.glob("*.pt"))) == 2
+
+
+def test_enforcer_applies_masks(tiny_tokenizer):
+    tokenizer = _with_tag_tokens(tiny_tokenizer)
+    enforcer = StructuredEnforcer(tokenizer, compile_state_masks(tokenizer))
+    enforcer.start(1)
+    forced = enforcer.take_forced()
+    assert tokenizer.decode(forced) == "<thought>"
+
+    # Logits may be wider than the vocabulary.
+    scores = enforcer.process(torch.zeros((1, len(tokenizer) + 8)))
+    assert enforcer.state == State.THOUGHT_CONTENT
+    assert scores[0, tokenizer.convert_tokens_to_ids("<thought>")] == float("-inf")
+    assert scores[0, tokenizer.eos_token_id] == float("-inf")
+    assert (scores[0, len(tokenizer) :] == float("-inf")).all()
+    assert scores[0, tokenizer.encode("x", add_special_tokens=False)[0]] == 0
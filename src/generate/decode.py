@@ -0,0 +1,694 @@
+"""
+Our own decoding loop, in place of `model.generate`.
+
+It does the same thing, but gives us control over what goes into each forward pass.
+In particular, tokens that `StructuredEnforcer` would force one at a time (e.g. `\\n<action>`)
+are known in advance: with jump-forward, they are all appended at once, in a single
+prefill-style forward pass, and sampling resumes right after.
+"""
+
+import inspect
+import time
+from dataclasses import dataclass, field
+from typing import Iterator, List, Optional, Set, Tuple
+
+import torch
+from torch import Tensor
+
+from .constrain import RowConstraint, State, StructuredEnforcer
+from .kv import KVPool, concat_rows, row_past, select_rows
+from .lora import Adapters
+
+
+@dataclass
+class Sampler:
+    """
+    Turns next-token logits into next tokens, following the semantics of `model.generate`:
+    repetition penalty, then logits processors, then temperature, top-k, top-p.
+    """
+
+    do_sample: bool = False
+    temperature: float = 1.0
+    top_k: int = 0
+    top_p: float = 1.0
+    repetition_penalty: float = 1.0
+
+    @classmethod
+    def from_generation_config(cls, config, **overrides) -> "Sampler":
+        """Sampling parameters of a HF `GenerationConfig`, with `overrides` on top."""
+        params = dict(
+            do_sample=bool(config.do_sample),
+            temperature=config.temperature if config.temperature is not None else 1.0,
+            top_k=config.top_k or 0,
+            top_p=config.top_p if config.top_p is not None else 1.0,
+            repetition_penalty=config.repetition_penalty or 1.0,
+        )
+        params.update(overrides)
+        return cls(**params)
+
+    def penalize(self, seen: Tensor, scores: Tensor) -> Tensor:
+        """
+        Repetition penalty, applied before any other logits processor.
+        `seen` tells which tokens each sequence contains so far, prompt included:
+        a `(batch, vocab)` boolean mask, kept up to date by the caller.
+        """
+        if self.repetition_penalty == 1.0:
+            return scores
+        penalized = torch.where(
+            scores < 0,
+            scores * self.repetition_penalty,
+            scores / self.repetition_penalty,
+        )
+        return torch.where(seen, penalized, scores)
+
+    def __call__(self, scores: Tensor) -> Tensor:
+        """Pick the next token of each row: `(batch, vocab)` scores -> `(batch,)` token IDs."""
+        # Forced tokens: nothing to sample, and no randomness consumed.
+        # This keeps sampled outputs identical with and without jump-forward.
+        if not self.do_sample or (torch.isfinite(scores).sum(-1) == 1).all():
+            return scores.argmax(-1)
+
+        if self.temperature != 1.0:
+            scores = scores / self.temperature
+
+        if self.top_k > 0:
+            top_k = min(self.top_k, scores.shape[-1])
+            kth_best = torch.topk(scores, top_k)[0][..., -1, None]
+            scores = scores.masked_fill(scores < kth_best, float("-inf"))
+
+        if self.top_p < 1.0:
+            sorted_scores, sorted_indices = torch.sort(scores, descending=False)
+            cumulative_probs = sorted_scores.softmax(dim=-1).cumsum(dim=-1)
+            to_remove = cumulative_probs <= (1 - self.top_p)
+            # Always keep at least one token.
+            to_remove[..., -1:] = False
+            to_remove = to_remove.scatter(1, sorted_indices, to_remove)
+            scores = scores.masked_fill(to_remove, float("-inf"))
+
+        probs = scores.softmax(dim=-1)
+        return torch.multinomial(probs, num_samples=1).squeeze(1)
+
+
+@dataclass
+class DecodeStats:
+    """Where the work went, for a single `decode` call. Token counts are summed over sequences."""
+
+    n_prompt: int = 0
+    # Tokens prefilled: prompts, minus what was reused, plus what was forced right away.
+    n_prefilled: int = 0
+    n_generated: int = 0
+    # Calls to the model.
+    n_forward: int = 0
+    # Tokens appended through jump-forward, without being sampled.
+    n_jumped: int = 0
+    # Prompt tokens whose keys and values were reused rather than prefilled.
+    n_reused: int = 0
+    # Speculative decoding: tokens guessed, and how many of those the model agreed with.
+    n_drafted: int = 0
+    n_accepted: int = 0
+    # Calls to `BatchDecoder.step`.
+    n_steps: int = 0
+    # Time, in seconds: prefilling joining rows, decoding the others (drafting included),
+    # and in the constraint (masking logits, following tokens, jump-forward).
+    # Wall-clock time, but GPU time for prefill and decode on CUDA.
+    prefill_seconds: float = 0.0
+    decode_seconds: float = 0.0
+    constraint_seconds: float = 0.0
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.n_accepted / self.n_drafted if self.n_drafted else 0.0
+
+    @property
+    def tokens_per_forward(self) -> float:
+        return self.n_generated / self.n_forward if self.n_forward else 0.0
+
+
+def _forward(model, chunk: "_Chunk", past) -> Tuple[List[Tensor], object]:
+    """
+    One forward pass over a chunk of new tokens, on top of `past`.
+    Returns the logits at the requested positions of each row, and the updated cache.
+    """
+    out = model(
+        input_ids=chunk.input_ids,
+        attention_mask=chunk.attention_mask,
+        position_ids=chunk.position_ids,
+        past_key_values=past,
+        use_cache=True,
+        **chunk.model_kwargs,
+    )
+    # With `num_logits_to_keep`, logits only cover the end of the chunk.
+    offset = chunk.input_ids.shape[1] - out.logits.shape[1]
+    logits = [
+        out.logits[row, [i - offset for i in index]].float()
+        for row, index in enumerate(chunk.logit_index)
+    ]
+    return logits, out.past_key_values
+
+
+def _supports_logits_to_keep(model) -> bool:
+    # Avoids materializing full-vocabulary logits for every prompt position.
+    # As done by `model.generate`.
+    forward = getattr(model, "forward", None)
+    return forward is not None and "num_logits_to_keep" in inspect.signature(forward).parameters
+
+
+@dataclass
+class _Chunk:
+    """
+    The tokens to feed the model in one forward pass.
+
+    Rows may have different numbers of new tokens (e.g. one sampled token, plus a forced run).
+    They are right-padded to the same width, and the padding is masked out:
+    the KV cache ends up with holes, which the attention mask keeps track of.
+    """
+
+    input_ids: Tensor
+    # Covers the cache and the chunk.
+    attention_mask: Tensor
+    position_ids: Tensor
+    # Indices, within the chunk, of the positions whose logits we want, for each row.
+    # Usually only the last real token; also the guesses, with speculative decoding.
+    logit_index: List[List[int]]
+    model_kwargs: dict
+
+
+def _model_device(model) -> torch.device:
+    return getattr(model, "device", torch.device("cpu"))
+
+
+def decode(
+    model,
+    prompts: List[List[int]],
+    enforcer: Optional[StructuredEnforcer],
+    sampler: Sampler,
+    max_new_tokens: int,
+    stop_token_ids: Set[int],
+    pad_token_id: int,
+    jump_forward: bool = True,
+    stats: Optional[DecodeStats] = None,
+    kv_pool: Optional[KVPool] = None,
+    drafter=None,
+) -> List[List[int]]:
+    """
+    Generate up to `max_new_tokens` tokens after each prompt.
+    Returns the generated token IDs of each sequence, including the stop token if one was generated.
+
+    Sequences stop independently; a finished sequence no longer gets any tokens,
+    while the others go on.
+
+    With `kv_pool`, we skip prefilling whatever a prompt shares with a previous sequence;
+    the resulting caches go back into the pool.
+
+    With `drafter`, guessed tokens are checked in the same forward pass (speculative decoding).
+    """
+    batch = BatchDecoder(
+        model,
+        enforcer,
+        sampler,
+        stop_token_ids,
+        pad_token_id,
+        jump_forward,
+        stats,
+        kv_pool,
+        drafter,
+    )
+    return decode_batch(batch, prompts, max_new_tokens)
+
+
+def decode_stream(
+    model,
+    prompts: List[List[int]],
+    enforcer: Optional[StructuredEnforcer],
+    sampler: Sampler,
+    max_new_tokens: int,
+    stop_token_ids: Set[int],
+    pad_token_id: int,
+    jump_forward: bool = True,
+    stats: Optional[DecodeStats] = None,
+    kv_pool: Optional[KVPool] = None,
+    drafter=None,
+) -> Iterator[List[List[int]]]:
+    """
+    `decode`, step by step: yields the new tokens of each sequence as soon as they are known.
+
+    Tokens forced right at the start (e.g. `<thought>`) are yielded before the prefill even
+    begins; then come the tokens of each forward pass.
+    The consumer may stop iterating at any point (`close()`): generation stops there.
+    """
+    batch = BatchDecoder(
+        model,
+        enforcer,
+        sampler,
+        stop_token_ids,
+        pad_token_id,
+        jump_forward,
+        stats,
+        kv_pool,
+        drafter,
+    )
+    return stream_batch(batch, prompts, max_new_tokens)
+
+
+def decode_batch(
+    batch: "BatchDecoder", prompts: List[List[int]], max_new_tokens: int
+) -> List[List[int]]:
+    """`decode`, with a given decoding loop."""
+    generated: List[List[int]] = [[] for _ in prompts]
+    for new_tokens in stream_batch(batch, prompts, max_new_tokens):
+        for row, tokens in enumerate(new_tokens):
+            generated[row] += tokens
+    return generated
+
+
+def stream_batch(
+    batch: "BatchDecoder", prompts: List[List[int]], max_new_tokens: int
+) -> Iterator[List[List[int]]]:
+    """`decode_stream`, with a given decoding loop."""
+    rows = [batch.add(prompt, max_new_tokens) for prompt in prompts]
+    if any(row.generated for row in rows):
+        yield [list(row.generated) for row in rows]
+
+    try:
+        while batch.rows:
+            new_tokens = dict(batch.step())
+            yield [new_tokens.get(row, []) for row in rows]
+    except GeneratorExit:
+        # The consumer stopped early (e.g. the client went away): what's in the cache is still good.
+        batch.remove(batch.rows)
+
+
+@dataclass(eq=False)
+class DecodeRow:
+    """A sequence in a `BatchDecoder`."""
+
+    # Everything the model has seen or will see, prompt included.
+    sequence: List[int]
+    max_new_tokens: int
+    generated: List[int] = field(default_factory=list)
+    finished: bool = False
+    # State machine of the constraint, if any.
+    constraint: Optional[RowConstraint] = None
+    # Whether it has a place in the batch's KV cache yet.
+    prefilled: bool = False
+    # Number of tokens of `sequence` in the KV cache. The rest is yet to be fed.
+    n_fed: int = 0
+    # Speculative decoding: guessed tokens, and how many of those were right.
+    n_drafted: int = 0
+    n_accepted: int = 0
+    # Another sample for the same prompt: joins the batch with a copy of that row's prefill.
+    prefill_from: Optional["DecodeRow"] = None
+    # LoRA adapter, by name. `None` for the model as loaded.
+    adapter: Optional[str] = None
+    # Repetition penalty: which tokens `sequence` contains, as of its first `n_seen` tokens.
+    seen: Optional[Tensor] = None
+    n_seen: int = 0
+
+    @property
+    def state(self) -> Optional[State]:
+        return self.constraint.state if self.constraint is not None else None
+
+
+class BatchDecoder:
+    """
+    The decoding loop, one `step` at a time, over a batch whose composition may change
+    between steps: sequences join with `add`, and leave once finished (or `remove`d)
+    without waiting for the others. This is what continuous batching needs.
+
+    Joining sequences are prefilled on their own, then their KV cache is stacked with
+    the batch's. Caches of different lengths are left-padded, and rows are right-padded
+    within each chunk: the attention mask keeps track of the holes, positions are explicit.
+    """
+
+    def __init__(
+        self,
+        model,
+        enforcer: Optional[StructuredEnforcer],
+        sampler: Sampler,
+        stop_token_ids: Set[int],
+        pad_token_id: int,
+        jump_forward: bool = True,
+        stats: Optional[DecodeStats] = None,
+        kv_pool: Optional[KVPool] = None,
+        drafter=None,
+        adapters: Optional[Adapters] = None,
+    ):
+        """
+        `drafter`, if given, enables speculative decoding: see `src.generate.speculate`.
+        `adapters`, if given, lets rows use different LoRA adapters: see `src.generate.lora`.
+        """
+        self.model = model
+        self.enforcer = enforcer
+        self.sampler = sampler
+        self.stop_token_ids = stop_token_ids
+        self.pad_token_id = pad_token_id
+        self.jump_forward = jump_forward and enforcer is not None
+        self.stats = stats if stats is not None else DecodeStats()
+        self.kv_pool = kv_pool
+        self.drafter = drafter
+        self.adapters = adapters
+
+        self._device = _model_device(model)
+        self._logits_to_keep = _supports_logits_to_keep(model)
+        if enforcer is not None:
+            enforcer.start(0)
+
+        # Prefilled rows first, in the order of the KV cache, then those about to join.
+        # Enforcer rows are kept in the same order.
+        self.rows: List[DecodeRow] = []
+        # KV cache of the prefilled rows, and which of its positions are real.
+        self._past = None
+        self._mask: Optional[Tensor] = None
+        # Right padding of each prefilled row, in the latest forward pass.
+        self._chunk_padding: List[int] = []
+        # On CUDA: GPU timings not known yet, as (stat, start event, end event).
+        self._pending_times: List[Tuple[str, object, object]] = []
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    @torch.inference_mode()
+    def add(
+        self, prompt: List[int], max_new_tokens: int, adapter: Optional[str] = None
+    ) -> DecodeRow:
+        """
+        Queue a sequence, to join the batch at the next `step`.
+        Whatever is forced right away (e.g. `<thought>`) is already in `generated`.
+
+        `adapter` is loaded right away if needed. Raises `KeyError` if there's no such adapter.
+        """
+        if adapter is not None:
+            if self.adapters is None:
+                raise KeyError(f"No adapters with this model: {adapter}")
+            self.adapters.acquire(adapter, in_use={row.adapter for row in self.rows})
+        self.stats.n_prompt += len(prompt)
+        row = DecodeRow(sequence=list(prompt), max_new_tokens=max_new_tokens, adapter=adapter)
+        if self.enforcer is not None:
+            row.constraint = self.enforcer.add_row()
+        self.rows.append(row)
+
+        # Even the prompt may be followed by forced tokens: prefill them along with it.
+        self._extend(len(self.rows) - 1, [])
+        if row.finished:
+            self.remove([row])
+        return row
+
+    @torch.inference_mode()
+    def add_samples(
+        self, prompt: List[int], max_new_tokens: int, n: int, adapter: Optional[str] = None
+    ) -> List[DecodeRow]:
+        """
+        `add`, for `n` independent samples of the same prompt.
+        The prompt is prefilled once, and its KV cache copied for each sample.
+        """
+        rows = [self.add(prompt, max_new_tokens, adapter) for _ in range(n)]
+        for row in rows[1:]:
+            row.prefill_from = rows[0]
+        return rows
+
+    @torch.inference_mode()
+    def remove(self, rows: List[DecodeRow]):
+        """Rows leave the batch, whether finished or not. Their KV cache goes to the pool."""
+        leaving = set(rows)
+        if self.kv_pool is not None:
+            for i, row in enumerate(self.rows):
+                if row in leaving and row.prefilled:
+                    past = row_past(self._past, self._mask, i)
+                    # Keys and values depend on the adapter too.
+                    self.kv_pool.store(row.sequence[: row.n_fed], past, namespace=row.adapter)
+
+        keep = [i for i, row in enumerate(self.rows) if row not in leaving]
+        cached = [i for i in keep if self.rows[i].prefilled]
+        if self._past is not None:
+            if cached:
+                self._past, self._mask = select_rows(self._past, self._mask, cached)
+            else:
+                self._past, self._mask = None, None
+        if self.enforcer is not None:
+            self.enforcer.select_rows(keep)
+        if self.drafter is not None:
+            for row in rows:
+                self.drafter.forget(row)
+        self.rows = [self.rows[i] for i in keep]
+
+    @torch.inference_mode()
+    def step(self) -> List[Tuple[DecodeRow, List[int]]]:
+        """
+        One forward pass for the batch, plus one prefill per joining row.
+        Returns the new tokens of each row. Finished rows leave the batch afterwards.
+        """
+        if not self.rows:
+            return []
+
+        self.stats.n_steps += 1
+        start = self._mark()
+        prefilled = [row for row in self.rows if row.prefilled]
+        drafts = [[] for _ in prefilled]
+        if self.drafter is not None and prefilled:
+            drafts = self.drafter.draft(prefilled)
+
+        # For each row, the logits after its pending tokens, then after each guess.
+        logits = []
+        if prefilled:
+            logits += self._forward_batch(prefilled, drafts)
+        decoded = self._mark()
+        self._add_time("decode_seconds", start, decoded)
+
+        prefills = {}
+        for row in self.rows:
+            if row.prefilled:
+                continue
+            leader = row.prefill_from
+            if leader in prefills and leader.sequence == row.sequence:
+                prefills[row] = self._share_prefill(row, leader, prefills[leader])
+            else:
+                prefills[row] = self._prefill(row)
+            logits.append(prefills[row])
+        if prefills:
+            self._add_time("prefill_seconds", decoded, self._mark())
+
+        new_tokens, n_accepted = self._sample(logits, drafts)
+        if prefilled:
+            self._reject(prefilled, drafts, n_accepted)
+
+        result = list(zip(self.rows, new_tokens))
+        self.remove([row for row in self.rows if row.finished])
+        self._collect_times()
+        return result
+
+    def _sample(
+        self, logits: List[Tensor], drafts: List[List[int]]
+    ) -> Tuple[List[List[int]], List[int]]:
+        """
+        Sample the next token of each row, and with speculation, the next ones, for as long
+        as they match the guesses.
+        Returns the new tokens of each row, and how many guesses each got right.
+        """
+        new_tokens: List[List[int]] = [[] for _ in self.rows]
+        n_accepted = [0 for _ in self.rows]
+        drafts = drafts + [[] for _ in range(len(self.rows) - len(drafts))]
+        # Rows whose guesses have all been right so far.
+        active = list(range(len(self.rows)))
+        depth = 0
+        while active:
+            scores = torch.stack([logits[i][depth] for i in active])
+            if self.sampler.repetition_penalty != 1.0:
+                seen = torch.stack([self._seen(self.rows[i], scores) for i in active])
+                scores = self.sampler.penalize(seen, scores)
+            if self.enforcer is not None:
+                start = time.perf_counter()
+                scores = self.enforcer.process(scores, active)
+                self.stats.constraint_seconds += time.perf_counter() - start
+            sampled = self.sampler(scores).tolist()
+
+            still_active = []
+            for i, token in zip(active, sampled):
+                tokens = self._extend(i, [token])
+                new_tokens[i] += tokens
+                draft = drafts[i]
+                if depth < len(draft) and tokens[:1] == [draft[depth]]:
+                    n_accepted[i] += 1
+                    # Forced tokens after it weren't in the guess: the next logits are stale.
+                    if len(tokens) == 1 and not self.rows[i].finished:
+                        still_active.append(i)
+            active = still_active
+            depth += 1
+        return new_tokens, n_accepted
+
+    def _seen(self, row: DecodeRow, scores: Tensor) -> Tensor:
+        """Mask of the tokens in `row`'s sequence, for the repetition penalty. Updated with new tokens only."""
+        if row.seen is None:
+            row.seen = torch.zeros(scores.shape[-1], dtype=torch.bool, device=scores.device)
+        new_tokens = row.sequence[row.n_seen :]
+        if new_tokens:
+            row.seen[torch.tensor(new_tokens, device=scores.device)] = True
+            row.n_seen = len(row.sequence)
+        return row.seen
+
+    def _reject(self, rows: List[DecodeRow], drafts: List[List[int]], n_accepted: List[int]):
+        """
+        Guesses were fed to the model along with the pending tokens. The right ones stay in
+        the KV cache; the others are masked out, and left as holes.
+        """
+        n_columns = self._mask.shape[1]
+        for i, (row, draft) in enumerate(zip(rows, drafts)):
+            if not draft:
+                continue
+            self.stats.n_drafted += len(draft)
+            self.stats.n_accepted += n_accepted[i]
+            row.n_drafted += len(draft)
+            row.n_accepted += n_accepted[i]
+
+            n_rejected = len(draft) - n_accepted[i]
+            if n_rejected:
+                # Guesses come last in the row's chunk, before its right padding.
+                end = n_columns - self._chunk_padding[i]
+                self._mask[i, end - n_rejected : end] = 0
+                row.n_fed -= n_rejected
+
+    def _append(self, row: DecodeRow, tokens: List[int]) -> List[int]:
+        """Append tokens to a sequence, until it stops. Returns those actually appended."""
+        appended = []
+        for token in tokens:
+            if row.finished:
+                break
+            appended.append(token)
+            row.generated.append(token)
+            self.stats.n_generated += 1
+            if token in self.stop_token_ids or len(row.generated) >= row.max_new_tokens:
+                row.finished = True
+        row.sequence += appended
+        return appended
+
+    def _extend(self, index: int, sampled: List[int]) -> List[int]:
+        """
+        Append sampled tokens, and with jump-forward, whatever is bound to follow them.
+        Returns the new tokens, to be fed to the model in one go.
+        """
+        row = self.rows[index]
+        new_tokens = self._append(row, sampled)
+        if self.enforcer is None:
+            return new_tokens
+
+        start = time.perf_counter()
+        self.enforcer.feed(index, new_tokens)
+        if self.jump_forward and not row.finished:
+            forced = self._append(row, self.enforcer.take_forced(index))
+            self.stats.n_jumped += len(forced)
+            new_tokens += forced
+        self.stats.constraint_seconds += time.perf_counter() - start
+        return new_tokens
+
+    def _mark(self):
+        """
+        A point in time, for `_add_time`. On CUDA, a point in the GPU's stream of work:
+        waiting for the GPU just to time it would stall the CPU, which should be ahead.
+        """
+        if self._device.type != "cuda":
+            return time.perf_counter()
+        event = torch.cuda.Event(enable_timing=True)
+        event.record(torch.cuda.current_stream(self._device))
+        return event
+
+    def _add_time(self, stat: str, start, end):
+        if self._device.type != "cuda":
+            setattr(self.stats, stat, getattr(self.stats, stat) + end - start)
+        else:
+            self._pending_times.append((stat, start, end))
+
+    def _collect_times(self):
+        """Add up GPU timings that are known by now. Sampling waits for the GPU anyway."""
+        while self._pending_times and self._pending_times[0][2].query():
+            stat, start, end = self._pending_times.pop(0)
+            setattr(self.stats, stat, getattr(self.stats, stat) + start.elapsed_time(end) / 1000)
+
+    def _call_model(self, chunk: _Chunk, past):
+        self.stats.n_forward += 1
+        model = self.model if self.adapters is None else self.adapters.model
+        return _forward(model, chunk, past)
+
+    def _adapter_kwargs(self, rows: List[DecodeRow]) -> dict:
+        if self.adapters is None:
+            return {}
+        return self.adapters.forward_kwargs([row.adapter for row in rows])
+
+    def _prefill(self, row: DecodeRow) -> Tensor:
+        """Prefill a joining row, and add its KV cache to the batch's. Returns its next-token logits."""
+        past, n_past = None, 0
+        if self.kv_pool is not None:
+            past, n_past = self.kv_pool.take(row.sequence, namespace=row.adapter)
+            self.stats.n_reused += n_past
+
+        length = len(row.sequence)
+        chunk = _Chunk(
+            input_ids=torch.tensor([row.sequence[n_past:]], device=self._device),
+            attention_mask=torch.ones((1, length), dtype=torch.long, device=self._device),
+            position_ids=torch.arange(n_past, length, device=self._device)[None],
+            logit_index=[[length - n_past - 1]],
+            model_kwargs={
+                **({"num_logits_to_keep": 1} if self._logits_to_keep else {}),
+                **self._adapter_kwargs([row]),
+            },
+        )
+        (logits,), past = self._call_model(chunk, past)
+        self.stats.n_prefilled += length - n_past
+
+        row.prefilled = True
+        row.n_fed = length
+        if self._past is None:
+            self._past, self._mask = past, chunk.attention_mask
+        else:
+            self._past, self._mask = concat_rows(
+                self._past, self._mask, past, chunk.attention_mask
+            )
+        return logits
+
+    def _share_prefill(self, row: DecodeRow, leader: DecodeRow, logits: Tensor) -> Tensor:
+        """
+        Join the batch with a copy of the KV cache of `leader`, which was just prefilled with
+        the same sequence. Returns its next-token logits: the leader's.
+        """
+        index = [r for r in self.rows if r.prefilled].index(leader)
+        past, mask = select_rows(self._past, self._mask, [index])
+        self._past, self._mask = concat_rows(self._past, self._mask, past, mask)
+        row.prefilled = True
+        row.n_fed = leader.n_fed
+        return logits
+
+    def _forward_batch(self, rows: List[DecodeRow], drafts: List[List[int]]) -> List[Tensor]:
+        """
+        Feed the prefilled rows their new tokens, then their guesses if any.
+        Returns their next-token logits, after each of those guesses too.
+        """
+        pending = [row.sequence[row.n_fed :] for row in rows]
+        chunks = [t + draft for t, draft in zip(pending, drafts)]
+
+        # Anything that is bound to follow goes into the same forward pass.
+        width = max(len(t) for t in chunks)
+        self._chunk_padding = [width - len(t) for t in chunks]
+        chunk_mask = torch.tensor(
+            [[1] * len(t) + [0] * (width - len(t)) for t in chunks], device=self._device
+        )
+        chunk = _Chunk(
+            input_ids=torch.tensor(
+                [t + [self.pad_token_id] * (width - len(t)) for t in chunks],
+                device=self._device,
+            ),
+            attention_mask=torch.cat([self._mask, chunk_mask], dim=1),
+            position_ids=torch.tensor(
+                [[row.n_fed + i for i in range(width)] for row in rows], device=self._device
+            ),
+            logit_index=[
+                list(range(max(len(t) - 1, 0), len(t) + len(draft)))
+                for t, draft in zip(pending, drafts)
+            ],
+            model_kwargs={
+                **({"num_logits_to_keep": width} if self._logits_to_keep else {}),
+                **self._adapter_kwargs(rows),
+            },
+        )
+        logits, self._past = self._call_model(chunk, self._past)
+        self._mask = chunk.attention_mask
+        for row, t in zip(rows, chunks):
+            row.n_fed += len(t)
+        return logits
@@ -0,0 +1,393 @@
+"""
+Reusing key/value caches across calls.
+
+In an agent loop, each turn's prompt is the previous turn's prompt, plus the response,
+plus a little more (an execution result, a user message). Prefilling it from scratch
+every time is wasteful: most of its keys and values were already computed.
+
+`KVPool` keeps the caches of several sequences around (e.g. one per session), within a
+memory budget. Least recently used ones are evicted: spilled to CPU RAM or to disk if
+configured, and brought back on the next hit.
+"""
+
+import copy
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from itertools import count
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+import torch
+from torch import Tensor
+
+log = logging.getLogger(__name__)
+
+# A model's `past_key_values`: a `DynamicCache`, legacy tuples, or anything with a `crop` method.
+Past = Any
+
+# Legacy format: one (key, value) pair per layer, of shape (batch, heads, seq, head_dim).
+LegacyPast = Tuple[Tuple[Tensor, Tensor], ...]
+
+
+def common_prefix_length(a: Sequence, b: Sequence) -> int:
+    """Of token lists, or strings."""
+    n = min(len(a), len(b))
+    # Comparing slices: much faster than item by item in Python. Of doubling lengths, then
+    # binary search: in time proportional to the common prefix, not to the whole sequences.
+    lo, hi = 0, 16
+    while hi < n and a[:hi] == b[:hi]:
+        lo, hi = hi, hi * 2
+    hi = min(hi, n)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def crop_past(past: Past, length: int) -> Past:
+    """Keep the keys and values of the first `length` positions only."""
+    if hasattr(past, "crop"):
+        past.crop(length)
+        return past
+    return tuple((k[:, :, :length], v[:, :, :length]) for k, v in past)
+
+
+def _to_legacy(past: Past) -> Optional[LegacyPast]:
+    """A view of `past` as tuples of tensors, or `None` if it has no such thing."""
+    if hasattr(past, "to_legacy_cache"):
+        return past.to_legacy_cache()
+    if isinstance(past, tuple):
+        return past
+    return None
+
+
+def _from_legacy(legacy: LegacyPast, cache_type: Optional[type]) -> Past:
+    return cache_type.from_legacy_cache(legacy) if cache_type is not None else legacy
+
+
+def _cache_type(past: Past) -> Optional[type]:
+    return type(past) if hasattr(past, "from_legacy_cache") else None
+
+
+def _share(past: Past) -> Past:
+    """
+    A copy of `past` that can be cropped and extended without affecting the original.
+    Tensors are shared where possible: caches don't write into them, they concatenate.
+    """
+    legacy = _to_legacy(past)
+    if legacy is None:
+        return copy.deepcopy(past)
+    return _from_legacy(legacy, _cache_type(past))
+
+
+def _map_legacy(past: Past, fn) -> Past:
+    """Apply `fn` to each key and value tensor, keeping the cache type."""
+    legacy = tuple(tuple(fn(t) for t in layer) for layer in _to_legacy(past))
+    return _from_legacy(legacy, _cache_type(past))
+
+
+# Batch manipulation, for caches of shape (batch, heads, seq, head_dim), along with an
+# attention mask of shape (batch, seq) telling which positions are real.
+
+
+def select_rows(past: Past, mask: Tensor, rows: List[int]) -> Tuple[Past, Tensor]:
+    """Keep these rows only, in this order."""
+    index = torch.tensor(rows, dtype=torch.long, device=mask.device)
+    past = _map_legacy(past, lambda t: t.index_select(0, index.to(t.device)))
+    return trim_left(past, mask.index_select(0, index))
+
+
+def trim_left(past: Past, mask: Tensor) -> Tuple[Past, Tensor]:
+    """Drop leading positions that no row attends to (e.g. padding of rows that left)."""
+    attended = mask.any(0).nonzero()
+    start = int(attended[0]) if len(attended) else mask.shape[1]
+    if start == 0:
+        return past, mask
+    return _map_legacy(past, lambda t: t[:, :, start:]), mask[:, start:]
+
+
+def concat_rows(a: Past, a_mask: Tensor, b: Past, b_mask: Tensor) -> Tuple[Past, Tensor]:
+    """Stack the rows of two caches. The shorter one is left-padded with masked positions."""
+    length = max(a_mask.shape[1], b_mask.shape[1])
+
+    def pad(t: Tensor, dim: int) -> Tensor:
+        n = length - t.shape[dim]
+        if n == 0:
+            return t
+        shape = list(t.shape)
+        shape[dim] = n
+        return torch.cat([t.new_zeros(shape), t], dim=dim)
+
+    a_legacy, b_legacy = _to_legacy(a), _to_legacy(b)
+    legacy = tuple(
+        tuple(torch.cat([pad(x, 2), pad(y, 2)], dim=0) for x, y in zip(a_layer, b_layer))
+        for a_layer, b_layer in zip(a_legacy, b_legacy)
+    )
+    mask = torch.cat([pad(a_mask, 1), pad(b_mask, 1)], dim=0)
+    return _from_legacy(legacy, _cache_type(a)), mask
+
+
+def row_past(past: Past, mask: Tensor, row: int) -> Past:
+    """The cache of a single row, without any padding or holes."""
+    positions = mask[row].nonzero().squeeze(1)
+    return _map_legacy(
+        past, lambda t: t[row : row + 1].index_select(2, positions.to(t.device))
+    )
+
+
+def past_nbytes(past: Past) -> int:
+    """
+    Memory that `past` keeps alive. Cropped caches are views: their whole storage counts,
+    cropped positions included. Storage shared by several tensors counts once.
+    """
+    legacy = _to_legacy(past) or ()
+    storages = {}
+    for layer in legacy:
+        for t in layer:
+            storage = t.untyped_storage()
+            storages[storage.data_ptr()] = storage.nbytes()
+    return sum(storages.values())
+
+
+@dataclass
+class KVPoolStats:
+    """Counters, to size the pool."""
+
+    hits: int = 0
+    misses: int = 0
+    # Prompt tokens served from the pool, over all hits.
+    reused_tokens: int = 0
+    # Entries pushed out of device memory, whether spilled or dropped.
+    evictions: int = 0
+    spills: int = 0
+    # Spilled entries brought back to the device on a hit.
+    restores: int = 0
+    # Entries gone for good.
+    drops: int = 0
+
+
+@dataclass
+class _Entry:
+    id: int
+    token_ids: List[int]
+    namespace: Optional[str]
+    block_hashes: List[int]
+    nbytes: int
+    # On the device, ready to use. `None` once spilled.
+    past: Past
+    # Once spilled: legacy tuples on the CPU, or the file they were saved to.
+    spilled: Optional[LegacyPast | Path] = None
+    cache_type: Optional[type] = None
+    device: Optional[torch.device] = None
+
+
+class KVPool:
+    """
+    KV caches of recent sequences, keyed by token prefix.
+
+    A new sequence reuses the cache of the entry it shares the longest prefix with, cropped to
+    that prefix. Whatever differs is never reused: this is what makes it correct when history
+    is rewritten rather than appended to (e.g. `ResumeFrom`).
+
+    Entries are indexed by chained hashes of their tokens, `block_size` tokens at a time,
+    so that finding candidates doesn't mean comparing against every entry. Only when no
+    block matches, e.g. for prompts shorter than a block, are all entries compared against.
+
+    Caches that the same tokens don't determine alone (e.g. computed with different LoRA
+    adapters) go in different `namespace`s, and are never reused across them.
+
+    Budgets are in bytes. `spill` is `None` (evicted entries are dropped), `"cpu"`,
+    or a directory to save them to.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 2 * 1024**3,
+        spill: Optional[str | Path] = None,
+        max_spill_bytes: int = 8 * 1024**3,
+        block_size: int = 64,
+    ):
+        self.max_bytes = max_bytes
+        self.max_spill_bytes = max_spill_bytes
+        self.block_size = block_size
+        self.spill_dir = None if spill in (None, "cpu") else Path(spill)
+        self.spill_enabled = spill is not None
+        if self.spill_dir is not None:
+            self.spill_dir.mkdir(parents=True, exist_ok=True)
+
+        self.stats = KVPoolStats()
+        # Least recently used first.
+        self._entries: OrderedDict[int, _Entry] = OrderedDict()
+        # Block hash -> IDs of the entries whose tokens start with that block chain.
+        self._index: Dict[int, Set[int]] = {}
+        self._ids = count()
+        # Totals of the entries' `nbytes`, on the device and spilled.
+        self._device_bytes = 0
+        self._spilled_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def device_bytes(self) -> int:
+        return self._device_bytes
+
+    @property
+    def spilled_bytes(self) -> int:
+        return self._spilled_bytes
+
+    def take(self, token_ids: List[int], namespace: Optional[str] = None) -> Tuple[Past, int]:
+        """
+        A cache for `token_ids`, cropped to what can be reused.
+        Returns `(past, n_reused)`; `past` is `None` if nothing can be reused.
+
+        The caller is going to extend `past`, and should `store` it once done.
+        If it covers a whole entry, that entry is handed over and leaves the pool:
+        the stored extension will supersede it.
+        """
+        entry, n_common = self._lookup(token_ids, namespace)
+        # At least one token must be fed to the model, to get logits out of it.
+        n_reused = min(n_common, len(token_ids) - 1)
+        if entry is None or n_reused <= 0:
+            self.stats.misses += 1
+            return None, 0
+
+        self.stats.hits += 1
+        self.stats.reused_tokens += n_reused
+        past = self._restore(entry)
+        if n_reused == len(entry.token_ids):
+            self._remove(entry)
+        else:
+            self._entries.move_to_end(entry.id)
+            past = _share(past)
+            self._enforce_budgets()
+        return crop_past(past, n_reused), n_reused
+
+    def store(self, token_ids: List[int], past: Past, namespace: Optional[str] = None):
+        """`past` holds the keys and values of exactly `token_ids`."""
+        # Entries that are a prefix of this one are of no more use.
+        for entry in list(self._entries.values()):
+            if entry.namespace == namespace and len(entry.token_ids) <= len(token_ids) and (
+                common_prefix_length(entry.token_ids, token_ids) == len(entry.token_ids)
+            ):
+                self._drop(entry)
+
+        entry = _Entry(
+            id=next(self._ids),
+            token_ids=list(token_ids),
+            namespace=namespace,
+            block_hashes=self._block_hashes(token_ids, namespace),
+            nbytes=past_nbytes(past),
+            past=past,
+        )
+        self._entries[entry.id] = entry
+        self._device_bytes += entry.nbytes
+        for h in entry.block_hashes:
+            self._index.setdefault(h, set()).add(entry.id)
+        self._enforce_budgets()
+
+    def clear(self):
+        for entry in list(self._entries.values()):
+            self._remove(entry)
+
+    def _block_hashes(self, token_ids: List[int], namespace: Optional[str] = None) -> List[int]:
+        """
+        One hash per complete block, each covering all the tokens up to the end of its block.
+        First, that of no tokens at all: every entry of the namespace has it.
+        """
+        h = hash(namespace)
+        hashes = [h]
+        for start in range(0, len(token_ids) - self.block_size + 1, self.block_size):
+            h = hash((h, tuple(token_ids[start : start + self.block_size])))
+            hashes.append(h)
+        return hashes
+
+    def _lookup(
+        self, token_ids: List[int], namespace: Optional[str] = None
+    ) -> Tuple[Optional[_Entry], int]:
+        """The entry sharing the longest prefix with `token_ids`, and the length of that prefix."""
+        for h in reversed(self._block_hashes(token_ids, namespace)):
+            candidates = [
+                (common_prefix_length(self._entries[i].token_ids, token_ids), i)
+                for i in self._index.get(h, ())
+                if self._entries[i].namespace == namespace
+            ]
+            if candidates:
+                n_common, best = max(candidates)
+                return self._entries[best], n_common
+        return None, 0
+
+    def _restore(self, entry: _Entry) -> Past:
+        if entry.spilled is None:
+            return entry.past
+
+        legacy = entry.spilled
+        if isinstance(legacy, Path):
+            legacy = torch.load(legacy, weights_only=True)
+            entry.spilled.unlink(missing_ok=True)
+        legacy = tuple(tuple(t.to(entry.device) for t in layer) for layer in legacy)
+        entry.past = _from_legacy(legacy, entry.cache_type)
+        entry.spilled = None
+        self._spilled_bytes -= entry.nbytes
+        self._device_bytes += entry.nbytes
+        self.stats.restores += 1
+        log.debug(f"Restored KV cache entry {entry.id} ({len(entry.token_ids)} tokens)")
+        return entry.past
+
+    def _enforce_budgets(self):
+        for entry in list(self._entries.values()):
+            if self.device_bytes <= self.max_bytes:
+                break
+            if entry.spilled is None:
+                self._evict(entry)
+
+        for entry in list(self._entries.values()):
+            if self.spilled_bytes <= self.max_spill_bytes:
+                break
+            if entry.spilled is not None:
+                self._drop(entry)
+
+    def _evict(self, entry: _Entry):
+        """Out of device memory: spilled if possible, dropped otherwise."""
+        self.stats.evictions += 1
+        legacy = _to_legacy(entry.past)
+        if not self.spill_enabled or legacy is None or entry.nbytes > self.max_spill_bytes:
+            self._drop(entry)
+            return
+
+        entry.cache_type = _cache_type(entry.past)
+        entry.device = legacy[0][0].device if legacy else torch.device("cpu")
+        host = tuple(tuple(t.to("cpu") for t in layer) for layer in legacy)
+        if self.spill_dir is not None:
+            path = self.spill_dir / f"{entry.id}.pt"
+            torch.save(host, path)
+            entry.spilled = path
+        else:
+            entry.spilled = host
+        entry.past = None
+        self._device_bytes -= entry.nbytes
+        self._spilled_bytes += entry.nbytes
+        self.stats.spills += 1
+        log.debug(f"Spilled KV cache entry {entry.id} ({entry.nbytes} bytes)")
+
+    def _drop(self, entry: _Entry):
+        self.stats.drops += 1
+        self._remove(entry)
+
+    def _remove(self, entry: _Entry):
+        del self._entries[entry.id]
+        if entry.spilled is None:
+            self._device_bytes -= entry.nbytes
+        else:
+            self._spilled_bytes -= entry.nbytes
+        for h in entry.block_hashes:
+            ids = self._index[h]
+            ids.discard(entry.id)
+            if not ids:
+                del self._index[h]
+        if isinstance(entry.spilled, Path):
+            entry.spilled.unlink(missing_ok=True)
@@ -3,60 +3,229 @@ Core LLM functionality: initialization and generation with constraints.
 """
 
 import logging
-from unsloth import FastLanguageModel
-from unsloth.chat_templates import get_chat_template
+from typing import Iterator, List, Optional, Set
 
-from .constrain import StructuredEnforcer
+from .backends import load_backend
+from .constrain import StructuredEnforcer, load_state_masks
+from .decode import BatchDecoder, DecodeStats, Sampler, decode_batch
+from .kv import KVPool
+from .speculate import DraftModel, PromptLookup, check_tokenizers
+from .stream import DeltaStream, StreamDelta
+from ..preproc.compact import TokenCounter, compact
 from ..types.chatml import Conversation
 
 log = logging.getLogger(__name__)
 
+
 class LLM:
     """
     Handles model initialization and generation with appropriate constraints.
     """
 
-    def __init__(self, model_name: str = "unsloth/Phi-4", chat_template="phi-4", max_seq_length: int = 2048):
+    def __init__(
+        self,
+        model_name: str = "unsloth/Phi-4",
+        chat_template="phi-4",
+        max_seq_length: int = 2048,
+        kv_pool: Optional[KVPool] = None,
+        draft_model_name: Optional[str] = None,
+        tokenizer_name: Optional[str] = None,
+    ):
+        """
+        `model_name` may also be a `.gguf` file, to run on CPU with llama.cpp: see `backends`.
+        Its tokenizer comes from `tokenizer_name`, or the file's directory.
+
+        With `draft_model_name`, a smaller model sharing the tokenizer guesses tokens for
+        this one to check (speculative decoding). Raises `ValueError` if tokenizers differ.
+        """
         log.info(f"Initializing LLM with model {model_name}, chat template {chat_template}, max_seq_length {max_seq_length}")
-        # Initialize model and tokenizer
-        model, tokenizer = FastLanguageModel.from_pretrained(
-            model_name=model_name,
-            max_seq_length=max_seq_length,
-            load_in_4bit=True,
-        )
-        self.tokenizer = get_chat_template(
-            tokenizer, chat_template
-        ) # CAREFUL wrt mistmatches...
-        FastLanguageModel.for_inference(model)
-        self.model = model
+        self.backend = load_backend(model_name, chat_template, max_seq_length, tokenizer_name)
+        self.tokenizer = self.backend.tokenizer
+        self.max_seq_length = max_seq_length
+
+        # Token counts of messages seen before, to fit conversations in the context window cheaply.
+        self.token_counter = TokenCounter(self.tokenizer)
+
+        # Walking the vocabulary takes a while: once per tokenizer, cached on disk.
+        self.state_masks = load_state_masks(self.tokenizer).to(self.backend.device)
 
-    def generate(self, messages: Conversation, max_new_tokens: int = 512) -> str:
+        # Keys and values of previous sequences: the next turn of a conversation can reuse most of them.
+        self.kv_pool = None
+        if self.backend.reuses_kv:
+            self.kv_pool = kv_pool if kv_pool is not None else KVPool()
+
+        self.draft_model = None
+        if draft_model_name is not None:
+            if not self.backend.speculative:
+                raise ValueError(f"No speculative decoding with {type(self.backend).__name__}")
+            log.info(f"Loading draft model {draft_model_name}")
+            draft = load_backend(draft_model_name, chat_template, max_seq_length)
+            # Before wasting any time: guesses would be nonsense to the main model.
+            check_tokenizers(self.tokenizer, draft.tokenizer)
+            self.draft_model = draft.model
+
+    def generate(
+        self,
+        messages: Conversation | List[Conversation],
+        max_new_tokens: int = 512,
+        jump_forward: bool = True,
+        prompt_lookup: bool = False,
+    ) -> str | List[str]:
         """
         Generate a response given a conversation history.
         Returns raw text (still needs to be parsed).
+
+        Given a list of conversations, generates a response to each, as a single batch,
+        and returns a list of responses.
+
+        With `jump_forward`, tokens forced by the constraint are appended in bulk
+        rather than one forward pass at a time. Same output, fewer forward passes.
+
+        With `prompt_lookup`, the next tokens are guessed by copying from earlier in the
+        conversation, and checked in the same forward pass (speculative decoding).
+        Same output, for greedy decoding; fewer forward passes when the code repeats itself.
+        Otherwise, the draft model guesses, if there is one.
+        """
+        if not _is_batch(messages):
+            return self.generate([messages], max_new_tokens, jump_forward, prompt_lookup)[0]
+
+        prompts = [
+            self.prompt_tokens(self.fit(conversation, max_new_tokens)) for conversation in messages
+        ]
+        n_input = sum(len(p) for p in prompts)
+        log.info(f"Completing {n_input} tokens, over {len(prompts)} sequence(s)...")
+
+        stats = DecodeStats()
+        outputs = []
+        group_size = self.backend.max_batch_size or len(prompts)
+        for start in range(0, len(prompts), group_size):
+            batch = self.batch_decoder(jump_forward, stats, prompt_lookup)
+            outputs += decode_batch(batch, prompts[start : start + group_size], max_new_tokens)
+        self._log_stats(stats)
+
+        return [
+            self.tokenizer.decode(output, skip_special_tokens=False) for output in outputs
+        ]
+
+    def generate_stream(
+        self,
+        messages: Conversation,
+        max_new_tokens: int = 512,
+        jump_forward: bool = True,
+        prompt_lookup: bool = False,
+    ) -> Iterator[StreamDelta]:
+        """
+        Same as `generate` for a single conversation, but yields the response as it comes.
+        Joined together, the deltas' text is what `generate` would have returned.
+
+        The first delta (`<thought>`, forced) comes before the prompt is even prefilled.
+        Stop iterating (or `close()`) to stop generation.
+        """
+        prompt = self.prompt_tokens(self.fit(messages, max_new_tokens))
+        log.info(f"Streaming completion of {len(prompt)} tokens...")
+
+        stats = DecodeStats()
+        batch = self.batch_decoder(jump_forward, stats, prompt_lookup)
+        row = batch.add(prompt, max_new_tokens)
+        deltas = DeltaStream(self.tokenizer)
+        try:
+            if delta := deltas.push(row.generated, row.state):
+                yield delta
+            while batch.rows:
+                for _, tokens in batch.step():
+                    if delta := deltas.push(tokens, row.state):
+                        yield delta
+        except GeneratorExit:
+            # Stopped early: what's in the KV cache is still good for next time.
+            batch.remove(batch.rows)
+            raise
+
+        if delta := deltas.flush(row.state):
+            yield delta
+        self._log_stats(stats)
+
+    def batch_decoder(
+        self,
+        jump_forward: bool = True,
+        stats: Optional[DecodeStats] = None,
+        prompt_lookup: bool = False,
+    ) -> BatchDecoder:
+        """A decoding loop that sequences can join and leave at any step: for continuous batching."""
+        return self.backend.new_decoder(
+            StructuredEnforcer(self.tokenizer, self.state_masks),
+            self._sampler(),
+            stop_token_ids=self._stop_token_ids(),
+            pad_token_id=self._pad_token_id(),
+            jump_forward=jump_forward,
+            stats=stats,
+            kv_pool=self.kv_pool,
+            drafter=self._drafter(prompt_lookup),
+        )
+
+    def fit(self, conversation: Conversation, max_new_tokens: int) -> Conversation:
         """
-        inputs = self.tokenizer.apply_chat_template(
-            messages, return_tensors="pt", add_generation_prompt=True
-        ).to("cuda")
+        Compact `conversation` if needed, so that it fits in the context window along with
+        the response. See `src.preproc.compact`.
+        """
+        budget = self.max_seq_length - max_new_tokens
+        compacted = compact(conversation, budget, self.token_counter)
+        if compacted != conversation:
+            n_tokens = self.token_counter.total(compacted)
+            log.info(
+                f"Compacted conversation from {len(conversation)} to {len(compacted)} messages, "
+                f"{self.token_counter.total(conversation)} to {n_tokens} tokens (budget: {budget})"
+            )
+            if n_tokens > budget:
+                log.warning("Conversation still doesn't fit in the context window")
+        return compacted
+
+    def prompt_tokens(self, conversation: Conversation) -> List[int]:
+        return self.tokenizer.apply_chat_template(conversation, add_generation_prompt=True)
+
+    def _sampler(self) -> Sampler:
+        return Sampler.from_generation_config(self.backend.generation_config, temperature=1)
 
-        n_input = inputs.shape[1]
-        log.info(f"Completing {n_input} tokens...")
+    def _drafter(self, prompt_lookup: bool):
+        """Who guesses tokens, if anyone: prompt lookup if asked for, else the draft model."""
+        if not self.backend.speculative:
+            if prompt_lookup:
+                log.warning(f"No speculative decoding with {type(self.backend).__name__}")
+            return None
+        if prompt_lookup:
+            return PromptLookup()
+        if self.draft_model is not None:
+            return DraftModel(
+                self.draft_model, self.tokenizer, self._stop_token_ids(), self.state_masks
+            )
+        return None
 
-        outputs = self.model.generate(
-            inputs,
-            max_new_tokens=max_new_tokens,
-            logits_processor=[StructuredEnforcer(self.tokenizer)],
-            pad_token_id=self.tokenizer.eos_token_id,
-            temperature=1,
+    def _log_stats(self, stats: DecodeStats):
+        log.info(
+            f"Reused {stats.n_reused} cached prompt tokens. "
+            f"Generated {stats.n_generated} tokens in {stats.n_forward} forward passes "
+            f"({stats.n_jumped} jumped forward). Prefill: {stats.prefill_seconds:.2f}s, "
+            f"decoding: {stats.decode_seconds:.2f}s, constraint: {stats.constraint_seconds:.2f}s"
         )
+        if stats.n_drafted:
+            log.info(
+                f"Speculation: accepted {stats.n_accepted}/{stats.n_drafted} guessed tokens "
+                f"({stats.acceptance_rate:.0%}), {stats.tokens_per_forward:.2f} tokens per forward pass"
+            )
+        if self.kv_pool is not None:
+            log.debug(f"KV pool: {len(self.kv_pool)} entries, {self.kv_pool.stats}")
 
-        # Always BS = 1.
-        assert outputs.shape[0] == 1
+    def _pad_token_id(self) -> int:
+        if self.tokenizer.pad_token_id is not None:
+            return self.tokenizer.pad_token_id
+        return self.tokenizer.eos_token_id
 
-        # Remove input tokens
-        outputs = outputs[0, n_input:]
+    def _stop_token_ids(self) -> Set[int]:
+        """Generation stops on any of these, as with `model.generate`."""
+        eos = self.backend.generation_config.eos_token_id
+        eos = [] if eos is None else [eos] if isinstance(eos, int) else list(eos)
+        return {self.tokenizer.eos_token_id, *eos}
 
-        n_output = outputs.shape[0]
-        log.info(f"Generated {n_output} tokens")
 
-        return self.tokenizer.decode(outputs, skip_special_tokens=False)
+def _is_batch(messages: Conversation | List[Conversation]) -> bool:
+    """A conversation is a list of messages (dicts); a batch is a list of conversations."""
+    return bool(messages) and isinstance(messages[0], list)
@@ -0,0 +1,152 @@
+"""
+Several LoRA adapters on top of a single resident base model, chosen per sequence.
+
+Trying a freshly trained adapter shouldn't mean reloading the base model. `Adapters` knows
+of adapters by name (`register`, `discover`), loads them into the model on first use, and
+unloads the least recently used ones beyond `max_loaded`. Adapters that sequences of the
+batch are using are never unloaded.
+
+Sequences with different adapters are decoded in the same batch: PEFT applies each row's
+own adapter, given `adapter_names` (mixed-batch inference). Rows without an adapter get the
+adapter the model was loaded with, if any (`--model ./run/phi4/lora`), the base model otherwise.
+"""
+
+import glob
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set
+
+log = logging.getLogger(__name__)
+
+# Where `nb/train.py` saves adapters: `run/<name>/lora`.
+RUN_ADAPTERS = "run/*/lora"
+
+# PEFT's name for no adapter at all, in `adapter_names`.
+BASE = "__base__"
+
+
+class Adapters:
+    """
+    LoRA adapters for `model`, loaded on demand, at most `max_loaded` at a time
+    (more if that many are in use).
+
+    `register`, `loaded` and `in` may be used from any thread, e.g. the server's event loop;
+    everything else, from the decoding thread only: loading and unloading adapters changes
+    the model.
+    """
+
+    def __init__(self, model, max_loaded: int = 4):
+        self.base = model
+        self.max_loaded = max_loaded
+        # Name -> directory, for all known adapters, loaded or not.
+        self.paths: Dict[str, str] = {}
+        # Around what's shared with `register`: names, and what's loaded. Not held while
+        # loading, which takes a while.
+        self._lock = threading.Lock()
+        # Least recently used first.
+        self._loaded: OrderedDict[str, None] = OrderedDict()
+        # Registered again since they were loaded: to reload once no sequence uses them.
+        self._stale: Set[str] = set()
+        # The adapter the model came with, if any. Never unloaded.
+        self.default = _active_adapter(model)
+        self._peft = model if self.default is not None else None
+
+    def __contains__(self, name: str) -> bool:
+        with self._lock:
+            return name in self.paths
+
+    @property
+    def model(self):
+        """What to run: the base model, wrapped by PEFT once it has adapters."""
+        return self._peft if self._peft is not None else self.base
+
+    @property
+    def loaded(self) -> List[str]:
+        with self._lock:
+            return list(self._loaded)
+
+    def register(self, name: str, path: str):
+        """Make an adapter available, or point `name` to a new version. Loaded on first use."""
+        if not (Path(path) / "adapter_config.json").is_file():
+            raise ValueError(f"No LoRA adapter in {path}")
+        if name == self.default:
+            raise ValueError(f"{name} is the model's own adapter")
+        with self._lock:
+            # Loaded, or maybe being loaded right now, from its previous version.
+            if name in self.paths:
+                self._stale.add(name)
+            self.paths[name] = str(path)
+        log.info(f"Registered adapter {name} from {path}")
+
+    def discover(self, pattern: str = RUN_ADAPTERS) -> List[str]:
+        """Register the adapters found in `pattern` directories, named after their parent."""
+        names = []
+        for path in sorted(glob.glob(pattern)):
+            if (Path(path) / "adapter_config.json").is_file():
+                name = Path(path).parent.name
+                self.register(name, path)
+                names.append(name)
+        return names
+
+    def acquire(self, name: str, in_use: Iterable[Optional[str]] = ()):
+        """
+        Load `name` if needed, and unload what's beyond `max_loaded` but `in_use` adapters.
+        Raises `KeyError` for unknown adapters.
+        """
+        in_use = set(in_use)
+        with self._lock:
+            if name not in self.paths:
+                raise KeyError(f"Unknown adapter: {name}")
+            path = self.paths[name]
+            reload = name in self._stale and name not in in_use
+            if reload:
+                self._stale.discard(name)
+        if reload and name in self._loaded:
+            self._unload(name)
+
+        if name not in self._loaded:
+            self._load(name, path)
+        with self._lock:
+            self._loaded.move_to_end(name)
+
+        for other in list(self._loaded):
+            if len(self._loaded) <= self.max_loaded:
+                break
+            if other != name and other not in in_use:
+                self._unload(other)
+
+    def forward_kwargs(self, names: List[Optional[str]]) -> dict:
+        """Model arguments to apply, to each row, its adapter (`None` for the default)."""
+        if self._peft is None:
+            return {}
+        return {"adapter_names": [name or self.default or BASE for name in names]}
+
+    def _load(self, name: str, path: str):
+        log.info(f"Loading adapter {name} from {path}")
+        if self._peft is None:
+            # Only needed once there are adapters.
+            from peft import PeftModel
+
+            self._peft = PeftModel.from_pretrained(self.base, path, adapter_name=name)
+            self._peft.eval()
+        else:
+            self._peft.load_adapter(path, adapter_name=name)
+        with self._lock:
+            self._loaded[name] = None
+
+    def _unload(self, name: str):
+        log.info(f"Unloading adapter {name}")
+        self._peft.delete_adapter(name)
+        with self._lock:
+            del self._loaded[name]
+
+
+def _active_adapter(model) -> Optional[str]:
+    """The adapter of a model loaded from a LoRA directory, `None` for a plain model."""
+    try:
+        from peft import PeftModel
+    except ImportError:
+        return None
+    return model.active_adapter if isinstance(model, PeftModel) else None
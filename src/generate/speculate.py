@@ -0,0 +1,191 @@
+"""
+Speculative decoding: guess the next few tokens cheaply, and have the model check them all
+in a single forward pass.
+
+The model's outputs at the guessed positions tell us what it would have sampled there.
+Guesses are accepted for as long as they match; the first mismatch is replaced by what the
+model sampled instead. Either way, each forward pass yields at least one token, and often more.
+Outputs are exactly what they would have been without speculation, for greedy decoding;
+for sampling, their distribution is.
+
+`PromptLookup` guesses by copying: the code the assistant writes often repeats names,
+paths and snippets that are already in the conversation (earlier code, execution output).
+
+`DraftModel` guesses with a smaller model sharing the same tokenizer, under the same
+constraint as the main one.
+"""
+
+from typing import Dict, List, Optional, Set, Tuple
+
+import torch
+from torch import Tensor
+
+from .constrain import StructuredEnforcer
+from .decode import DecodeRow, _Chunk, _forward, _model_device, _supports_logits_to_keep
+from .kv import Past, common_prefix_length, crop_past
+
+
+class NgramIndex:
+    """
+    Where each n-gram of a sequence last appeared, for small n.
+    Updated incrementally as the sequence grows: O(1) per token.
+    """
+
+    def __init__(self, max_ngram: int):
+        self.max_ngram = max_ngram
+        # n-gram -> position right after its latest occurrence, that is followed by something.
+        self._next: Dict[Tuple[int, ...], int] = {}
+        self._n_indexed = 0
+
+    def update(self, sequence: List[int]):
+        # An n-gram ending at `end` gets indexed once `sequence[end]` exists.
+        # The latest n-grams are thus never found: they are what we look up.
+        for end in range(max(self._n_indexed, 1), len(sequence)):
+            for n in range(1, min(self.max_ngram, end) + 1):
+                self._next[tuple(sequence[end - n : end])] = end
+        self._n_indexed = max(self._n_indexed, len(sequence))
+
+    def find(self, ngram: List[int]) -> int:
+        """Where the latest earlier occurrence of `ngram` is followed from, or -1."""
+        return self._next.get(tuple(ngram), -1)
+
+
+class PromptLookup:
+    """
+    Drafts continuations by finding the latest `n`-gram of a sequence earlier in it,
+    prompt included, for `n` from `max_ngram` down to `min_ngram`, and copying what follows.
+    """
+
+    def __init__(self, max_ngram: int = 3, min_ngram: int = 2, n_draft: int = 8):
+        self.max_ngram = max_ngram
+        self.min_ngram = min_ngram
+        self.n_draft = n_draft
+        self._indices: Dict[DecodeRow, NgramIndex] = {}
+
+    def draft(self, rows: List[DecodeRow]) -> List[List[int]]:
+        return [self._draft(row) for row in rows]
+
+    def forget(self, row: DecodeRow):
+        """`row` left the batch."""
+        self._indices.pop(row, None)
+
+    def _draft(self, row: DecodeRow) -> List[int]:
+        index = self._indices.setdefault(row, NgramIndex(self.max_ngram))
+        index.update(row.sequence)
+
+        n_draft = min(self.n_draft, row.max_new_tokens - len(row.generated) - 1)
+        if n_draft <= 0:
+            return []
+        for n in range(self.max_ngram, self.min_ngram - 1, -1):
+            if len(row.sequence) <= n:
+                continue
+            start = index.find(row.sequence[-n:])
+            if start >= 0:
+                return row.sequence[start : start + n_draft]
+        return []
+
+
+class DraftModel:
+    """
+    Drafts continuations with a small model: its greedy choices, one token at a time.
+
+    Each row's constraint is forked, so that the draft follows the same rules as the main
+    model: same banned tokens, same forced sequences. Guesses that break them would be
+    rejected anyway, wasting the rest of the draft.
+
+    The draft model keeps a KV cache per row, cropped to what the main model accepted.
+    Rows are drafted one after the other: the draft model is meant to be cheap.
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        stop_token_ids: Set[int],
+        masks: Optional[Tensor] = None,
+        n_draft: int = 4,
+    ):
+        self.model = model
+        self.stop_token_ids = stop_token_ids
+        self.n_draft = n_draft
+        # Drives forked constraints, one at a time.
+        self._enforcer = StructuredEnforcer(tokenizer, masks)
+        self._device = _model_device(model)
+        self._logits_to_keep = _supports_logits_to_keep(model)
+        # Tokens whose keys and values are in the draft model's cache, and that cache.
+        self._caches: Dict[DecodeRow, Tuple[List[int], Past]] = {}
+
+    @torch.inference_mode()
+    def draft(self, rows: List[DecodeRow]) -> List[List[int]]:
+        return [self._draft(row) for row in rows]
+
+    def forget(self, row: DecodeRow):
+        """`row` left the batch."""
+        self._caches.pop(row, None)
+
+    def _draft(self, row: DecodeRow) -> List[int]:
+        n_draft = min(self.n_draft, row.max_new_tokens - len(row.generated) - 1)
+        if n_draft <= 0:
+            return []
+
+        # Whatever the main model rejected last time goes.
+        tokens, past = self._caches.pop(row, ([], None))
+        n_past = min(common_prefix_length(tokens, row.sequence), len(row.sequence) - 1)
+        past = crop_past(past, n_past) if past is not None and n_past > 0 else None
+        tokens = row.sequence[:n_past]
+
+        constraint = row.constraint.fork() if row.constraint is not None else None
+        self._enforcer.rows = [constraint]
+
+        draft: List[int] = []
+        new_tokens = row.sequence[n_past:]
+        while True:
+            scores, past = self._forward(new_tokens, len(tokens), past)
+            tokens += new_tokens
+            if constraint is not None:
+                scores = self._enforcer.process(scores)
+            token = scores.argmax(dim=-1).item()
+            draft.append(token)
+            if len(draft) >= n_draft or token in self.stop_token_ids:
+                break
+            if constraint is not None:
+                constraint.push(token)
+            new_tokens = [token]
+
+        self._caches[row] = (tokens, past)
+        return draft
+
+    def _forward(self, new_tokens: List[int], n_past: int, past) -> Tuple[Tensor, Past]:
+        """Next-token logits, shape `(1, vocab)`, after feeding `new_tokens`."""
+        length = n_past + len(new_tokens)
+        chunk = _Chunk(
+            input_ids=torch.tensor([new_tokens], device=self._device),
+            attention_mask=torch.ones((1, length), dtype=torch.long, device=self._device),
+            position_ids=torch.arange(n_past, length, device=self._device)[None],
+            logit_index=[[len(new_tokens) - 1]],
+            model_kwargs={"num_logits_to_keep": 1} if self._logits_to_keep else {},
+        )
+        (logits,), past = _forward(self.model, chunk, past)
+        return logits, past
+
+
+def check_tokenizers(tokenizer, draft_tokenizer):
+    """
+    Speculation compares token IDs: both models must agree on what they mean.
+    Raises `ValueError` otherwise.
+    """
+    vocab, draft_vocab = tokenizer.get_vocab(), draft_tokenizer.get_vocab()
+    if vocab != draft_vocab:
+        differ = sorted(
+            token for token in vocab.keys() | draft_vocab.keys()
+            if vocab.get(token) != draft_vocab.get(token)
+        )
+        raise ValueError(
+            f"The draft model's tokenizer doesn't match: {len(draft_vocab)} tokens vs. "
+            f"{len(vocab)}, {len(differ)} differ (e.g. {differ[:5]})"
+        )
+    if tokenizer.eos_token_id != draft_tokenizer.eos_token_id:
+        raise ValueError(
+            f"The draft model's EOS token doesn't match: {draft_tokenizer.eos_token!r} "
+            f"vs. {tokenizer.eos_token!r}"
+        )
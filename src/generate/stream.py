@@ -0,0 +1,54 @@
+"""
+Streaming responses: from tokens, as they are generated, to text deltas.
+"""
+
+from dataclasses import dataclass
+from typing import List, Optional
+
+from .constrain import IncrementalDetokenizer, State
+
+
+@dataclass
+class StreamDelta:
+    """A piece of a response being generated."""
+
+    text: str
+    # Constraint state, right after `text`: tells whether we're in the thought, action, code...
+    state: Optional[State]
+    # Tokens behind `text`. Text held back, waiting for the rest of a character, counts later.
+    n_tokens: int = 0
+    # Whether all of it was forced by the constraint, e.g. the opening `<thought>`: the model
+    # may not even have seen the prompt yet.
+    forced: bool = False
+
+
+class DeltaStream:
+    """
+    Turns the tokens of one response into `StreamDelta`s.
+    Joined together, their text is the decoding of all the tokens.
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self._detokenizer = IncrementalDetokenizer(tokenizer)
+        # Tokens not accounted for in any delta yet.
+        self._n_pending = 0
+
+    def push(
+        self, tokens: List[int], state: Optional[State], forced: bool = False
+    ) -> Optional[StreamDelta]:
+        """`forced` if the constraint forced all of `tokens`."""
+        text = "".join(self._detokenizer.push(token) for token in tokens)
+        self._n_pending += len(tokens)
+        return self._delta(text, state, forced) if text else None
+
+    def flush(self, state: Optional[State]) -> Optional[StreamDelta]:
+        """Once done: anything held back, waiting for the rest of a character that never came."""
+        full_text = self.tokenizer.decode(self._detokenizer.token_ids, skip_special_tokens=False)
+        rest = full_text[len(self._detokenizer) :]
+        return self._delta(rest, state) if rest or self._n_pending else None
+
+    def _delta(self, text: str, state: Optional[State], forced: bool = False) -> StreamDelta:
+        delta = StreamDelta(text, state, self._n_pending, forced)
+        self._n_pending = 0
+        return delta
@@ -0,0 +1,247 @@
+import torch
+
+from .constrain import StructuredEnforcer
+from .decode import BatchDecoder, DecodeStats, Sampler, decode, decode_stream
+from .kv import KVPool
+
+SCRIPT = (
+    "<thought>Let me think about it.</thought>\n"
+    "<action>List files</action>\n"
+    "```python\nimport os\nprint(os.listdir('.'))\n```"
+)
+
+
+def _prompt(tokenizer, question="What's in here?"):
+    conversation = [{"role": "user", "content": question}]
+    return tokenizer.apply_chat_template(conversation, add_generation_prompt=True)
+
+
+def _decode(
+    tokenizer, model, prompts, jump_forward, sampler=None, max_new_tokens=200, kv_pool=None
+):
+    stats = DecodeStats()
+    outputs = decode(
+        model,
+        prompts,
+        enforcer=StructuredEnforcer(tokenizer),
+        sampler=sampler or Sampler(),
+        max_new_tokens=max_new_tokens,
+        stop_token_ids={tokenizer.eos_token_id},
+        pad_token_id=tokenizer.pad_token_id,
+        jump_forward=jump_forward,
+        stats=stats,
+        kv_pool=kv_pool,
+    )
+    return [tokenizer.decode(o) for o in outputs], stats
+
+
+def test_jump_forward_same_text_fewer_passes(tiny_tokenizer, scripted_lm):
+    prompts = [_prompt(tiny_tokenizer)]
+    step_texts, step_stats = _decode(tiny_tokenizer, scripted_lm(SCRIPT), prompts, False)
+    jump_texts, jump_stats = _decode(tiny_tokenizer, scripted_lm(SCRIPT), prompts, True)
+
+    assert step_texts == jump_texts == [SCRIPT + "\n<|im_end|>"]
+    assert step_stats.n_generated == jump_stats.n_generated
+    assert jump_stats.n_jumped > 0
+    assert jump_stats.n_forward == step_stats.n_forward - jump_stats.n_jumped
+
+
+def test_jump_forward_real_model(tiny_tokenizer, tiny_llama):
+    """Same output on an actual transformer, with its KV cache, greedy or sampled."""
+    prompts = [_prompt(tiny_tokenizer)]
+    for sampler in [Sampler(), Sampler(do_sample=True, temperature=0.7, top_k=20, top_p=0.9)]:
+        outputs = []
+        for jump_forward in [False, True]:
+            torch.manual_seed(0)
+            outputs.append(
+                _decode(tiny_tokenizer, tiny_llama, prompts, jump_forward, sampler, 30)
+            )
+        (step_texts, step_stats), (jump_texts, jump_stats) = outputs
+        assert step_texts == jump_texts
+        assert step_texts[0].startswith("<thought>")
+        assert jump_stats.n_forward < step_stats.n_forward
+
+
+def test_batch_rows_finish_independently(tiny_tokenizer, scripted_lm):
+    """Rows of different lengths: the shorter one stops, the other goes on."""
+    short_script = "<thought>Hi!</thought>\n<action>Nothing</action>\n```python\n1\n```"
+    model = scripted_lm(lambda prompt: short_script if "Hi" in prompt else SCRIPT)
+    prompts = [_prompt(tiny_tokenizer, "Hi"), _prompt(tiny_tokenizer, "A longer question?")]
+
+    for jump_forward in [False, True]:
+        texts, _ = _decode(tiny_tokenizer, model, prompts, jump_forward)
+        assert texts == [short_script + "\n<|im_end|>", SCRIPT + "\n<|im_end|>"]
+
+    # Enough for the short one only.
+    texts, _ = _decode(tiny_tokenizer, model, prompts, True, max_new_tokens=33)
+    assert texts[0] == short_script + "\n<|im_end|>"
+    assert SCRIPT.startswith(texts[1]) and texts[1] != SCRIPT
+
+
+def test_batch_matches_single(tiny_tokenizer, tiny_llama):
+    """Padding, holes in the KV cache and all: each row decodes as if it were alone."""
+    prompts = [_prompt(tiny_tokenizer, "Hi"), _prompt(tiny_tokenizer, "List the files, please.")]
+    for jump_forward in [False, True]:
+        batched, _ = _decode(tiny_tokenizer, tiny_llama, prompts, jump_forward, max_new_tokens=40)
+        single = [
+            _decode(tiny_tokenizer, tiny_llama, [p], jump_forward, max_new_tokens=40)[0][0]
+            for p in prompts
+        ]
+        assert batched == single
+
+
+def test_kv_pool_across_turns(tiny_tokenizer, tiny_llama):
+    """Next turn, then a rewind to an earlier point: same outputs as without the cache."""
+    cache = KVPool(block_size=4)
+    turn_1 = [{"role": "user", "content": "What's in here?"}]
+    text, _ = _decode(tiny_tokenizer, tiny_llama, [_prompt(tiny_tokenizer)], True, None, 30, cache)
+    turn_2 = turn_1 + [
+        {"role": "assistant", "content": text[0]},
+        {"role": "user", "content": "And now?"},
+    ]
+    rewound = turn_1 + [{"role": "assistant", "content": "Something else."}]
+
+    for conversation in [turn_2, rewound, turn_2]:
+        prompt = tiny_tokenizer.apply_chat_template(conversation, add_generation_prompt=True)
+        cached, stats = _decode(tiny_tokenizer, tiny_llama, [prompt], True, None, 30, cache)
+        fresh, _ = _decode(tiny_tokenizer, tiny_llama, [prompt], True, None, 30)
+        assert cached == fresh
+        assert stats.n_reused > 0
+
+
+def test_stream(tiny_tokenizer, scripted_lm):
+    """Steps add up to the full output; `<thought>` comes before any forward pass."""
+    model = scripted_lm(SCRIPT)
+    stats = DecodeStats()
+    steps = decode_stream(
+        model,
+        [_prompt(tiny_tokenizer)],
+        enforcer=StructuredEnforcer(tiny_tokenizer),
+        sampler=Sampler(),
+        max_new_tokens=200,
+        stop_token_ids={tiny_tokenizer.eos_token_id},
+        pad_token_id=tiny_tokenizer.pad_token_id,
+        stats=stats,
+    )
+    first = next(steps)
+    assert tiny_tokenizer.decode(first[0]) == "<thought>"
+    assert stats.n_forward == 0
+
+    tokens = first[0] + [t for step in steps for t in step[0]]
+    assert tiny_tokenizer.decode(tokens) == SCRIPT + "\n<|im_end|>"
+
+
+def test_stream_closed_early(tiny_tokenizer, tiny_llama):
+    """Stopping midway stops generation, and keeps what was computed for next time."""
+    pool = KVPool(block_size=4)
+    prompt = _prompt(tiny_tokenizer)
+    steps = decode_stream(
+        tiny_llama,
+        [prompt],
+        enforcer=StructuredEnforcer(tiny_tokenizer),
+        sampler=Sampler(),
+        max_new_tokens=30,
+        stop_token_ids={tiny_tokenizer.eos_token_id},
+        pad_token_id=tiny_tokenizer.pad_token_id,
+        kv_pool=pool,
+    )
+    partial = [t for _, step in zip(range(5), steps) for t in step[0]]
+    steps.close()
+
+    assert len(pool) == 1
+    texts, stats = _decode(tiny_tokenizer, tiny_llama, [prompt], True, None, 30, pool)
+    assert texts[0].startswith(tiny_tokenizer.decode(partial))
+    assert stats.n_reused > len(prompt)
+
+
+def test_rows_join_midway(tiny_tokenizer, tiny_llama):
+    """Continuous batching: whenever a row joins, and whoever leaves, it decodes as if alone."""
+    questions = ["Hi", "List the files, please.", "What's in here?"]
+    prompts = [_prompt(tiny_tokenizer, q) for q in questions]
+    single = [
+        _decode(tiny_tokenizer, tiny_llama, [p], True, max_new_tokens=30)[0][0] for p in prompts
+    ]
+
+    batch = BatchDecoder(
+        tiny_llama,
+        StructuredEnforcer(tiny_tokenizer),
+        Sampler(),
+        stop_token_ids={tiny_tokenizer.eos_token_id},
+        pad_token_id=tiny_tokenizer.pad_token_id,
+    )
+    rows = []
+    # Different budgets, so that rows leave at different steps.
+    for i, (prompt, max_new_tokens) in enumerate(zip(prompts, [10, 30, 30])):
+        rows.append(batch.add(prompt, max_new_tokens))
+        for _ in range(3 + i):
+            batch.step()
+    while batch.rows:
+        batch.step()
+
+    texts = [tiny_tokenizer.decode(row.generated) for row in rows]
+    assert texts[1:] == single[1:]
+    assert single[0].startswith(texts[0])
+
+
+def test_samples_share_prefill(tiny_tokenizer, tiny_llama):
+    prompt = _prompt(tiny_tokenizer)
+    (single,), _ = _decode(tiny_tokenizer, tiny_llama, [prompt], True, max_new_tokens=30)
+
+    def batch(sampler):
+        stats = DecodeStats()
+        batch = BatchDecoder(
+            tiny_llama,
+            StructuredEnforcer(tiny_tokenizer),
+            sampler,
+            stop_token_ids={tiny_tokenizer.eos_token_id},
+            pad_token_id=tiny_tokenizer.pad_token_id,
+            stats=stats,
+        )
+        rows = batch.add_samples(prompt, 30, 3)
+        batch.step()
+        # A single prefill.
+        assert stats.n_forward == 1
+        while batch.rows:
+            batch.step()
+        return [tiny_tokenizer.decode(row.generated) for row in rows]
+
+    # Greedy: each sample decodes as if alone, from its copy of the cache.
+    assert batch(Sampler()) == [single] * 3
+    torch.manual_seed(0)
+    assert len(set(batch(Sampler(do_sample=True)))) > 1
+
+
+def test_repetition_penalty(tiny_tokenizer, tiny_llama):
+    """Same as `model.generate`'s, from the mask of tokens seen, kept up to date step by step."""
+    from transformers import RepetitionPenaltyLogitsProcessor
+
+    sequences = [[3, 5, 5, 9], [7]]
+    scores = torch.randn((2, 20))
+    seen = torch.zeros((2, 20), dtype=torch.bool)
+    for i, sequence in enumerate(sequences):
+        seen[i, sequence] = True
+    expected = torch.cat([
+        RepetitionPenaltyLogitsProcessor(1.3)(torch.tensor([sequence]), scores[i : i + 1].clone())
+        for i, sequence in enumerate(sequences)
+    ])
+    assert torch.allclose(Sampler(repetition_penalty=1.3).penalize(seen, scores), expected)
+
+    # Through the decoding loop: same as `model.generate`, greedy, without the constraint.
+    prompt = _prompt(tiny_tokenizer)
+    (output,) = decode(
+        tiny_llama,
+        [prompt],
+        enforcer=None,
+        sampler=Sampler(repetition_penalty=1.3),
+        max_new_tokens=30,
+        stop_token_ids=set(),
+        pad_token_id=tiny_tokenizer.pad_token_id,
+    )
+    expected = tiny_llama.generate(
+        torch.tensor([prompt]),
+        max_new_tokens=30,
+        do_sample=False,
+        repetition_penalty=1.3,
+        pad_token_id=tiny_tokenizer.pad_token_id,
+    )[0, len(prompt) :]
+    assert output == expected.tolist()
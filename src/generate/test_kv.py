@@ -0,0 +1,138 @@
+import pytest
+import torch
+
+from .constrain import StructuredEnforcer
+from .decode import DecodeStats, Sampler, decode
+from .kv import KVPool, common_prefix_length, crop_past, past_nbytes
+
+
+def _generate(tokenizer, model, conversation, kv_pool=None):
+    prompt = tokenizer.apply_chat_template(conversation, add_generation_prompt=True)
+    stats = DecodeStats()
+    output = decode(
+        model,
+        [prompt],
+        enforcer=StructuredEnforcer(tokenizer),
+        sampler=Sampler(),
+        max_new_tokens=20,
+        stop_token_ids={tokenizer.eos_token_id},
+        pad_token_id=tokenizer.pad_token_id,
+        stats=stats,
+        kv_pool=kv_pool,
+    )[0]
+    return tokenizer.decode(output), stats
+
+
+def _totals(pool):
+    """Device and spilled bytes, counted from scratch."""
+    entries = pool._entries.values()
+    return (
+        sum(e.nbytes for e in entries if e.spilled is None),
+        sum(e.nbytes for e in entries if e.spilled is not None),
+    )
+
+
+def _sessions():
+    """Two sessions sharing a long system prompt, each a few turns long."""
+    system = [{"role": "system", "content": "You are a helpful assistant. " * 4}]
+    return [
+        system + [{"role": "user", "content": f"Session {name}: what's in here?"}]
+        for name in "AB"
+    ]
+
+
+@pytest.mark.parametrize("spill", [None, "cpu", "disk"])
+def test_sessions_interleaved(tiny_tokenizer, tiny_llama, tmp_path, spill):
+    """Flip between sessions, with room for a single one: same outputs as without the pool."""
+    sessions = _sessions()
+    # Measure an entry, to size the pool.
+    probe = KVPool()
+    _generate(tiny_tokenizer, tiny_llama, sessions[0], probe)
+    entry_bytes = probe.device_bytes
+
+    pool = KVPool(
+        max_bytes=int(entry_bytes * 2.5),
+        spill=tmp_path if spill == "disk" else spill,
+        block_size=8,
+    )
+    for turn in range(3):
+        for session in sessions:
+            cached, stats = _generate(tiny_tokenizer, tiny_llama, session, pool)
+            fresh, _ = _generate(tiny_tokenizer, tiny_llama, session)
+            assert cached == fresh
+            if turn > 0:
+                assert stats.n_reused > 0
+            session += [
+                {"role": "assistant", "content": cached},
+                {"role": "user", "content": f"Turn {turn}, go on."},
+            ]
+        assert pool.device_bytes <= pool.max_bytes
+        assert (pool.device_bytes, pool.spilled_bytes) == _totals(pool)
+
+    assert pool.stats.evictions > 0
+    assert pool.stats.hits >= 4
+    if spill is None:
+        assert pool.stats.restores == 0
+    else:
+        assert pool.stats.restores > 0
+        assert pool.spilled_bytes > 0
+    if spill == "disk":
+        assert list(tmp_path.glob("*.pt"))
+
+
+def test_shared_prefix_kept(tiny_tokenizer, tiny_llama):
+    """A partial hit reuses the shared prefix, and leaves the other session's entry alone."""
+    a, b = _sessions()
+    pool = KVPool(block_size=8)
+    _generate(tiny_tokenizer, tiny_llama, a, pool)
+    _, stats = _generate(tiny_tokenizer, tiny_llama, b, pool)
+
+    assert stats.n_reused > 0
+    assert len(pool) == 2
+    assert pool.stats.hits == 1 and pool.stats.misses == 1
+
+
+def test_shorter_than_a_block(tiny_tokenizer, tiny_llama):
+    """With the default block size, a cache shorter than a block gets reused too."""
+    pool = KVPool()
+    conversation = [{"role": "user", "content": "Hi"}]
+    response, _ = _generate(tiny_tokenizer, tiny_llama, conversation, pool)
+    (entry,) = pool._entries.values()
+    assert len(entry.token_ids) < pool.block_size
+
+    conversation += [
+        {"role": "assistant", "content": response},
+        {"role": "user", "content": "Go on."},
+    ]
+    cached, stats = _generate(tiny_tokenizer, tiny_llama, conversation, pool)
+    assert stats.n_reused > 0
+    assert pool.stats.hits == 1
+    assert cached == _generate(tiny_tokenizer, tiny_llama, conversation)[0]
+
+
+def test_common_prefix_length():
+    tokens = list(range(1000))
+    assert common_prefix_length(tokens, tokens + [0]) == 1000
+    assert common_prefix_length(tokens, tokens[:999] + [0]) == 999
+    assert common_prefix_length(tokens, [1] + tokens) == 0
+    assert common_prefix_length([], tokens) == 0
+    text = "line\n" * 100
+    assert common_prefix_length(text + "a", text + "b") == len(text)
+
+
+def test_cropped_nbytes():
+    """Cropping a cache doesn't free anything: its storage is what the pool holds on to."""
+    keys = torch.zeros((1, 2, 100, 4))
+    past = ((keys, keys.clone()),)
+    full = past_nbytes(past)
+    assert full == 2 * keys.numel() * keys.element_size()
+    # The same tensor twice counts once.
+    assert past_nbytes(((keys, keys),)) == full // 2
+
+    pool = KVPool(max_bytes=full * 3 // 2)
+    pool.store(list(range(10)), crop_past(past, 10))
+    assert pool.device_bytes == full
+    pool.store([7] * 10, crop_past(((keys.clone(), keys.clone()),), 10))
+    # Over budget, by storage: the first one is gone.
+    assert len(pool) == 1
+    assert pool.take(list(range(10)) + [0]) == (None, 0)
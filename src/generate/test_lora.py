@@ -0,0 +1,124 @@
+import pytest
+
+from .constrain import StructuredEnforcer
+from .decode import BatchDecoder, Sampler
+from .kv import KVPool
+from .lora import BASE, Adapters
+
+SCRIPT = "<thought>Hi!</thought>\n<action>Nothing</action>\n```python\n1\n```"
+
+
+class LoggedAdapters(Adapters):
+    """Keeps track of what gets loaded, in place of loading anything with PEFT."""
+
+    def __init__(self, model, **kwargs):
+        super().__init__(model, **kwargs)
+        self.log = []
+
+    def _load(self, name, path):
+        self.log.append(("load", name))
+        self._peft = self.base
+        self._loaded[name] = None
+
+    def _unload(self, name):
+        self.log.append(("unload", name))
+        del self._loaded[name]
+
+
+class AdapterNames:
+    """Wraps a model, to record the `adapter_names` of each call."""
+
+    def __init__(self, model):
+        self.model = model
+        self.device = model.device
+        self.calls = []
+
+    def __call__(self, adapter_names=None, **kwargs):
+        self.calls.append(adapter_names)
+        return self.model(**kwargs)
+
+    forward = __call__
+
+
+def _adapters(tmp_path, names, **kwargs) -> LoggedAdapters:
+    for name in names:
+        (tmp_path / name / "lora").mkdir(parents=True)
+        (tmp_path / name / "lora" / "adapter_config.json").write_text("{}")
+    adapters = LoggedAdapters(kwargs.pop("model", None), **kwargs)
+    assert adapters.discover(f"{tmp_path}/*/lora") == sorted(names)
+    return adapters
+
+
+def test_lru(tmp_path):
+    adapters = _adapters(tmp_path, ["a", "b", "c"], max_loaded=2)
+    with pytest.raises(KeyError):
+        adapters.acquire("nope")
+    with pytest.raises(ValueError):
+        adapters.register("d", str(tmp_path))
+
+    adapters.acquire("a")
+    adapters.acquire("b")
+    adapters.acquire("a")
+    adapters.acquire("c")
+    # `b` was the least recently used.
+    assert adapters.loaded == ["a", "c"]
+    # In use: stays loaded, even beyond the limit.
+    adapters.acquire("b", in_use={"a", "c"})
+    assert adapters.loaded == ["a", "c", "b"]
+    assert adapters.log == [("load", "a"), ("load", "b"), ("load", "c"), ("unload", "b"), ("load", "b")]
+
+
+def test_register_again(tmp_path):
+    adapters = _adapters(tmp_path, ["a"])
+    adapters.acquire("a")
+    adapters.register("a", str(tmp_path / "a" / "lora"))
+    # Still in use: the new version waits.
+    adapters.acquire("a", in_use={"a"})
+    assert adapters.log == [("load", "a")]
+    adapters.acquire("a")
+    assert adapters.log == [("load", "a"), ("unload", "a"), ("load", "a")]
+
+
+def test_register_while_loading(tmp_path):
+    adapters = _adapters(tmp_path, ["a"])
+    load = adapters._load
+    # A new version comes in while the previous one is loading.
+    adapters._load = lambda name, path: (adapters.register(name, path), load(name, path))
+    adapters.acquire("a")
+    adapters._load = load
+    adapters.acquire("a", in_use={"a"})
+    assert adapters.log == [("load", "a")]
+    adapters.acquire("a")
+    assert adapters.log == [("load", "a"), ("unload", "a"), ("load", "a")]
+
+
+def test_rows_with_adapters(tmp_path, tiny_tokenizer, scripted_lm):
+    model = AdapterNames(scripted_lm(SCRIPT))
+    adapters = _adapters(tmp_path, ["a", "b"], model=model)
+    pool = KVPool(block_size=4)
+    batch = BatchDecoder(
+        model,
+        StructuredEnforcer(tiny_tokenizer),
+        Sampler(),
+        stop_token_ids={tiny_tokenizer.eos_token_id},
+        pad_token_id=tiny_tokenizer.pad_token_id,
+        kv_pool=pool,
+        adapters=adapters,
+    )
+    prompt = tiny_tokenizer.apply_chat_template(
+        [{"role": "user", "content": "Hi"}], add_generation_prompt=True
+    )
+    with pytest.raises(KeyError):
+        batch.add(prompt, 100, "nope")
+    rows = [batch.add(prompt, 100, adapter) for adapter in [None, "a", "b"]]
+    while batch.rows:
+        batch.step()
+
+    for row in rows:
+        assert tiny_tokenizer.decode(row.generated) == SCRIPT + "\n<|im_end|>"
+    # One prefill per row, then the whole batch at once.
+    assert model.calls[:4] == [[BASE], ["a"], ["b"], [BASE, "a", "b"]]
+    # Caches are kept apart: a cache from an adapter is no good to another.
+    assert len(pool) == 3
+    assert pool.take(rows[1].sequence, namespace="c") == (None, 0)
+    assert pool.take(rows[1].sequence, namespace="b")[1] > 0
@@ -0,0 +1,201 @@
+import copy
+
+import pytest
+import torch
+from transformers import PreTrainedTokenizerFast
+
+from .constrain import RowConstraint, State, StructuredEnforcer
+from .decode import DecodeStats, Sampler, decode
+from .speculate import DraftModel, NgramIndex, PromptLookup, check_tokenizers
+
+CODE = "import os\nfor name in sorted(os.listdir('.')):\n    print(name, os.path.getsize(name))"
+SCRIPT = (
+    "<thought>Same as before, sorted.</thought>\n"
+    "<action>List files with their sizes</action>\n"
+    f"```python\n{CODE}\n```"
+)
+
+
+def _prompt(tokenizer, question=f"What does this do?\n```python\n{CODE}\n```"):
+    conversation = [{"role": "user", "content": question}]
+    return tokenizer.apply_chat_template(conversation, add_generation_prompt=True)
+
+
+def _decode(
+    tokenizer, model, prompts, drafter, sampler=None, max_new_tokens=200, jump_forward=True
+):
+    stats = DecodeStats()
+    outputs = decode(
+        model,
+        prompts,
+        enforcer=StructuredEnforcer(tokenizer),
+        sampler=sampler or Sampler(),
+        max_new_tokens=max_new_tokens,
+        stop_token_ids={tokenizer.eos_token_id},
+        pad_token_id=tokenizer.pad_token_id,
+        jump_forward=jump_forward,
+        stats=stats,
+        drafter=drafter,
+    )
+    return [tokenizer.decode(o) for o in outputs], stats
+
+
+def test_ngram_index():
+    index = NgramIndex(max_ngram=2)
+    index.update([1, 2, 3, 1, 2])
+    assert index.find([1, 2]) == 2
+    assert index.find([2]) == 2
+    # The latest n-gram isn't followed by anything yet.
+    assert index.find([2, 3, 1, 2]) == -1
+
+    index.update([1, 2, 3, 1, 2, 4])
+    assert index.find([1, 2]) == 5
+    assert index.find([5]) == -1
+
+
+def test_prompt_lookup_fewer_passes(tiny_tokenizer, scripted_lm):
+    """Copying code from the prompt: same text, several tokens per forward pass."""
+    prompts = [_prompt(tiny_tokenizer)]
+    texts, stats = _decode(tiny_tokenizer, scripted_lm(SCRIPT), prompts, None)
+    spec_texts, spec_stats = _decode(tiny_tokenizer, scripted_lm(SCRIPT), prompts, PromptLookup())
+
+    assert texts == spec_texts == [SCRIPT + "\n<|im_end|>"]
+    assert spec_stats.n_generated == stats.n_generated
+    assert spec_stats.n_accepted > 0
+    assert 0 < spec_stats.acceptance_rate <= 1
+    assert spec_stats.n_forward < stats.n_forward
+    assert spec_stats.tokens_per_forward > stats.tokens_per_forward
+
+
+def test_prompt_lookup_batch(tiny_tokenizer, scripted_lm):
+    """Rows accept different numbers of guesses; each gets its own response."""
+    short_script = "<thought>Hi!</thought>\n<action>Nothing</action>\n```python\n1\n```"
+    model = scripted_lm(lambda prompt: short_script if "Hi" in prompt else SCRIPT)
+    prompts = [_prompt(tiny_tokenizer, "Hi"), _prompt(tiny_tokenizer)]
+    texts, _ = _decode(tiny_tokenizer, model, prompts, None)
+    spec_texts, spec_stats = _decode(tiny_tokenizer, model, prompts, PromptLookup())
+    assert spec_texts == texts
+    assert spec_stats.n_accepted > 0
+
+
+def test_prompt_lookup_real_model(tiny_tokenizer, tiny_llama):
+    """On an actual transformer, rejected guesses leave holes in the KV cache: same output."""
+    prompts = [_prompt(tiny_tokenizer), _prompt(tiny_tokenizer, "Hi")]
+    # Guess from unigrams, so that there's something to reject.
+    drafter = PromptLookup(min_ngram=1)
+    for sampler in [Sampler(), Sampler(repetition_penalty=1.3)]:
+        texts, _ = _decode(tiny_tokenizer, tiny_llama, prompts, None, sampler, 40)
+        spec_texts, spec_stats = _decode(
+            tiny_tokenizer, tiny_llama, prompts, drafter, sampler, 40
+        )
+        assert spec_texts == texts
+        assert spec_stats.n_drafted > spec_stats.n_accepted
+
+
+def test_prompt_lookup_sampling(tiny_tokenizer, tiny_llama):
+    """Sampling still works; the output follows the constraint."""
+    torch.manual_seed(0)
+    sampler = Sampler(do_sample=True, temperature=0.7, top_k=20, top_p=0.9)
+    prompts = [_prompt(tiny_tokenizer)]
+    texts, _ = _decode(tiny_tokenizer, tiny_llama, prompts, PromptLookup(min_ngram=1), sampler, 30)
+    assert texts[0].startswith("<thought>")
+
+
+def _draft_model(tokenizer, model, n_draft=4):
+    return DraftModel(model, tokenizer, {tokenizer.eos_token_id}, n_draft=n_draft)
+
+
+def test_draft_model_agrees(tiny_tokenizer, tiny_llama):
+    """A draft model that happens to be the main one: every guess is right."""
+    prompts = [_prompt(tiny_tokenizer), _prompt(tiny_tokenizer, "Hi")]
+    texts, stats = _decode(tiny_tokenizer, tiny_llama, prompts, None, max_new_tokens=40)
+    drafter = _draft_model(tiny_tokenizer, tiny_llama)
+    spec_texts, spec_stats = _decode(
+        tiny_tokenizer, tiny_llama, prompts, drafter, max_new_tokens=40
+    )
+
+    assert spec_texts == texts
+    assert spec_stats.n_drafted > 0
+    assert spec_stats.n_accepted == spec_stats.n_drafted
+    assert spec_stats.n_forward < stats.n_forward
+
+
+def test_draft_model_disagrees(tiny_tokenizer, tiny_llama, scripted_lm):
+    """A draft model that's mostly wrong: same output, its guesses rejected."""
+    model = scripted_lm(SCRIPT)
+    prompts = [_prompt(tiny_tokenizer)]
+    texts, _ = _decode(tiny_tokenizer, model, prompts, None)
+    spec_texts, spec_stats = _decode(
+        tiny_tokenizer, model, prompts, _draft_model(tiny_tokenizer, tiny_llama)
+    )
+    assert spec_texts == texts == [SCRIPT + "\n<|im_end|>"]
+    assert spec_stats.n_accepted < spec_stats.n_drafted
+
+
+def test_draft_model_constrained(tiny_tokenizer, scripted_lm):
+    """
+    The draft model follows the constraint too. Left to itself, this one would only guess EOS;
+    constrained, it gets forced tokens right.
+    """
+    drafter = _draft_model(tiny_tokenizer, scripted_lm(""))
+    spec_texts, spec_stats = _decode(
+        tiny_tokenizer, scripted_lm(SCRIPT), [_prompt(tiny_tokenizer)], drafter, jump_forward=False
+    )
+    assert spec_texts == [SCRIPT + "\n<|im_end|>"]
+    assert spec_stats.n_accepted > 0
+
+
+def test_forked_constraint(tiny_tokenizer):
+    """Wherever the response is at, a fork goes on exactly as a full copy would."""
+    # What the model writes; the constraint forces the rest.
+    written = tiny_tokenizer.encode(
+        f"Same as before.</thought>List files</action>{CODE}\n```", add_special_tokens=False
+    )
+
+    def replay(constraint, n_steps=None):
+        """States, and forced tokens, at each step."""
+        trace = []
+        while written[constraint.n_written :] and len(trace) != n_steps:
+            forced = constraint.next_forced()
+            trace.append((constraint.state, forced))
+            if forced is None:
+                forced = written[constraint.n_written]
+                constraint.n_written += 1
+            constraint.push(forced)
+        return trace
+
+    full = replay(_Constraint(tiny_tokenizer))
+    assert full[-1][0] == State.CODE_CONTENT
+    for n_steps in range(len(full)):
+        constraint = _Constraint(tiny_tokenizer)
+        replay(constraint, n_steps)
+        deep = copy.deepcopy(constraint)
+        fork = constraint.fork()
+        assert replay(fork) == replay(deep) == full[n_steps:]
+        # The original is left as it was.
+        assert replay(constraint) == full[n_steps:]
+
+
+class _Constraint(RowConstraint):
+    """Keeps track of how much of the written tokens it was given, forks included."""
+
+    n_written = 0
+
+
+def test_check_tokenizers(tiny_tokenizer):
+    check_tokenizers(tiny_tokenizer, tiny_tokenizer)
+
+    other = PreTrainedTokenizerFast(
+        tokenizer_object=tiny_tokenizer.backend_tokenizer,
+        eos_token="<|im_end|>",
+        pad_token="<|endoftext|>",
+    )
+    other.add_tokens(["<extra>"])
+    with pytest.raises(ValueError, match="tokenizer"):
+        check_tokenizers(tiny_tokenizer, other)
+
+    other = PreTrainedTokenizerFast(
+        tokenizer_object=tiny_tokenizer.backend_tokenizer, eos_token="<|endoftext|>"
+    )
+    with pytest.raises(ValueError, match="EOS"):
+        check_tokenizers(tiny_tokenizer, other)
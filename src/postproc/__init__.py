@@ -3,12 +3,12 @@ Structured interpretation of LLM output.
 """
 
 import traceback
-from typing import List
+from dataclasses import dataclass
+from typing import List, Optional
 import re
-import markdown2
-from bs4 import BeautifulSoup
 
 from src.types import EventBody, AssistantThought, AssistantAction, CodeFragment
+from .fence import CodeBlockScanner, code_fence, code_start
 
 
 def extract_tag_content(text: str, tag: str) -> tuple[str, str]:
@@ -26,23 +26,67 @@ def extract_tag_content(text: str, tag: str) -> tuple[str, str]:
     return content, remaining
 
 
-def extract_code_from_markdown(md_text: str) -> str:
-    """Extract the one and only code block from markdown text."""
-    # Use markdown2 to parse the text
-    html = markdown2.markdown(md_text, extras=["fenced-code-blocks"])
-    soup = BeautifulSoup(html, "html.parser")
+@dataclass
+class CodeBlock:
+    """A fenced code block, as found by `find_code_block`."""
+
+    code: str
+    # Where `code` is in the text: `text[start:end] == code`.
+    start: int
+    end: int
+    # Where the closing fence's line ends.
+    fence_end: int
+
+
+def find_code_block(text: str) -> Optional[CodeBlock]:
+    """
+    The first complete code block in `text`, if any, in a single pass. Its code is verbatim:
+    see `normalize_code` for what `extract_code_from_markdown` returns.
+
+    Same rules as `StructuredEnforcer`: the block opens at the first `code_start`, and closes
+    at the first line that starts with `code_fence` (no leading whitespace), with nothing but
+    whitespace after it. That line may have no newline yet.
+    """
+    start = text.find(code_start)
+    if start == -1:
+        return None
+    start += len(code_start)
+    pos = start
+    while True:
+        eol = text.find("\n", pos)
+        if eol == -1:
+            eol = len(text)
+        if text.startswith(code_fence, pos) and not text[pos + len(code_fence) : eol].strip():
+            return CodeBlock(text[start:pos], start, pos, eol)
+        if eol == len(text):
+            return None
+        pos = eol + 1
 
-    # Find all code blocks
-    code_blocks = soup.find_all("code")
 
-    # Ensure there's exactly one
-    if not code_blocks:
+def normalize_code(code: str) -> str:
+    """
+    Code as `markdown2` gave it to us, before `find_code_block`; sessions were recorded that way.
+    Tabs are expanded, blank lines around the code dropped, and `&amp;`, `&lt;`, `&gt;` unescaped.
+    The code ends with a newline.
+    """
+    lines = re.split(r"\r\n?|\n", code)
+    # Whitespace-only lines count as blank: they end up empty.
+    lines = [line.expandtabs(4) if line.strip(" \t") else "" for line in lines]
+    code = "\n".join(lines).strip("\n") + "\n"
+    for entity, char in [("&amp;", "&"), ("&lt;", "<"), ("&gt;", ">")]:
+        code = code.replace(entity, char)
+    return code
+
+
+def extract_code_from_markdown(md_text: str) -> str:
+    """Extract the one and only code block from markdown text, normalized (see `normalize_code`)."""
+    block = find_code_block(md_text)
+    if block is None:
         raise ValueError("No code block found in markdown")
-    if len(code_blocks) > 1:
+    before = md_text[: block.start - len(code_start)]
+    if code_fence in before or code_fence in md_text[block.fence_end :]:
         raise ValueError("Multiple code blocks found in markdown")
-
-    # Return the content of the only code block
-    return code_blocks[0].get_text()
+    return normalize_code(block.code)
 
 
 def parse_constrained_message(text: str) -> List[EventBody]:
@@ -69,3 +113,87 @@ def parse_constrained_message(text: str) -> List[EventBody]:
         traceback.print_exc()
 
     return events
+
+
+class IncrementalMessageParser:
+    """
+    `parse_constrained_message`, for a response being generated: `feed` it text deltas, and it
+    returns the events whose section just closed. Each delta is only looked at once.
+
+    Sections come in the order `StructuredEnforcer` enforces: thought, action, code. Text
+    outside of them is ignored, as is anything after the code block. The code block closes
+    with its closing fence's newline, or with `close`: the enforcer stops right after the fence.
+    """
+
+    # What each state looks for, and the event the text up to it makes, if any.
+    _TAGS = [
+        ("<thought>", None),
+        ("</thought>", AssistantThought),
+        ("<action>", None),
+        ("</action>", AssistantAction),
+        (code_start, None),
+    ]
+
+    def __init__(self):
+        self.events: List[EventBody] = []
+        # Index in `_TAGS`; past them, in the code block.
+        self._state = 0
+        # The text of the current section, but the end that could be the start of its tag.
+        self._parts: List[str] = []
+        self._tail = ""
+        # Where the code block ends, as for the enforcer.
+        self._code = CodeBlockScanner()
+        self._code.feed(code_start)
+        self._done = False
+
+    def feed(self, delta: str) -> List[EventBody]:
+        n_events = len(self.events)
+        while delta and not self._done:
+            if self._state < len(self._TAGS):
+                delta = self._find_tag(delta)
+            else:
+                delta = self._scan_code(delta)
+        return self.events[n_events:]
+
+    def close(self) -> List[EventBody]:
+        """Once the response is complete: the code block, if its fence had no newline."""
+        n_events = len(self.events)
+        if not self._done and self._state == len(self._TAGS) and self._code.feed("")[1]:
+            self._emit_code()
+        if not self._done:
+            raise ValueError(f"Failed to parse constrained message: incomplete, got {self.events}")
+        return self.events[n_events:]
+
+    def _find_tag(self, delta: str) -> str:
+        """Look for the current state's tag. Returns what's left of `delta` once found."""
+        tag, event_type = self._TAGS[self._state]
+        text = self._tail + delta
+        loc = text.find(tag)
+        if loc == -1:
+            cut = max(0, len(text) - (len(tag) - 1))
+            if event_type is not None and cut:
+                self._parts.append(text[:cut])
+            self._tail = text[cut:]
+            return ""
+
+        if event_type is not None:
+            self._parts.append(text[:loc])
+            self.events.append(event_type("".join(self._parts).strip()))
+        self._parts = []
+        self._tail = ""
+        self._state += 1
+        return text[loc + len(tag) :]
+
+    def _scan_code(self, delta: str) -> str:
+        """Take in code. Returns `""`: anything after the block is ignored."""
+        self._parts.append(delta)
+        self._code.feed(delta)
+        if self._code.closed:
+            self._emit_code()
+        return ""
+
+    def _emit_code(self):
+        code = "".join(self._parts)[: self._code.line_start]
+        self.events.append(CodeFragment(normalize_code(code)))
+        self._parts = []
+        self._done = True
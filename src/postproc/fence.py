@@ -0,0 +1,113 @@
+"""
+Streaming counterpart to `get_code_block_status` (see `src.generate.constrain`).
+
+`get_code_block_status` looks at the whole text every time, which is quadratic when
+called at every decoding step. `CodeBlockScanner` is fed the same text, in pieces,
+and only ever looks at each character once.
+
+Both the enforcer, during generation, and `IncrementalMessageParser`, on what it generated,
+go by it: here, away from `torch`.
+"""
+
+from typing import Optional, Tuple
+
+# Verbatim start of a code block. This is a constant.
+code_start = "```python\n"
+
+code_fence = "```"
+
+
+class CodeBlockScanner:
+    """
+    Feed it text deltas with `feed`; it returns `(has_content, should_end)`,
+    exactly as `get_code_block_status` would on the concatenation of all deltas so far.
+
+    `should_end` may come from a last line that's still incomplete, e.g. a fence with no newline
+    yet; `closed` only once a complete line closed the block.
+    """
+
+    def __init__(self):
+        # Before the opening fence is found: the end of the text, in case the fence straddles two deltas.
+        self._tail = ""
+        self._in_block = False
+
+        # Whether any *complete* line of the block contains something else than whitespace.
+        self._has_content = False
+
+        # Once a complete line closes the block, the result can never change.
+        self._result: Optional[Tuple[bool, bool]] = None
+
+        # Where the current line starts, counting from the start of the block's body (after
+        # `code_start`). Once the block ends: where its closing fence is, i.e. where the code ends.
+        self.line_start = 0
+        self._body_len = 0
+
+        # The current, incomplete line. We only keep what we need to know about it:
+        # - its length;
+        # - whether its first (up to) three characters are backticks;
+        # - whether everything after those is whitespace;
+        # - whether it is all whitespace.
+        self._line_len = 0
+        self._line_fenced = True
+        self._line_tail_blank = True
+        self._line_blank = True
+
+    def feed(self, delta: str) -> Tuple[bool, bool]:
+        if self._result is not None:
+            return self._result
+
+        if not self._in_block:
+            text = self._tail + delta
+            loc = text.find(code_start)
+            if loc == -1:
+                self._tail = text[-(len(code_start) - 1) :]
+                return False, False
+
+            # Found: what follows is the body.
+            self._in_block = True
+            self._tail = ""
+            delta = text[loc + len(code_start) :]
+
+        for i, c in enumerate(delta):
+            if c == "\n":
+                if self._line_closes_block():
+                    self._result = (self._has_content, True)
+                    return self._result
+                if not self._line_blank:
+                    self._has_content = True
+                self._new_line()
+                self.line_start = self._body_len + i + 1
+                continue
+
+            blank = c.isspace()
+            if self._line_len < len(code_fence):
+                # No leading whitespace allowed!
+                self._line_fenced = self._line_fenced and c == "`"
+            elif not blank:
+                self._line_tail_blank = False
+            self._line_blank = self._line_blank and blank
+            self._line_len += 1
+        self._body_len += len(delta)
+
+        # The last line may be incomplete, but still counts.
+        if self._line_closes_block():
+            return self._has_content, True
+
+        return True, False
+
+    @property
+    def closed(self) -> bool:
+        return self._result is not None
+
+    def _line_closes_block(self) -> bool:
+        return (
+            self._line_len >= len(code_fence)
+            and self._line_fenced
+            and self._line_tail_blank
+        )
+
+    def _new_line(self):
+        self._line_len = 0
+        self._line_fenced = True
+        self._line_tail_blank = True
+        self._line_blank = True
@@ -0,0 +1,167 @@
+import glob
+import random
+
+import pytest
+
+from src.preproc import as_code_fences
+from . import (
+    IncrementalMessageParser,
+    extract_code_from_markdown,
+    extract_tag_content,
+    find_code_block,
+    normalize_code,
+    parse_constrained_message,
+)
+from .fence import CodeBlockScanner
+
+VALIDATED_SESSIONS = "data/sessions/validated/*.xml"
+
+# What code is made of, for comparisons with `markdown2`: whatever it would handle specially.
+_CODE_PIECES = [
+    "x", "ab", " ", "    ", "\t", "\n", "\r\n", "\r", "é", "'", '"', "`", "~~~", "*", "_", "\\", "#",
+    "- ", "1. ", "[a](b)", "<b>", "<", ">", "&", "&amp;", "&amp", "&lt;", "&gt;", "lt;", "&nbsp;",
+    "&#9;", "&#x41;", "&foo;", "\xa0",
+]
+
+
+@pytest.mark.parametrize(
+    "text,code",
+    [
+        ("```python\nprint(1)\n```", "print(1)\n"),
+        ("\n```python\nprint(1)\n```  \n", "print(1)\n"),
+        ("```python\nx = '<a>&amp;</a>'\n\tdef f():\n```", "x = '<a>&amp;</a>'\n\tdef f():\n"),
+        ("```python\ns = '''\n ```\n```py\n'''\n```\n", "s = '''\n ```\n```py\n'''\n"),
+        ("```python\nx\n", None),
+        ("```\nx\n```", None),
+    ],
+)
+def test_find_code_block(text, code):
+    block = find_code_block(text)
+    if code is None:
+        assert block is None
+        return
+    assert block.code == code == text[block.start : block.end]
+    assert text[block.end : block.fence_end].rstrip() == "```"
+
+
+@pytest.mark.parametrize(
+    "text,code",
+    [
+        ("```python\nprint(1)\n```", "print(1)\n"),
+        ("```python\n\nx=1\n\n```", "x=1\n"),
+        ("```python\n  \n  x\n \n  y  \n\t\n```", "  x\n\n  y  \n"),
+        ("```python\nif a:\n\tb\tc\n```", "if a:\n    b   c\n"),
+        ("```python\nx = '<a>&amp;</a>' &lt; &#9;\n```", "x = '<a>&</a>' < &#9;\n"),
+        ("```python\na\r\nb\n```", "a\nb\n"),
+        ("```python\n\n```", "\n"),
+    ],
+)
+def test_extract_code(text, code):
+    """Normalized as `markdown2` used to, so that code round-trips through `as_code_fences`."""
+    assert extract_code_from_markdown(text) == code
+    assert extract_code_from_markdown(as_code_fences(code)) == code
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_same_as_markdown(seed, random_text):
+    """Exactly the code that `markdown2` and `BeautifulSoup` used to extract."""
+    pytest.importorskip("markdown2")
+    pytest.importorskip("bs4")
+    pytest.importorskip("pygments")
+    from src.bench.fence import via_markdown
+
+    rng = random.Random(seed)
+    for _ in range(500):
+        code = random_text(rng, _CODE_PIECES)
+        before, after = rng.choice(["", "\n", "Hi\n"]), rng.choice(["", "\n", "  \n"])
+        text = f"{before}```python\n{code}\n```{after}"
+        assert extract_code_from_markdown(text) == via_markdown(text), repr(text)
+
+
+def test_one_block_only():
+    with pytest.raises(ValueError, match="No code block"):
+        extract_code_from_markdown("Nothing here.")
+    with pytest.raises(ValueError, match="Multiple"):
+        extract_code_from_markdown("```python\n1\n```\n```python\n2\n```")
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_same_as_enforcer(seed, random_text):
+    """A block is found exactly when `StructuredEnforcer` would have closed it."""
+    rng = random.Random(seed)
+    for _ in range(500):
+        text = random_text(rng)
+        _, should_end = CodeBlockScanner().feed(text)
+        assert (find_code_block(text) is not None) == should_end, repr(text)
+
+
+def test_validated_sessions():
+    """Same code as with `markdown2` and `BeautifulSoup`, on every validated response."""
+    pytest.importorskip("markdown2")
+    pytest.importorskip("bs4")
+    from src.bench.fence import via_markdown
+    from src.persist.load import session_from_file
+    from src.preproc import session_to_chatml
+
+    # Without Git LFS, these are pointers.
+    paths = [p for p in glob.glob(VALIDATED_SESSIONS) if not open(p).read().startswith("version ")]
+    if not paths:
+        pytest.skip("No validated sessions")
+    n_checked = 0
+    for path in paths:
+        for msg in session_to_chatml(session_from_file(path)):
+            if msg["role"] != "assistant":
+                continue
+            _, remaining = extract_tag_content(msg["content"], "thought")
+            _, remaining = extract_tag_content(remaining, "action")
+            remaining = remaining.strip()
+            assert extract_code_from_markdown(remaining) == via_markdown(remaining)
+            n_checked += 1
+    assert n_checked
+
+
+def test_incremental_parser():
+    text = "<thought>Let me <b>see</b>.</thought>\n<action>List</action>\n```python\ns = '''\n ```\n'''\n```\n"
+    # Where each section closes.
+    ends = [text.index("</thought>") + 10, text.index("</action>") + 9, len(text)]
+    rng = random.Random(0)
+    for _ in range(100):
+        parser = IncrementalMessageParser()
+        events, pos = [], 0
+        while pos < len(text):
+            n = rng.randint(1, 8)
+            new_events = parser.feed(text[pos : pos + n])
+            # As soon as their section closes.
+            assert len(new_events) == sum(pos < end <= pos + n for end in ends)
+            pos += n
+            events += new_events
+        assert parser.close() == []
+        assert events == parser.events == parse_constrained_message(text)
+
+    # The enforcer stops right after the fence: no newline.
+    parser = IncrementalMessageParser()
+    assert len(parser.feed(text.removesuffix("\n"))) == 2
+    assert parser.close() == parse_constrained_message(text)[2:]
+    with pytest.raises(ValueError):
+        IncrementalMessageParser().close()
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_incremental_parser_code(seed, random_text):
+    """Whatever the text, and however it comes, the same code as `find_code_block`, if any."""
+    rng = random.Random(seed)
+    for _ in range(500):
+        text = "<thought>Hi</thought>\n<action>Go</action>\n" + random_text(rng)
+        block = find_code_block(text)
+        parser = IncrementalMessageParser()
+        pos = 0
+        while pos < len(text):
+            n = rng.randint(1, 8)
+            parser.feed(text[pos : pos + n])
+            pos += n
+        if block is None:
+            with pytest.raises(ValueError):
+                parser.close()
+        else:
+            parser.close()
+            assert parser.events[2].code == normalize_code(block.code), repr(text)
@@ -3,9 +3,10 @@ At any given point, a session can be flattened into a list of ChatML messages,
 applying any appropriate rewriting transformations.
 """
 
-from typing import List
+import hashlib
 import traceback
-from typing import Optional
+from collections import OrderedDict
+from typing import List, Optional
 from src.types.chatml import Conversation, Msg as ChatMLMsg, NormalRole
 from src.types import (
     Session,
@@ -89,15 +90,56 @@ def ensure_consistency(conv: Conversation):
             )
 
 
-def validate_flattened_assistant_msg(msg: ChatMLMsg):
-    """Validate assistant message structure."""
+class ValidatedMessages:
+    """
+    Assistant messages known to be valid, by hash of their content: flattening a session
+    again only parses what's new. Remembers the `max_entries` most recently validated.
+    """
+
+    def __init__(self, max_entries: int = 16384):
+        self.max_entries = max_entries
+        self._digests: OrderedDict[bytes, None] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._digests)
+
+    def __contains__(self, content: str) -> bool:
+        digest = _digest(content)
+        if digest not in self._digests:
+            return False
+        self._digests.move_to_end(digest)
+        return True
+
+    def add(self, content: str):
+        self._digests[_digest(content)] = None
+        if len(self._digests) > self.max_entries:
+            self._digests.popitem(last=False)
+
+
+def _digest(content: str) -> bytes:
+    return hashlib.blake2b(content.encode(), digest_size=16).digest()
+
+
+# Shared by all sessions: the same messages come back, turn after turn.
+VALIDATED = ValidatedMessages()
+
+
+def validate_flattened_assistant_msg(
+    msg: ChatMLMsg, validated: Optional[ValidatedMessages] = VALIDATED
+):
+    """Validate assistant message structure. Skipped if already `validated`, `None` to force it."""
+    content = msg["content"]
+    if validated is not None and content in validated:
+        return
     try:
-        parse_constrained_message(msg["content"])
+        parse_constrained_message(content)
     except Exception as e:
         traceback.print_exc()
         raise ValueError(
             f"Assistant message validation failed:\nContent: {msg['content']}\nError: {str(e)}"
         )
+    if validated is not None:
+        validated.add(content)
 
 
 def session_to_chatml(session: Session) -> Conversation:
@@ -105,38 +147,9 @@ def session_to_chatml(session: Session) -> Conversation:
     system_msg: ChatMLMsg = {"role": "system", "content": DEFAULT_SYSTEM_PROMPT}
     conv: Conversation = [system_msg]
 
-    prev_role: Optional[NormalRole] = None
-    cut_off_index = None
-
-    for i, session_event in enumerate(session.events):
-        event = session_event.body
-        if isinstance(event, ResumeFrom):
-            cut_off_index = _find_event_index_by_id(session.events, event.from_event_id)
-            if cut_off_index is not None:
-                print(
-                    f"ResumeFrom found, cutting history after event id: {event.from_event_id} at index {cut_off_index}"
-                )
-                session.events = session.events[: cut_off_index + 1]
-                break
-            else:
-                print(
-                    f"Warning: ResumeFrom refers to unknown event id: {event.from_event_id}. Ignoring."
-                )
-                continue
-
-    for session_event in session.events:
-        event = session_event.body
-        role = event_source_role(event)
-        new_text: str = event_to_plaintext(event)
-
-        if prev_role == role:
-            prev_msg: ChatMLMsg = conv[-1]
-            prev_msg["content"] += "\n" + new_text
-            continue
-
-        msg: ChatMLMsg = {"role": role, "content": new_text}
-        prev_role = role
-        conv.append(msg)
+    for indices in active_branch(session):
+        for i in indices:
+            _append_event(conv, session.events[i].body)
 
     ensure_consistency(conv)
 
@@ -147,11 +160,114 @@ def session_to_chatml(session: Session) -> Conversation:
     return conv
 
 
-def _find_event_index_by_id(
-    session_events: List[SessionEvent], event_id: str
-) -> Optional[int]:
-    """Find event index by ID."""
-    for index, session_event in enumerate(session_events):
-        if session_event.event_id == event_id:
-            return index
-    return None
+def active_branch(session: Session, end: Optional[int] = None) -> List[range]:
+    """
+    The events the conversation goes through, as ranges of indices into `session.events`,
+    up to `end`.
+
+    `ResumeFrom` takes the conversation back to right after an earlier event: the events in
+    between are an abandoned branch, skipped but kept. Nothing is copied or removed.
+    """
+    events = session.events
+    end = len(events) if end is None else end
+    branch: List[range] = []
+    start = 0
+    for i in range(end):
+        event = events[i].body
+        if not isinstance(event, ResumeFrom):
+            continue
+        branch.append(range(start, i))
+        start = i + 1
+        target = session.index_of(event.from_event_id)
+        if target is None or target >= i:
+            print(f"Warning: ResumeFrom refers to unknown event id: {event.from_event_id}. Ignoring.")
+            continue
+        branch = _cut_after(branch, target) or active_branch(session, target + 1)
+    branch.append(range(start, end))
+    return [indices for indices in branch if indices]
+
+
+def _cut_after(branch: List[range], index: int) -> List[range]:
+    """The branch, up to `index` included. Empty if `index` isn't on it."""
+    for i, indices in enumerate(branch):
+        if index in indices:
+            return branch[:i] + [range(indices.start, index + 1)]
+    return []
+
+
+class IncrementalChatML:
+    """
+    `session_to_chatml` for a session that keeps growing: each call only formats, merges and
+    validates the events added since the previous one.
+
+    Events are expected to be appended only. When they aren't (events removed or replaced,
+    a new `ResumeFrom`...), the conversation is rebuilt from scratch.
+    """
+
+    def __init__(self, session: Session):
+        self.session = session
+        self._conv: Conversation = []
+        # The list of events consumed so far, how many, and the last one: to tell appends apart.
+        self._events: Optional[List[SessionEvent]] = None
+        self._n_events = 0
+        self._last: Optional[SessionEvent] = None
+
+    def conversation(self) -> Conversation:
+        """Same as `session_to_chatml(self.session)`."""
+        events = self.session.events
+        if not self._appended_to(events):
+            return self._rebuild()
+        new_events = events[self._n_events :]
+        if any(isinstance(e.body, ResumeFrom) for e in new_events):
+            return self._rebuild()
+
+        conv = self._conv
+        # New messages, and the last one if new events are merged into it.
+        start = len(conv)
+        if new_events and event_source_role(new_events[0].body) == conv[-1]["role"]:
+            start -= 1
+        try:
+            for session_event in new_events:
+                _append_event(conv, session_event.body)
+            ensure_consistency(conv[start - 1 :])
+            for msg in conv[start:]:
+                if msg["role"] == "assistant":
+                    validate_flattened_assistant_msg(msg)
+        except Exception:
+            # Half updated: start over next time.
+            self._events = None
+            raise
+        self._consumed(events)
+        return [dict(msg) for msg in conv]
+
+    def _appended_to(self, events: List[SessionEvent]) -> bool:
+        return (
+            events is self._events
+            and len(events) >= self._n_events
+            and (self._n_events == 0 or events[self._n_events - 1] is self._last)
+        )
+
+    def _rebuild(self) -> Conversation:
+        self._events = None
+        self._conv = session_to_chatml(self.session)
+        self._consumed(self.session.events)
+        return [dict(msg) for msg in self._conv]
+
+    def _consumed(self, events: List[SessionEvent]):
+        self._events = events
+        self._n_events = len(events)
+        self._last = events[-1] if events else None
+
+
+def _append_event(conv: Conversation, event: EventBody):
+    """Append an event to the conversation: a new message, or more of the last one if same role."""
+    role = event_source_role(event)
+    new_text: str = event_to_plaintext(event)
+
+    if conv[-1]["role"] == role:
+        prev_msg: ChatMLMsg = conv[-1]
+        prev_msg["content"] += "\n" + new_text
+        return
+
+    msg: ChatMLMsg = {"role": role, "content": new_text}
+    conv.append(msg)
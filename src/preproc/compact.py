@@ -0,0 +1,241 @@
+"""
+Fitting a conversation into the model's context window.
+
+`session_to_chatml` keeps everything, execution outputs verbatim. Long sessions end up
+over the window, or spend most of the prefill on stale outputs. Given a token budget,
+`compact` frees space, least valuable first:
+1. old execution outputs are truncated to their head and tail, more and more aggressively;
+2. superseded code (rerun as is, retried after an error, or redefined) is elided;
+3. the oldest turns are dropped, the first user message (the task) excepted;
+4. as a last resort, recent outputs are truncated too.
+
+Nothing changes when the conversation already fits: the prompt stays a prefix of the next
+turn's, and its KV cache can be reused.
+
+Token counts are cached per message content: planning the next turn only tokenizes what's new.
+"""
+
+import ast
+import re
+from collections import OrderedDict
+from typing import List, Optional, Set
+
+from src.types.chatml import Conversation, Msg
+
+# Execution results, as formatted by `as_output_block` and `as_error_block`.
+OUTPUT_RE = re.compile(r"<(output|error)>(.*?)</\1>", re.DOTALL)
+# Code blocks, as formatted by `as_code_fences`.
+CODE_RE = re.compile(r"```python\n(.*?)\n```", re.DOTALL)
+# Where `truncate_middle` cut.
+TRUNCATED_RE = re.compile(r"\[\.\.\. (\d+) characters truncated \.\.\.\]\n")
+# First line of an exception, as formatted by `LLMFormatter`: `NameError: ...`.
+EXCEPTION_RE = re.compile(r"^\w*(Error|Exception|Interrupt|Exit)\b.*:", re.MULTILINE)
+
+# Successive limits, in characters, for old execution outputs.
+OUTPUT_LIMITS = (2000, 500, 100)
+ELIDED_CODE = "# (elided: superseded by later code)"
+
+
+class TokenCounter:
+    """
+    Token counts of messages, template overhead included.
+    Cached by content, for the `max_entries` most recently counted messages.
+    """
+
+    def __init__(self, tokenizer, max_entries: int = 4096):
+        self.tokenizer = tokenizer
+        self.max_entries = max_entries
+        self._counts: OrderedDict[str, int] = OrderedDict()
+        self._overhead: Optional[int] = None
+
+    def count(self, msg: Msg) -> int:
+        content = msg["content"]
+        n = self._counts.get(content)
+        if n is None:
+            n = len(self.tokenizer.encode(content, add_special_tokens=False))
+            self._counts[content] = n
+            if len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+        else:
+            self._counts.move_to_end(content)
+        return n + self.overhead
+
+    def total(self, conversation: Conversation) -> int:
+        """For the whole prompt, generation prompt included (about one message's overhead)."""
+        return sum(self.count(msg) for msg in conversation) + self.overhead
+
+    @property
+    def overhead(self) -> int:
+        """Tokens the chat template adds around each message: role headers, separators..."""
+        if self._overhead is None:
+            self._overhead = self._measure_overhead()
+        return self._overhead
+
+    def _measure_overhead(self) -> int:
+        question = {"role": "user", "content": "Hi"}
+        answer = {"role": "assistant", "content": "Hello"}
+        try:
+            one = self.tokenizer.apply_chat_template([question])
+            two = self.tokenizer.apply_chat_template([question, answer])
+        except Exception:
+            # No usable template: a reasonable guess for ChatML-like formats.
+            return 8
+        n_content = len(self.tokenizer.encode(answer["content"], add_special_tokens=False))
+        return max(len(two) - len(one) - n_content, 0)
+
+
+def truncate_middle(text: str, max_chars: int) -> str:
+    """
+    Keep the head and tail of `text`, cut at line boundaries if possible.
+    Text it already truncated is only cut further if what's left is over `max_chars`, under
+    a single marker counting all that's gone.
+    """
+    if (m := TRUNCATED_RE.search(text)) is not None:
+        before, after, n_cut = text[: m.start()], text[m.end() :], int(m[1])
+        n_kept = len(before) + len(after)
+    else:
+        before, after, n_cut, n_kept = text, text, 0, len(text)
+    if n_kept <= max_chars:
+        return text
+    half = max_chars // 2
+    head, tail = before[:half], after[len(after) - half :]
+    # Whole lines, unless a single line is longer than what we keep.
+    if (newline := head.rfind("\n")) > 0:
+        head = head[: newline + 1]
+    if 0 <= (newline := tail.find("\n")) < len(tail) - 1:
+        tail = tail[newline + 1 :]
+    n_cut += n_kept - len(head) - len(tail)
+    return f"{head}[... {n_cut} characters truncated ...]\n{tail}"
+
+
+def truncate_outputs(content: str, max_chars: int) -> str:
+    return OUTPUT_RE.sub(
+        lambda m: f"<{m[1]}>{truncate_middle(m[2], max_chars)}</{m[1]}>", content
+    )
+
+
+def compact(
+    conversation: Conversation, budget: int, counter: TokenCounter, keep_last: int = 2
+) -> Conversation:
+    """
+    A version of `conversation` that fits in `budget` tokens, if possible.
+    The last `keep_last` messages are only touched as a last resort.
+    Returns a new list; messages are never modified in place.
+    """
+    conv = list(conversation)
+    if counter.total(conv) <= budget:
+        return conv
+
+    def fits() -> bool:
+        return counter.total(conv) <= budget
+
+    def replace(i: int, content: str):
+        conv[i] = {"role": conv[i]["role"], "content": content}
+
+    # 1. Old outputs: head and tail.
+    for limit in OUTPUT_LIMITS:
+        for i in range(len(conv) - keep_last):
+            content = truncate_outputs(conv[i]["content"], limit)
+            if content != conv[i]["content"]:
+                replace(i, content)
+                if fits():
+                    return conv
+
+    # 2. Superseded code.
+    for i in range(len(conv) - keep_last):
+        if conv[i]["role"] != "assistant":
+            continue
+        content = _elide_superseded_code(conv, i)
+        if content != conv[i]["content"]:
+            replace(i, content)
+            if fits():
+                return conv
+
+    # 3. Oldest turns, an assistant message and the user message after it at a time,
+    # so that roles keep alternating.
+    first_user = next((i for i, msg in enumerate(conv) if msg["role"] == "user"), None)
+    if first_user is not None:
+        task = conv[first_user]["content"]
+        n_dropped = 0
+        while not fits() and len(conv) - (first_user + 3) >= keep_last:
+            del conv[first_user + 1 : first_user + 3]
+            n_dropped += 2
+            replace(
+                first_user,
+                f"{task}\n\n[{n_dropped} earlier messages omitted to fit the context window]",
+            )
+        if fits():
+            return conv
+
+    # 4. Recent outputs too.
+    for i in range(len(conv)):
+        content = truncate_outputs(conv[i]["content"], OUTPUT_LIMITS[-1])
+        if content != conv[i]["content"]:
+            replace(i, content)
+            if fits():
+                return conv
+
+    return conv
+
+
+def _elide_superseded_code(conv: Conversation, index: int) -> str:
+    """The content of assistant message `index`, with any code that later code supersedes elided."""
+    later_code = [
+        code
+        for msg in conv[index + 1 :]
+        if msg["role"] == "assistant"
+        for code in CODE_RE.findall(msg["content"])
+    ]
+    if not later_code:
+        return conv[index]["content"]
+
+    # Did running this message's code fail? The user message after it tells.
+    failed = (
+        index + 1 < len(conv)
+        and conv[index + 1]["role"] == "user"
+        and any(EXCEPTION_RE.search(m[2]) for m in OUTPUT_RE.finditer(conv[index + 1]["content"]))
+    )
+    later_definitions = set().union(*(_definitions(code) for code in later_code))
+
+    def elide(m: re.Match) -> str:
+        code = m[1]
+        if code == ELIDED_CODE:
+            return m[0]
+        superseded = (
+            failed
+            or code.strip() in (c.strip() for c in later_code)
+            or _only_definitions(code) and _definitions(code) <= later_definitions
+        )
+        return f"```python\n{ELIDED_CODE}\n```" if superseded else m[0]
+
+    return CODE_RE.sub(elide, conv[index]["content"])
+
+
+def _parse(code: str) -> Optional[ast.Module]:
+    try:
+        return ast.parse(code)
+    except SyntaxError:
+        return None
+
+
+def _definitions(code: str) -> Set[str]:
+    """Names of the functions and classes defined at the top level."""
+    tree = _parse(code)
+    if tree is None:
+        return set()
+    return {
+        node.name
+        for node in tree.body
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef))
+    }
+
+
+def _only_definitions(code: str) -> bool:
+    """Whether the code only defines functions and classes, and imports: no side effects."""
+    tree = _parse(code)
+    if tree is None or not tree.body:
+        return False
+    allowed = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Import, ast.ImportFrom)
+    return any(not isinstance(n, (ast.Import, ast.ImportFrom)) for n in tree.body) and all(
+        isinstance(node, allowed) for node in tree.body
+    )
@@ -0,0 +1,148 @@
+import copy
+
+import pytest
+
+import src.preproc as preproc
+from src.run.execute import CellOutput, ExecutionResult
+from src.types import (
+    AssistantAction,
+    AssistantThought,
+    CodeFragment,
+    HumanMsg,
+    ResumeFrom,
+    Session,
+    SessionEvent,
+)
+from . import IncrementalChatML, session_to_chatml
+
+
+def _turn(i: int):
+    return [
+        SessionEvent(f"user-{i}", HumanMsg(f"Step {i}, please.")),
+        SessionEvent(f"thought-{i}", AssistantThought(f"Step {i}")),
+        SessionEvent(f"action-{i}", AssistantAction("Print it")),
+        SessionEvent(f"code-{i}", CodeFragment(f"print({i})")),
+        SessionEvent(
+            f"result-{i}",
+            ExecutionResult(output=CellOutput(f"{i}\n", "", ""), success=True),
+        ),
+    ]
+
+
+def test_incremental(monkeypatch):
+    calls = []
+    to_plaintext = preproc.event_to_plaintext
+    monkeypatch.setattr(
+        preproc, "event_to_plaintext", lambda e: calls.append(e) or to_plaintext(e)
+    )
+
+    session = Session(events=[])
+    chatml = IncrementalChatML(session)
+    # As in `nb/interactive.py`: the user's message, the response, then its output.
+    for i in range(3):
+        events = _turn(i)
+        for new_events in [events[:1], events[1:4], events[4:]]:
+            session.events += new_events
+            expected = session_to_chatml(copy.deepcopy(session))
+            calls.clear()
+            assert chatml.conversation() == expected
+            # Only new events are formatted.
+            assert calls == [e.body for e in new_events]
+
+    # Rewound, then resumed from the last user message.
+    del session.events[-4:]
+    assert chatml.conversation() == session_to_chatml(copy.deepcopy(session))
+    session.events += [SessionEvent("resume", ResumeFrom("user-2"))]
+    expected = session_to_chatml(copy.deepcopy(session))
+    assert chatml.conversation() == expected
+    session.events += _turn(3)[1:]
+    assert chatml.conversation() == session_to_chatml(copy.deepcopy(session))
+
+    # Returned conversations are the caller's own.
+    expected[-1]["content"] = "changed"
+    assert chatml.conversation() != expected
+
+
+def test_validated(monkeypatch):
+    parsed = []
+    parse = preproc.parse_constrained_message
+    monkeypatch.setattr(
+        preproc, "parse_constrained_message", lambda text: parsed.append(text) or parse(text)
+    )
+    validated = preproc.ValidatedMessages(max_entries=2)
+    messages = [
+        {"role": "assistant", "content": f"<thought>{i}</thought>\n<action>Go</action>\n```python\n{i}\n```\n"}
+        for i in range(3)
+    ]
+
+    for msg in messages[:2] * 2:
+        preproc.validate_flattened_assistant_msg(msg, validated)
+    assert len(parsed) == 2
+    # The least recently validated one is forgotten.
+    preproc.validate_flattened_assistant_msg(messages[2], validated)
+    preproc.validate_flattened_assistant_msg(messages[0], validated)
+    assert len(parsed) == 4
+    assert len(validated) == 2
+    # Invalid messages still fail, every time.
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            preproc.validate_flattened_assistant_msg({"role": "assistant", "content": "Hi"}, validated)
+
+    # Flattened again: nothing new to parse.
+    session = Session(events=_turn(0) + _turn(1))
+    session_to_chatml(session)
+    parsed.clear()
+    session_to_chatml(session)
+    assert parsed == []
+
+
+def test_resume_from():
+    session = Session(events=_turn(0) + _turn(1))
+    regenerated = _turn(2)[1:]
+    # Regenerated from the last user message, then resumed from the first response.
+    session.events += [SessionEvent("resume-1", ResumeFrom("user-1"))] + regenerated
+    session.events += [SessionEvent("resume-2", ResumeFrom("result-0"))] + _turn(3)
+    events = list(session.events)
+
+    assert preproc.active_branch(session) == [range(0, 5), range(16, 21)]
+    assert preproc.active_branch(session, 15) == [range(0, 6), range(11, 15)]
+    conversation = session_to_chatml(session)
+    expected = session_to_chatml(Session(events=_turn(0) + _turn(3)))
+    assert conversation == expected
+    # Abandoned branches are kept.
+    assert session.events == events
+
+    # Back to the regenerated response: the branch it was on.
+    session.append(SessionEvent("resume-3", ResumeFrom("result-2")))
+    assert preproc.active_branch(session) == [range(0, 6), range(11, 15)]
+    assert session_to_chatml(session) == session_to_chatml(
+        Session(events=_turn(0) + _turn(1)[:1] + regenerated)
+    )
+    # Unknown events are ignored.
+    session.append(SessionEvent("resume-4", ResumeFrom("nope")))
+    assert session_to_chatml(session)[-1]["content"].startswith("<output>2")
+
+
+def test_index_of():
+    session = Session(events=_turn(0))
+    assert session.index_of("code-0") == 3
+    session.append(_turn(1)[0])
+    session.events += _turn(1)[1:]
+    assert session.index_of("result-1") == 9
+    # Changed behind its back.
+    del session.events[2]
+    assert session.index_of("code-0") == 2
+    session.events = _turn(2)
+    assert session.index_of("code-0") is None
+    assert session.index_of("code-2") == 3
+    # Last event replaced.
+    session.events[-1] = _turn(3)[-1]
+    assert session.index_of("result-3") == 4
+
+    # Misses don't cost a rebuild.
+    reindex = session._reindex
+    session._reindex = lambda: pytest.fail("Reindexed")
+    session.append(_turn(4)[0])
+    assert session.index_of("nope") is None
+    assert session.index_of("user-4") == 5
+    session._reindex = reindex
@@ -0,0 +1,134 @@
+from .compact import ELIDED_CODE, TokenCounter, compact, truncate_middle
+
+SYSTEM = {"role": "system", "content": "You are an IPython REPL assistant."}
+TASK = {"role": "user", "content": "Look at the logs."}
+
+
+def _assistant(code: str, thought: str = "Hmm.") -> dict:
+    content = f"<thought>{thought}</thought>\n<action>Run it</action>\n```python\n{code}\n```\n"
+    return {"role": "assistant", "content": content}
+
+
+def _output(text: str) -> dict:
+    return {"role": "user", "content": f"<output>{text}</output>"}
+
+
+def _log(n_lines: int, tag: str = "") -> str:
+    return "".join(f"{tag}line {i}: all good\n" for i in range(n_lines))
+
+
+def test_truncate_middle():
+    text = _log(100)
+    truncated = truncate_middle(text, 200)
+    assert len(truncated) < 250
+    assert truncated.startswith("line 0: all good\n")
+    assert truncated.endswith("line 99: all good\n")
+    assert "characters truncated" in truncated
+    assert truncate_middle("short", 200) == "short"
+
+
+def test_truncate_middle_again():
+    """Truncating again cuts further only if needed, under a single marker."""
+    text = _log(100)
+    once = truncate_middle(text, 200)
+    assert truncate_middle(once, 200) == once
+    twice = truncate_middle(truncate_middle(text, 1000), 200)
+    assert twice.count("characters truncated") == 1
+    assert twice.startswith("line 0: all good\n")
+    assert twice.endswith("line 99: all good\n")
+    # All that's gone is counted.
+    n_cut = int(twice.split("[... ")[1].split()[0])
+    n_kept = len(twice) - len(f"[... {n_cut} characters truncated ...]\n")
+    assert n_cut + n_kept == len(text)
+
+
+def test_fits_untouched(tiny_tokenizer):
+    conv = [SYSTEM, TASK, _assistant("print(1)"), _output("1")]
+    counter = TokenCounter(tiny_tokenizer)
+    assert compact(conv, 10_000, counter) == conv
+
+
+def test_old_outputs_first(tiny_tokenizer):
+    conv = [
+        SYSTEM,
+        TASK,
+        _assistant("!cat old.log"),
+        _output(_log(200, "old ")),
+        _assistant("!cat new.log"),
+        _output(_log(200, "new ")),
+    ]
+    counter = TokenCounter(tiny_tokenizer)
+    budget = counter.total(conv) * 2 // 3
+    compacted = compact(conv, budget, counter)
+
+    assert counter.total(compacted) <= budget
+    assert len(compacted) == len(conv)
+    assert "truncated" in compacted[3]["content"]
+    # The latest output is what the model needs most.
+    assert compacted[-1] == conv[-1]
+    # Not modified in place.
+    assert "truncated" not in conv[3]["content"]
+
+
+def test_superseded_code(tiny_tokenizer):
+    failed = "\n".join(f"x{i} = undefined_name + {i}" for i in range(30))
+    conv = [
+        SYSTEM,
+        TASK,
+        _assistant(failed),
+        _output("NameError: name 'undefined_name' is not defined\n"),
+        _assistant("x = 1"),
+        _output(""),
+    ]
+    counter = TokenCounter(tiny_tokenizer)
+    compacted = compact(conv, counter.total(conv) - 10, counter)
+    assert ELIDED_CODE in compacted[2]["content"]
+    assert compacted[2]["content"].startswith("<thought>Hmm.</thought>")
+    assert compacted[3:] == conv[3:]
+
+
+def test_oldest_turns_dropped(tiny_tokenizer):
+    conv = [SYSTEM, TASK]
+    for i in range(10):
+        conv += [_assistant(f"print({i})", thought=f"Step {i}, " * 20), _output(str(i))]
+    counter = TokenCounter(tiny_tokenizer)
+    budget = counter.total(conv) // 3
+    compacted = compact(conv, budget, counter)
+
+    assert counter.total(compacted) <= budget
+    assert compacted[0] == SYSTEM
+    assert compacted[1]["content"].startswith(TASK["content"])
+    assert "omitted" in compacted[1]["content"]
+    assert compacted[-2:] == conv[-2:]
+    roles = [msg["role"] for msg in compacted[1:]]
+    assert roles == ["user", "assistant"] * (len(roles) // 2) + ["user"]
+
+
+def test_compact_again(tiny_tokenizer):
+    """Compacting a compacted conversation changes nothing, even when it still doesn't fit."""
+    conv = [SYSTEM, TASK, _assistant("!cat old.log"), _output(_log(200, "old "))]
+    conv += [_assistant("!cat new.log"), _output(_log(200, "new "))]
+    counter = TokenCounter(tiny_tokenizer)
+    compacted = compact(conv, 10, counter)
+    assert counter.total(compacted) > 10
+    assert "truncated" in compacted[-1]["content"]
+    assert compact(compacted, 10, counter) == compacted
+
+
+def test_counts_cached(tiny_tokenizer):
+    calls = []
+
+    class CountingTokenizer:
+        def __getattr__(self, name):
+            return getattr(tiny_tokenizer, name)
+
+        def encode(self, text, **kwargs):
+            calls.append(text)
+            return tiny_tokenizer.encode(text, **kwargs)
+
+    counter = TokenCounter(CountingTokenizer())
+    conv = [SYSTEM, TASK, _assistant("print(1)"), _output("1")]
+    counter.total(conv)
+    n_calls = len(calls)
+    counter.total(conv + [_assistant("print(2)")])
+    assert len(calls) == n_calls + 1
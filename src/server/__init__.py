@@ -0,0 +1,3 @@
+"""
+REST API around `src.generate`: run with `python -m src.server`.
+"""
@@ -1,11 +1,20 @@
+import asyncio
+import json
 import logging
-from fastapi import FastAPI
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, List, Optional, Tuple
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 import uvicorn
 
+from src.generate.kv import KVPool
 from src.generate.llm import LLM
 from src.types import Conversation
 from .cli import parse_args, ServerConfig
+from .metrics import Metrics
+from .scheduler import Job, QueueFull, Scheduler
+from .sessions import IncrementalPrompt, SessionStore
 
 logging.basicConfig(
     format='%(asctime)s : %(levelname)s : %(message)s',
@@ -14,17 +23,106 @@ logging.basicConfig(
 )
 log = logging.getLogger(__name__)
 
-class GenerateRequest(BaseModel):
-    conversation: Conversation
+# How often to check whether the client of a non-streaming request is still there.
+DISCONNECT_POLL_INTERVAL = 0.5
+# How long to wait for the scheduler to finish its decoding step on shutdown. It's a daemon
+# thread: past that, it doesn't keep the process alive.
+SHUTDOWN_TIMEOUT = 10.0
+
+class GenerationParams(BaseModel):
     max_new_tokens: int = 512
+    # Independent samples, e.g. alternatives to pick from, all from a single prefill.
+    # They only differ if the model's generation config samples.
+    n: int = 1
+    # LoRA adapter, by name (see `/adapters`). The model as loaded if not set.
+    adapter: Optional[str] = None
+
+class GenerateRequest(GenerationParams):
+    conversation: Conversation
+
+class CreateSessionRequest(BaseModel):
+    conversation: Conversation = []
+
+class AppendRequest(BaseModel):
+    messages: Conversation
+
+class RewindRequest(BaseModel):
+    # Messages to keep.
+    n_messages: int
+
+class RegisterAdapterRequest(BaseModel):
+    name: str
+    # A directory, as saved by `save_pretrained`, e.g. `run/phi4/lora`.
+    path: str
 
 class Server:
     def __init__(self, config: ServerConfig):
         self.config = config
         self.app = FastAPI()
         self.llm = None
+        # All generation happens there, off the event loop, with concurrent requests batched together.
+        self.scheduler = None
+        # Conversations clients upload a piece at a time.
+        self.sessions = None
+        # Where the time goes. Also available in-process: `server.metrics.snapshot()`.
+        self.metrics = Metrics()
+        # Compaction and tokenization of prompts, off the event loop: a long conversation takes
+        # a while. A single thread: tokenizers, and sessions' incremental prompts, aren't
+        # meant to be used from several threads at once.
+        self._prompts = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prompts")
         self._setup_routes()
 
+    async def _submit(
+        self, request: GenerationParams, session_id: Optional[str] = None
+    ) -> List[Job]:
+        """Jobs for `request`, or for the conversation of a session, with `request`'s parameters."""
+        if self.scheduler is None:
+            raise HTTPException(status_code=503, detail="Model not loaded yet")
+        adapters = self.llm.backend.adapters
+        if request.adapter is not None and (adapters is None or request.adapter not in adapters):
+            raise HTTPException(status_code=404, detail=f"Unknown adapter: {request.adapter}")
+
+        if session_id is None:
+            conversation, incremental = request.conversation, None
+        else:
+            session = self._session(session_id)
+            # As it is now: it may change while the prompt is prepared.
+            conversation, incremental = list(session.conversation), session.prompt
+        prompt = await asyncio.get_running_loop().run_in_executor(
+            self._prompts, self._prompt, conversation, request.max_new_tokens, incremental
+        )
+        try:
+            return self.scheduler.submit_samples(
+                prompt,
+                request.max_new_tokens,
+                request.n,
+                request.adapter,
+            )
+        except QueueFull as e:
+            raise HTTPException(status_code=429, detail=str(e))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    def _prompt(
+        self,
+        conversation: Conversation,
+        max_new_tokens: int,
+        incremental: Optional[IncrementalPrompt] = None,
+    ) -> List[int]:
+        """Prompt tokens for `conversation`, compacted to fit. Blocking: see `_prompts`."""
+        conversation = self.llm.fit(conversation, max_new_tokens)
+        if incremental is not None:
+            return incremental.tokens(conversation)
+        return self.llm.prompt_tokens(conversation)
+
+    def _session(self, session_id: str):
+        if self.sessions is None:
+            raise HTTPException(status_code=503, detail="Model not loaded yet")
+        try:
+            return self.sessions.get(session_id)
+        except KeyError:
+            raise HTTPException(status_code=404, detail=f"Unknown session: {session_id}")
+
     def _setup_routes(self):
         @self.app.on_event("startup")
         async def load_model():
@@ -32,16 +130,156 @@ class Server:
             self.llm = LLM(
                 model_name=self.config.model_name,
                 chat_template=self.config.chat_template,
-                max_seq_length=16000
+                max_seq_length=16000,
+                kv_pool=KVPool(
+                    max_bytes=int(self.config.kv_cache_gb * 1024**3),
+                    spill=self.config.kv_spill,
+                    max_spill_bytes=int(self.config.kv_spill_gb * 1024**3),
+                ),
+                draft_model_name=self.config.draft_model,
+                tokenizer_name=self.config.tokenizer,
             )
 
-        @self.app.post("/generate")
-        async def generate_handler(request: GenerateRequest):
-            response = self.llm.generate(
-                request.conversation,
-                request.max_new_tokens
+            if self.config.adapters is not None:
+                adapters = self.llm.backend.adapters
+                if adapters is None:
+                    raise ValueError(f"No LoRA adapters with {type(self.llm.backend).__name__}")
+                adapters.max_loaded = self.config.max_adapters
+                names = adapters.discover(self.config.adapters)
+                log.info(f"Adapters found in {self.config.adapters}: {', '.join(names)}")
+
+            self.scheduler = Scheduler(
+                lambda: self.llm.batch_decoder(
+                    stats=self.metrics.decode, prompt_lookup=self.config.prompt_lookup
+                ),
+                self.llm.tokenizer,
+                max_batch_size=min(
+                    self.config.max_batch_size,
+                    self.llm.backend.max_batch_size or self.config.max_batch_size,
+                ),
+                max_queued=self.config.max_queued,
+                metrics=self.metrics,
             )
-            return {"response": response}
+            self.scheduler.start()
+            self.sessions = SessionStore(self.llm.tokenizer, max_sessions=self.config.max_sessions)
+
+        @self.app.on_event("shutdown")
+        async def stop_scheduler():
+            # Off the event loop: the current decoding step has to finish first.
+            if self.scheduler is not None:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self.scheduler.stop, SHUTDOWN_TIMEOUT
+                )
+            self._prompts.shutdown(wait=False, cancel_futures=True)
+
+        @self.app.get("/health")
+        async def health_handler():
+            return {
+                "status": "ok" if self.scheduler is not None else "loading",
+                "queue_depth": self.scheduler.queue_depth if self.scheduler else 0,
+                "batch_size": self.scheduler.batch_size if self.scheduler else 0,
+            }
+
+        @self.app.get("/metrics")
+        async def metrics_handler():
+            """In Prometheus' text format."""
+            return PlainTextResponse(self.metrics.render(), media_type="text/plain; version=0.0.4")
+
+        @self.app.get("/stats")
+        async def stats_handler():
+            """Same as `/metrics`, as JSON."""
+            return self.metrics.snapshot()
+
+        @self.app.get("/adapters")
+        async def adapters_handler():
+            """Adapters that requests may choose from, and those currently loaded."""
+            adapters = self.llm.backend.adapters if self.llm is not None else None
+            if adapters is None:
+                return {"adapters": {}, "loaded": []}
+            return {"adapters": adapters.paths, "loaded": adapters.loaded}
+
+        @self.app.post("/adapters")
+        async def register_adapter_handler(request: RegisterAdapterRequest):
+            """
+            Make a new adapter available, e.g. freshly trained, without a restart.
+            Registering an existing name again reloads it, once no running request uses it.
+            """
+            adapters = self.llm.backend.adapters if self.llm is not None else None
+            if adapters is None:
+                raise HTTPException(status_code=400, detail="No LoRA adapters with this model")
+            try:
+                adapters.register(request.name, request.path)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            return {"adapters": adapters.paths, "loaded": adapters.loaded}
+
+        @self.app.post("/generate")
+        async def generate_handler(request: GenerateRequest, http_request: Request):
+            """
+            `{"response": ..., "n_tokens": ...}`, plus with `n`, all `"responses"`,
+            `"response"` being the first one. `n_tokens` counts the tokens of all responses.
+            """
+            return await _respond(await self._submit(request), http_request)
+
+        @self.app.post("/generate/stream")
+        async def generate_stream_handler(request: GenerateRequest):
+            """
+            Same as `/generate`, as JSON lines: `{"text": ..., "state": ..., "n_tokens": ...,
+            "forced": ..., "index": ...}` per delta, where `state` is the constraint state after
+            the delta (e.g. `THOUGHT_CONTENT`), `n_tokens` the number of tokens it's made of,
+            `forced` whether the constraint forced all of them (e.g. the opening `<thought>`,
+            sent before the prefill), and `index` which of the `n` responses it belongs to.
+            Deltas of different responses are interleaved.
+            """
+            return _stream(await self._submit(request))
+
+        # Sessions: the server holds the conversation, clients send what's new.
+
+        @self.app.post("/sessions")
+        async def create_session_handler(request: CreateSessionRequest):
+            """A new session, starting with `conversation`: `{"session_id": ..., "n_messages": ...}`."""
+            if self.sessions is None:
+                raise HTTPException(status_code=503, detail="Model not loaded yet")
+            session = self.sessions.create(request.conversation)
+            return {"session_id": session.id, "n_messages": len(session.conversation)}
+
+        @self.app.get("/sessions/{session_id}")
+        async def get_session_handler(session_id: str):
+            return {"session_id": session_id, "conversation": self._session(session_id).conversation}
+
+        @self.app.delete("/sessions/{session_id}")
+        async def delete_session_handler(session_id: str):
+            self._session(session_id)
+            self.sessions.delete(session_id)
+            return {"session_id": session_id}
+
+        @self.app.post("/sessions/{session_id}/messages")
+        async def append_handler(session_id: str, request: AppendRequest):
+            session = self._session(session_id)
+            session.append(request.messages)
+            return {"session_id": session_id, "n_messages": len(session.conversation)}
+
+        @self.app.post("/sessions/{session_id}/rewind")
+        async def rewind_handler(session_id: str, request: RewindRequest):
+            """Back to the first `n_messages` messages, e.g. to regenerate a response."""
+            session = self._session(session_id)
+            try:
+                session.rewind(request.n_messages)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            return {"session_id": session_id, "n_messages": len(session.conversation)}
+
+        @self.app.post("/sessions/{session_id}/generate")
+        async def session_generate_handler(
+            session_id: str, request: GenerationParams, http_request: Request
+        ):
+            """`/generate`, for the session's conversation. The response isn't appended."""
+            return await _respond(await self._submit(request, session_id), http_request)
+
+        @self.app.post("/sessions/{session_id}/generate/stream")
+        async def session_generate_stream_handler(session_id: str, request: GenerationParams):
+            """`/generate/stream`, for the session's conversation."""
+            return _stream(await self._submit(request, session_id))
 
     def run(self):
         log.info(f"Starting server on {self.config.host}:{self.config.port}")
@@ -52,6 +290,81 @@ class Server:
         )
 
 
+async def _respond(jobs: List[Job], http_request: Request):
+    """The body of a `/generate` response."""
+    result = asyncio.ensure_future(asyncio.gather(*(job.result() for job in jobs)))
+    # Nothing to send until the end: poll, so that we notice if the client is gone.
+    while not (await asyncio.wait({result}, timeout=DISCONNECT_POLL_INTERVAL))[0]:
+        if await http_request.is_disconnected():
+            log.info("Client disconnected, cancelling generation")
+            for job in jobs:
+                job.cancel()
+            result.cancel()
+            return Response(status_code=499)
+    responses = ["".join(d.text for d in deltas) for deltas in result.result()]
+    return {
+        "response": responses[0],
+        "responses": responses,
+        "n_tokens": sum(d.n_tokens for deltas in result.result() for d in deltas),
+    }
+
+
+def _stream(jobs: List[Job]) -> StreamingResponse:
+    """A `/generate/stream` response."""
+
+    async def lines():
+        try:
+            async for index, d in _interleave([job.stream() for job in jobs]):
+                line = {
+                    "text": d.text,
+                    "state": d.state.name,
+                    "n_tokens": d.n_tokens,
+                    "forced": d.forced,
+                    "index": index,
+                }
+                yield json.dumps(line) + "\n"
+        finally:
+            # Also when the client disconnects: the responses get cancelled.
+            for job in jobs:
+                job.cancel()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+async def _interleave(streams: List[AsyncIterator]) -> AsyncIterator[Tuple[int, Any]]:
+    """Items of several streams as they come, along with the index of their stream."""
+    if len(streams) == 1:
+        async for item in streams[0]:
+            yield 0, item
+        return
+
+    items: asyncio.Queue = asyncio.Queue()
+    done = object()
+
+    async def pump(index: int, stream: AsyncIterator):
+        try:
+            async for item in stream:
+                await items.put((index, item))
+            await items.put((index, done))
+        except Exception as e:
+            await items.put((index, e))
+
+    tasks = [asyncio.create_task(pump(i, stream)) for i, stream in enumerate(streams)]
+    try:
+        n_running = len(tasks)
+        while n_running:
+            index, item = await items.get()
+            if item is done:
+                n_running -= 1
+            elif isinstance(item, BaseException):
+                raise item
+            else:
+                yield index, item
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
 if __name__ == "__main__":
     config = parse_args()
     server = Server(config)
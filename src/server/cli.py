@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from typing import Optional
 import argparse
 
 @dataclass
@@ -7,6 +8,17 @@ class ServerConfig:
     chat_template: str
     host: str = "127.0.0.1"
     port: int = 8000
+    kv_cache_gb: float = 2.0
+    kv_spill: Optional[str] = None
+    kv_spill_gb: float = 8.0
+    max_queued: int = 8
+    max_batch_size: int = 8
+    prompt_lookup: bool = False
+    draft_model: Optional[str] = None
+    tokenizer: Optional[str] = None
+    adapters: Optional[str] = None
+    max_adapters: int = 4
+    max_sessions: int = 64
 
 def parse_args() -> ServerConfig:
     parser = argparse.ArgumentParser(description="Run the generation server")
@@ -14,7 +26,13 @@ def parse_args() -> ServerConfig:
         "--model",
         type=str,
         default="unsloth/Phi-4",
-        help="Model name/path"
+        help="Model name/path. A .gguf file runs on CPU, with llama.cpp"
+    )
+    parser.add_argument(
+        "--tokenizer",
+        type=str,
+        default=None,
+        help="For a .gguf model: tokenizer name/path, if not in the same directory"
     )
 
     parser.add_argument(
@@ -36,11 +54,83 @@ def parse_args() -> ServerConfig:
         default=8000,
         help="Port to bind to"
     )
+    parser.add_argument(
+        "--kv-cache-gb",
+        type=float,
+        default=2.0,
+        help="GPU memory budget for KV caches kept across requests"
+    )
+    parser.add_argument(
+        "--kv-spill",
+        type=str,
+        default=None,
+        help="Where KV caches evicted from the GPU go: 'cpu', or a directory. Dropped if unset"
+    )
+    parser.add_argument(
+        "--kv-spill-gb",
+        type=float,
+        default=8.0,
+        help="Memory budget for spilled KV caches"
+    )
+    parser.add_argument(
+        "--max-queued",
+        type=int,
+        default=8,
+        help="Requests waiting for generation beyond this are rejected with 429"
+    )
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=8,
+        help="Requests decoded together, at most"
+    )
+    parser.add_argument(
+        "--prompt-lookup",
+        action="store_true",
+        help="Speculative decoding: guess tokens by copying from the conversation"
+    )
+    parser.add_argument(
+        "--draft-model",
+        type=str,
+        default=None,
+        help="Speculative decoding: a smaller model, with the same tokenizer, guesses tokens"
+    )
+    parser.add_argument(
+        "--adapters",
+        type=str,
+        default=None,
+        help="LoRA adapters requests may choose from, on top of --model: a glob, e.g. 'run/*/lora'"
+    )
+    parser.add_argument(
+        "--max-adapters",
+        type=int,
+        default=4,
+        help="LoRA adapters loaded at once, at most; least recently used ones are unloaded"
+    )
+    parser.add_argument(
+        "--max-sessions",
+        type=int,
+        default=64,
+        help="Conversations held for clients (see /sessions); least recently used ones are dropped"
+    )
     args = parser.parse_args()
+    if args.prompt_lookup and args.draft_model:
+        parser.error("--prompt-lookup and --draft-model are mutually exclusive")
 
     return ServerConfig(
         model_name=args.model,
         chat_template=args.chat_template,
         host=args.host,
-        port=args.port
+        port=args.port,
+        kv_cache_gb=args.kv_cache_gb,
+        kv_spill=args.kv_spill,
+        kv_spill_gb=args.kv_spill_gb,
+        max_queued=args.max_queued,
+        max_batch_size=args.max_batch_size,
+        prompt_lookup=args.prompt_lookup,
+        draft_model=args.draft_model,
+        tokenizer=args.tokenizer,
+        adapters=args.adapters,
+        max_adapters=args.max_adapters,
+        max_sessions=args.max_sessions,
     )
@@ -0,0 +1,179 @@
+"""
+Where the server's time goes: counters and histograms, for `/metrics` and in-process use.
+
+`Metrics.snapshot()` is the in-process API: plain numbers, in a dict. `Metrics.render()` is
+the same, in Prometheus' text format, for `/metrics`.
+
+Token counts and durations come from the decoding loop (`DecodeStats`, shared by every
+batch the scheduler creates); request-level figures (time to first token, duration, speed)
+from the scheduler.
+"""
+
+import bisect
+import resource
+import sys
+import threading
+from dataclasses import asdict
+from typing import Callable, Dict, List, Sequence
+
+import torch
+
+from src.generate.decode import DecodeStats
+
+# Seconds.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+STEP_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+# Tokens per second.
+SPEED_BUCKETS = (1, 2.5, 5, 10, 20, 30, 40, 60, 80, 100, 150, 200, 400)
+
+# (name, description, attribute of `DecodeStats`) for the counters of the decoding loop.
+_DECODE_COUNTERS = [
+    ("prompt_tokens", "Prompt tokens, over all sequences", "n_prompt"),
+    ("prefill_tokens", "Tokens prefilled: prompt tokens not reused from the KV pool, plus those forced upfront", "n_prefilled"),
+    ("reused_tokens", "Prompt tokens whose KV cache was reused", "n_reused"),
+    ("decode_tokens", "Tokens generated", "n_generated"),
+    ("forced_tokens", "Tokens forced by the constraint, appended without sampling", "n_jumped"),
+    ("drafted_tokens", "Tokens guessed by speculative decoding", "n_drafted"),
+    ("accepted_tokens", "Guessed tokens the model agreed with", "n_accepted"),
+    ("forward_passes", "Calls to the model", "n_forward"),
+    ("steps", "Decoding steps, each one forward pass for the batch", "n_steps"),
+    ("prefill_seconds", "Time spent prefilling", "prefill_seconds"),
+    ("decode_seconds", "Time spent decoding, speculation included", "decode_seconds"),
+    ("constraint_seconds", "Time spent in the constraint", "constraint_seconds"),
+]
+
+PREFIX = "kyzel_"
+
+
+class Histogram:
+    """Counts of observations at or below each bucket's upper bound, as in Prometheus."""
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        # The last one is for values beyond all buckets.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[int]:
+        totals, total = [], 0
+        for n in self.counts:
+            total += n
+            totals.append(total)
+        return totals
+
+    def quantile(self, q: float) -> float:
+        """Estimated from the buckets: the upper bound of the bucket the quantile falls into."""
+        if not self.count:
+            return 0.0
+        for bound, total in zip(self.buckets + (float("inf"),), self.cumulative()):
+            if total >= q * self.count:
+                return bound
+        return float("inf")
+
+    def snapshot(self) -> Dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+
+class Metrics:
+    """
+    Counters are updated from the scheduler thread, and read from anywhere: Python makes each
+    update atomic enough, and a snapshot slightly off is fine.
+    """
+
+    def __init__(self):
+        self.decode = DecodeStats()
+        # By outcome: `ok`, `cancelled`, `failed`, `rejected` (queue full).
+        self.requests: Dict[str, int] = {}
+        self.ttft = Histogram(LATENCY_BUCKETS)
+        self.request_seconds = Histogram(LATENCY_BUCKETS)
+        self.tokens_per_second = Histogram(SPEED_BUCKETS)
+        self.step_constraint_seconds = Histogram(STEP_BUCKETS)
+        # Current values, computed on demand.
+        self.gauges: Dict[str, Callable[[], float]] = {
+            "peak_gpu_memory_bytes": _peak_gpu_memory,
+            "peak_rss_bytes": _peak_rss,
+        }
+        self._lock = threading.Lock()
+
+    def count_request(self, outcome: str, n: int = 1):
+        with self._lock:
+            self.requests[outcome] = self.requests.get(outcome, 0) + n
+
+    def snapshot(self) -> Dict:
+        decode = asdict(self.decode)
+        return {
+            "requests": dict(self.requests),
+            **{name: fn() for name, fn in self.gauges.items()},
+            "decode": decode,
+            # Overall decoding speed, for the whole batch.
+            "decode_tokens_per_second": (
+                self.decode.n_generated / self.decode.decode_seconds
+                if self.decode.decode_seconds
+                else 0.0
+            ),
+            "constraint_seconds_per_step": (
+                self.decode.constraint_seconds / self.decode.n_steps if self.decode.n_steps else 0.0
+            ),
+            "time_to_first_token_seconds": self.ttft.snapshot(),
+            "request_seconds": self.request_seconds.snapshot(),
+            "request_tokens_per_second": self.tokens_per_second.snapshot(),
+            "step_constraint_seconds": self.step_constraint_seconds.snapshot(),
+        }
+
+    def render(self) -> str:
+        """Prometheus' text exposition format."""
+        lines = []
+
+        def metric(name: str, kind: str, description: str):
+            lines.append(f"# HELP {PREFIX}{name} {description}")
+            lines.append(f"# TYPE {PREFIX}{name} {kind}")
+
+        metric("requests_total", "counter", "Requests, by outcome")
+        for outcome, n in sorted(self.requests.items()):
+            lines.append(f'{PREFIX}requests_total{{outcome="{outcome}"}} {n}')
+        for name, fn in self.gauges.items():
+            metric(name, "gauge", name.replace("_", " ").capitalize())
+            lines.append(f"{PREFIX}{name} {_number(fn())}")
+        for name, description, attribute in _DECODE_COUNTERS:
+            metric(f"{name}_total", "counter", description)
+            lines.append(f"{PREFIX}{name}_total {_number(getattr(self.decode, attribute))}")
+
+        for name, histogram, description in [
+            ("time_to_first_token_seconds", self.ttft, "From submission to the first generated token"),
+            ("request_seconds", self.request_seconds, "From submission to the last token"),
+            ("request_tokens_per_second", self.tokens_per_second, "Decoding speed, per request"),
+            ("step_constraint_seconds", self.step_constraint_seconds, "Constraint time, per step"),
+        ]:
+            metric(name, "histogram", description)
+            bounds = [_number(b) for b in histogram.buckets] + ["+Inf"]
+            for bound, total in zip(bounds, histogram.cumulative()):
+                lines.append(f'{PREFIX}{name}_bucket{{le="{bound}"}} {total}')
+            lines.append(f"{PREFIX}{name}_sum {_number(histogram.sum)}")
+            lines.append(f"{PREFIX}{name}_count {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _peak_gpu_memory() -> int:
+    return torch.cuda.max_memory_allocated() if torch.cuda.is_available() else 0
+
+
+def _peak_rss() -> int:
+    # Kilobytes on Linux, bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
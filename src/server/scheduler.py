@@ -0,0 +1,294 @@
+"""
+Runs generation off the event loop, with continuous batching.
+
+Generation is blocking and GPU-bound: running it in a request handler would freeze the
+whole server, health checks included. Instead, handlers submit jobs to a `Scheduler`,
+and await their output.
+
+The scheduler drives a single `BatchDecoder` on a dedicated thread. Between two decoding
+steps, waiting jobs join the batch, and cancelled ones leave it; finished sequences leave
+as soon as they are done. Nobody waits for the slowest sequence of a batch, and the GPU
+doesn't sit idle between requests.
+
+The queue is bounded: when full, `submit` refuses new jobs rather than letting
+latency grow without bounds.
+
+Several samples for the same prompt (`submit_samples`) join the batch together, and share
+a single prefill.
+"""
+
+import asyncio
+import logging
+import queue
+import threading
+import time
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+from src.generate.decode import BatchDecoder, DecodeRow
+from src.generate.stream import DeltaStream, StreamDelta
+from .metrics import Metrics
+
+log = logging.getLogger(__name__)
+
+# Marks the end of a job's output.
+_DONE = object()
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Job:
+    """
+    A response to generate. Its deltas are handed over to the event loop as they come.
+    """
+
+    def __init__(
+        self,
+        prompt: List[int],
+        max_new_tokens: int,
+        loop: asyncio.AbstractEventLoop,
+        adapter: Optional[str] = None,
+    ):
+        self.prompt = prompt
+        self.max_new_tokens = max_new_tokens
+        self.adapter = adapter
+        self.submitted_at = time.perf_counter()
+        # When the model generated its first token, after the prefill.
+        self.first_token_at: Optional[float] = None
+        self._loop = loop
+        self._output: asyncio.Queue = asyncio.Queue()
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        """Whether queued or running, the job stops as soon as possible."""
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    async def stream(self) -> AsyncIterator[StreamDelta]:
+        """The response, delta by delta. Raises whatever went wrong."""
+        while (item := await self._output.get()) is not _DONE:
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    async def result(self) -> List[StreamDelta]:
+        return [delta async for delta in self.stream()]
+
+    def _emit(self, item):
+        """From the scheduler thread."""
+        if not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._output.put_nowait, item)
+
+    def _finish(self, error: Optional[Exception] = None):
+        """From the scheduler thread."""
+        if error is not None:
+            self._emit(error)
+        self._emit(_DONE)
+
+
+class Scheduler:
+    """
+    Continuous batching over a `BatchDecoder`, on a dedicated thread.
+
+    `new_batch` creates the decoder: on `start`, and after a failed step.
+    At most `max_batch_size` sequences are decoded together, and `max_queued` wait for a place.
+
+    Request-level figures go to `metrics`; for token counts and timings, decoders should
+    share its `decode` stats.
+    """
+
+    def __init__(
+        self,
+        new_batch: Callable[[], BatchDecoder],
+        tokenizer,
+        max_batch_size: int = 8,
+        max_queued: int = 8,
+        metrics: Optional[Metrics] = None,
+    ):
+        self.new_batch = new_batch
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.metrics.gauges["queue_depth"] = lambda: self.queue_depth
+        self.metrics.gauges["batch_size"] = lambda: self.batch_size
+        # Jobs join in groups: samples of the same prompt, together.
+        self._queue: queue.Queue[Optional[List[Job]]] = queue.Queue(maxsize=max_queued)
+        # A group that was taken from the queue, but didn't fit in the batch yet.
+        self._waiting: Optional[List[Job]] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+
+        # Only touched from the scheduler thread, but for `batch_size`.
+        self._batch: Optional[BatchDecoder] = None
+        self._jobs: Dict[DecodeRow, Job] = {}
+        self._deltas: Dict[DecodeRow, DeltaStream] = {}
+
+    def start(self):
+        self._stopping = False
+        self._batch = self.new_batch()
+        self._thread = threading.Thread(target=self._loop, name="scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        """
+        The thread stops after the current step. Blocking: waits for it, at most `timeout` seconds.
+        """
+        self._stopping = True
+        # Wake the thread up, if it's waiting for jobs.
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            log.warning(f"Scheduler still running after {timeout}s, not waiting for it")
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() + (self._waiting is not None)
+
+    @property
+    def batch_size(self) -> int:
+        return len(self._jobs)
+
+    def submit(self, prompt: List[int], max_new_tokens: int, adapter: Optional[str] = None) -> Job:
+        """
+        Queue a job, to join the batch at the next step. Raises `QueueFull`.
+        `adapter` is the LoRA adapter to use, by name: see `src.generate.lora`.
+        """
+        return self.submit_samples(prompt, max_new_tokens, 1, adapter)[0]
+
+    def submit_samples(
+        self, prompt: List[int], max_new_tokens: int, n: int, adapter: Optional[str] = None
+    ) -> List[Job]:
+        """
+        `n` jobs for the same prompt, sampled independently, from a single prefill.
+        Raises `QueueFull`, or `ValueError` if they can't all fit in a batch.
+        """
+        if not 1 <= n <= self.max_batch_size:
+            raise ValueError(f"Between 1 and {self.max_batch_size} samples per request")
+        loop = asyncio.get_running_loop()
+        jobs = [Job(prompt, max_new_tokens, loop, adapter) for _ in range(n)]
+        try:
+            self._queue.put_nowait(jobs)
+        except queue.Full:
+            self.metrics.count_request("rejected", n)
+            raise QueueFull(f"{self._queue.maxsize} requests already queued")
+        return jobs
+
+    def _loop(self):
+        while not self._stopping:
+            try:
+                # Idle: wait for something to do.
+                self._admit(block=not self._jobs)
+                self._drop_cancelled()
+                constraint_seconds = self.metrics.decode.constraint_seconds
+                results = self._batch.step()
+                if results:
+                    self.metrics.step_constraint_seconds.observe(
+                        self.metrics.decode.constraint_seconds - constraint_seconds
+                    )
+                now = time.perf_counter()
+                for row, tokens in results:
+                    job = self._jobs[row]
+                    if job.first_token_at is None and tokens:
+                        job.first_token_at = now
+                        self.metrics.ttft.observe(now - job.submitted_at)
+                    self._emit(row, tokens)
+            except Exception as e:
+                log.exception("Decoding failed")
+                # The KV cache may be in any state: start over with a new batch.
+                self.metrics.count_request("failed", len(self._jobs))
+                for job in self._jobs.values():
+                    job._finish(e)
+                self._jobs.clear()
+                self._deltas.clear()
+                self._batch = self.new_batch()
+
+        for job in self._jobs.values():
+            job._finish(Cancelled())
+        for job in self._waiting or []:
+            job._finish(Cancelled())
+
+    def _admit(self, block: bool):
+        """Let waiting jobs join the batch, as long as there's room."""
+        while len(self._jobs) < self.max_batch_size:
+            if self._waiting is not None:
+                jobs, self._waiting = self._waiting, None
+            else:
+                try:
+                    jobs = self._queue.get(block=block)
+                except queue.Empty:
+                    return
+                if jobs is None:
+                    return
+            block = False
+            for job in jobs:
+                if job.cancelled:
+                    self.metrics.count_request("cancelled")
+                    job._finish(Cancelled())
+            jobs = [job for job in jobs if not job.cancelled]
+            if not jobs:
+                continue
+            if len(self._jobs) + len(jobs) > self.max_batch_size:
+                # First in line: it joins as soon as there's room for all of it.
+                self._waiting = jobs
+                return
+
+            job = jobs[0]
+            try:
+                rows = self._batch.add_samples(job.prompt, job.max_new_tokens, len(jobs), job.adapter)
+            except Exception as e:
+                # E.g. an adapter that won't load: only these jobs fail.
+                log.exception("Could not start generation")
+                self.metrics.count_request("failed", len(jobs))
+                for job in jobs:
+                    job._finish(e)
+                continue
+            for row, job in zip(rows, jobs):
+                self._jobs[row] = job
+                self._deltas[row] = DeltaStream(self.tokenizer)
+                # Forced tokens, e.g. `<thought>`, are there right away.
+                self._emit(row, list(row.generated), forced=True)
+
+    def _drop_cancelled(self):
+        cancelled = [row for row, job in self._jobs.items() if job.cancelled]
+        if cancelled:
+            self._batch.remove(cancelled)
+            self.metrics.count_request("cancelled", len(cancelled))
+        for row in cancelled:
+            log.info("Generation cancelled")
+            self._jobs.pop(row)._finish(Cancelled())
+            del self._deltas[row]
+
+    def _emit(self, row: DecodeRow, tokens: List[int], forced: bool = False):
+        job, deltas = self._jobs[row], self._deltas[row]
+        if delta := deltas.push(tokens, row.state, forced):
+            job._emit(delta)
+        if row.finished:
+            if delta := deltas.flush(row.state):
+                job._emit(delta)
+            if row.n_drafted:
+                log.info(
+                    f"Generated {len(row.generated)} tokens; accepted "
+                    f"{row.n_accepted}/{row.n_drafted} guessed tokens "
+                    f"({row.n_accepted / row.n_drafted:.0%})"
+                )
+            self._count_finished(job, row)
+            job._finish()
+            del self._jobs[row], self._deltas[row]
+
+    def _count_finished(self, job: Job, row: DecodeRow):
+        now = time.perf_counter()
+        self.metrics.count_request("ok")
+        self.metrics.request_seconds.observe(now - job.submitted_at)
+        if job.first_token_at is not None and now > job.first_token_at:
+            self.metrics.tokens_per_second.observe(len(row.generated) / (now - job.first_token_at))
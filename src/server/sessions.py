@@ -0,0 +1,141 @@
+"""
+Conversations held by the server, so that clients only upload what's new each turn.
+
+Without sessions, each turn posts the whole conversation again: system prompt, every past
+execution output... With a session, the client creates it once, then appends new messages,
+or rewinds to an earlier message (e.g. to regenerate a response, or for `ResumeFrom`):
+`POST /sessions`, then `POST /sessions/{id}/messages`, `/rewind`, `/generate[/stream]`.
+
+The server also keeps each session's latest prompt, as tokens: the next one is mostly the
+same, and only the end of it needs tokenizing. The KV pool does the same for the prefill.
+"""
+
+import logging
+import uuid
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from src.generate.kv import common_prefix_length
+from src.types import Conversation
+
+log = logging.getLogger(__name__)
+
+
+class IncrementalPrompt:
+    """
+    Prompt tokens of the successive versions of a conversation, tokenizing only what changed.
+
+    Tokenizers treat special tokens (e.g. `<|im_end|>`) as boundaries: what's before one is
+    tokenized independently of what's after. Whatever the prompt shares with the previous
+    one, up to the last special token in common, keeps its tokens.
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self._special_ids = set(tokenizer.all_special_ids) | {
+            i for i, token in tokenizer.added_tokens_decoder.items() if token.special
+        }
+        self._text = ""
+        self._tokens: List[int] = []
+        # End of each token, in characters.
+        self._ends: List[int] = []
+
+    def tokens(self, conversation: Conversation) -> List[int]:
+        """Same as `LLM.prompt_tokens`."""
+        text = self.tokenizer.apply_chat_template(
+            conversation, tokenize=False, add_generation_prompt=True
+        )
+        n_chars, n_tokens = self._reusable(text)
+        encoding = self.tokenizer(
+            text[n_chars:], add_special_tokens=False, return_offsets_mapping=True
+        )
+        self._text = text
+        self._tokens = self._tokens[:n_tokens] + encoding["input_ids"]
+        self._ends = self._ends[:n_tokens] + [n_chars + end for _, end in encoding["offset_mapping"]]
+        return list(self._tokens)
+
+    def _reusable(self, text: str) -> Tuple[int, int]:
+        """How much of the previous prompt holds for `text`: characters, and their tokens."""
+        n_common = common_prefix_length(self._text, text)
+        for i in range(len(self._tokens) - 1, -1, -1):
+            if self._tokens[i] in self._special_ids and self._ends[i] <= n_common:
+                return self._ends[i], i + 1
+        return 0, 0
+
+    @staticmethod
+    def supported(tokenizer) -> bool:
+        """Whether tokenizing in parts gives the same tokens as all at once, for this tokenizer."""
+        if not getattr(tokenizer, "is_fast", False):
+            # No offsets.
+            return False
+        conversation = [
+            {"role": "system", "content": "Be brief."},
+            {"role": "user", "content": "Hi there"},
+            {"role": "assistant", "content": " Hello!\n"},
+            {"role": "user", "content": "  What's up?"},
+        ]
+        prompt = IncrementalPrompt(tokenizer)
+        try:
+            for i in range(2, len(conversation) + 1):
+                tokens = prompt.tokens(conversation[:i])
+            full = tokenizer.apply_chat_template(conversation, add_generation_prompt=True)
+        except Exception:
+            return False
+        return tokens == full
+
+
+class ChatSession:
+    """A conversation, as known to the server."""
+
+    def __init__(self, id: str, conversation: Conversation):
+        self.id = id
+        self.conversation: Conversation = list(conversation)
+        # `None` if the tokenizer doesn't lend itself to it.
+        self.prompt: Optional[IncrementalPrompt] = None
+
+    def append(self, messages: Conversation):
+        self.conversation += messages
+
+    def rewind(self, n_messages: int):
+        """Keep the first `n_messages` messages only."""
+        if not 0 <= n_messages <= len(self.conversation):
+            raise ValueError(f"Can't rewind to message {n_messages} of {len(self.conversation)}")
+        del self.conversation[n_messages:]
+
+
+class SessionStore:
+    """
+    Sessions by ID. Beyond `max_sessions`, the least recently used ones are forgotten:
+    clients find out with a `KeyError` (404), and start over with a new session.
+    """
+
+    def __init__(self, tokenizer, max_sessions: int = 64):
+        self.tokenizer = tokenizer
+        self.max_sessions = max_sessions
+        self._incremental = IncrementalPrompt.supported(tokenizer)
+        if not self._incremental:
+            log.info("Prompts of sessions are tokenized from scratch every time")
+        self._sessions: OrderedDict[str, ChatSession] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def create(self, conversation: Conversation) -> ChatSession:
+        session = ChatSession(uuid.uuid4().hex, conversation)
+        if self._incremental:
+            session.prompt = IncrementalPrompt(self.tokenizer)
+        self._sessions[session.id] = session
+        while len(self._sessions) > self.max_sessions:
+            forgotten, _ = self._sessions.popitem(last=False)
+            log.info(f"Forgot session {forgotten}")
+        return session
+
+    def get(self, id: str) -> ChatSession:
+        """Raises `KeyError` if there's no such session, or not anymore."""
+        session = self._sessions[id]
+        self._sessions.move_to_end(id)
+        return session
+
+    def delete(self, id: str):
+        del self._sessions[id]
+
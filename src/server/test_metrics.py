@@ -0,0 +1,39 @@
+import asyncio
+
+from .metrics import Histogram, Metrics
+from .test_scheduler import LONG, _prompt, _run, _scheduler
+
+
+def test_histogram():
+    histogram = Histogram([1, 2, 5])
+    for value in [0.5, 1, 1.5, 3, 10]:
+        histogram.observe(value)
+    assert histogram.cumulative() == [2, 3, 4, 5]
+    assert histogram.quantile(0.5) == 2
+    assert histogram.quantile(0.99) == float("inf")
+    assert histogram.sum == 16
+
+
+def test_scheduler_metrics(tiny_tokenizer, scripted_lm):
+    metrics = Metrics()
+    scheduler = _scheduler(tiny_tokenizer, scripted_lm(LONG), metrics=metrics)
+
+    async def main():
+        jobs = [scheduler.submit(_prompt(tiny_tokenizer, f"Q{i}"), 200) for i in range(3)]
+        return await asyncio.gather(*(job.result() for job in jobs))
+
+    _run(scheduler, main)
+    stats = metrics.snapshot()
+    assert stats["requests"] == {"ok": 3}
+    assert stats["time_to_first_token_seconds"]["count"] == 3
+    assert stats["request_tokens_per_second"]["count"] == 3
+    assert stats["decode"]["n_generated"] > 0
+    assert stats["decode"]["n_jumped"] > 0
+    # Forced tokens right after the prompt are prefilled with it.
+    assert stats["decode"]["n_prefilled"] > stats["decode"]["n_prompt"] > 0
+    assert stats["batch_size"] == 0
+
+    text = metrics.render()
+    assert 'kyzel_requests_total{outcome="ok"} 3' in text
+    assert 'kyzel_time_to_first_token_seconds_bucket{le="+Inf"} 3' in text
+    assert "kyzel_constraint_seconds_total" in text
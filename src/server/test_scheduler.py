@@ -0,0 +1,203 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from src.generate.constrain import State, StructuredEnforcer
+from src.generate.decode import BatchDecoder, Sampler
+from .scheduler import Cancelled, QueueFull, Scheduler
+
+SHORT = "<thought>Hi!</thought>\n<action>Nothing</action>\n```python\n1\n```"
+LONG = (
+    "<thought>Let me think about it.</thought>\n"
+    "<action>List files</action>\n"
+    "```python\nimport os\nprint(os.listdir('.'))\n```"
+)
+
+
+class BatchSizes:
+    """Wraps a model, to record the batch size of each call."""
+
+    def __init__(self, model):
+        self.model = model
+        self.device = model.device
+        self.sizes = []
+
+    def __call__(self, input_ids, **kwargs):
+        self.sizes.append(input_ids.shape[0])
+        return self.model(input_ids=input_ids, **kwargs)
+
+    forward = __call__
+
+
+def _scheduler(tokenizer, model, metrics=None, **kwargs) -> Scheduler:
+    return Scheduler(
+        lambda: BatchDecoder(
+            model,
+            StructuredEnforcer(tokenizer),
+            Sampler(),
+            stop_token_ids={tokenizer.eos_token_id},
+            pad_token_id=tokenizer.pad_token_id,
+            stats=metrics.decode if metrics is not None else None,
+        ),
+        tokenizer,
+        metrics=metrics,
+        **kwargs,
+    )
+
+
+def _prompt(tokenizer, question):
+    conversation = [{"role": "user", "content": question}]
+    return tokenizer.apply_chat_template(conversation, add_generation_prompt=True)
+
+
+def _run(scheduler, main):
+    scheduler.start()
+    try:
+        return asyncio.run(main())
+    finally:
+        scheduler.stop()
+
+
+def test_join_and_leave(tiny_tokenizer, scripted_lm):
+    """A request joins midway, and leaves first; each gets its own response."""
+    model = BatchSizes(scripted_lm(lambda prompt: SHORT if "Hi" in prompt else LONG))
+    scheduler = _scheduler(tiny_tokenizer, model)
+
+    async def main():
+        long_job = scheduler.submit(_prompt(tiny_tokenizer, "What's in here?"), 200)
+        long_stream = long_job.stream()
+        long_deltas = [await long_stream.__anext__() for _ in range(3)]
+
+        short_job = scheduler.submit(_prompt(tiny_tokenizer, "Hi"), 200)
+        short_deltas = await short_job.result()
+        long_deltas += [delta async for delta in long_stream]
+        return long_deltas, short_deltas
+
+    long_deltas, short_deltas = _run(scheduler, main)
+    assert "".join(d.text for d in short_deltas) == SHORT + "\n<|im_end|>"
+    assert "".join(d.text for d in long_deltas) == LONG + "\n<|im_end|>"
+    assert long_deltas[0].state == State.THOUGHT_CONTENT
+    assert long_deltas[-1].state == State.DONE
+    # Sent before the prefill: only `<thought>`, forced.
+    assert long_deltas[0].text == "<thought>" and long_deltas[0].forced
+    assert not any(d.forced for d in long_deltas[1:])
+
+    # Decoded together for a while; alone at the start and at the end.
+    assert model.sizes[0] == 1 and model.sizes[-1] == 1
+    assert max(model.sizes) == 2
+
+
+def test_batch_size_limit(tiny_tokenizer, scripted_lm):
+    model = BatchSizes(scripted_lm(LONG))
+    scheduler = _scheduler(tiny_tokenizer, model, max_batch_size=2, max_queued=4)
+
+    async def main():
+        jobs = [scheduler.submit(_prompt(tiny_tokenizer, f"Q{i}"), 200) for i in range(4)]
+        return await asyncio.gather(*(job.result() for job in jobs))
+
+    for deltas in _run(scheduler, main):
+        assert "".join(d.text for d in deltas) == LONG + "\n<|im_end|>"
+    assert max(model.sizes) == 2
+
+
+def test_queue_full(tiny_tokenizer, scripted_lm):
+    scheduler = _scheduler(tiny_tokenizer, scripted_lm(LONG), max_queued=1)
+
+    async def main():
+        scheduler.submit(_prompt(tiny_tokenizer, "Q"), 200)
+        with pytest.raises(QueueFull):
+            scheduler.submit(_prompt(tiny_tokenizer, "Q"), 200)
+
+    # Not started: nothing leaves the queue.
+    asyncio.run(main())
+
+
+def test_cancel(tiny_tokenizer, scripted_lm):
+    """A cancelled job stops; the others go on."""
+    model = BatchSizes(scripted_lm(LONG))
+    scheduler = _scheduler(tiny_tokenizer, model)
+
+    async def main():
+        cancelled, other = [scheduler.submit(_prompt(tiny_tokenizer, "Q"), 200) for _ in range(2)]
+        stream = cancelled.stream()
+        await stream.__anext__()
+        cancelled.cancel()
+        with pytest.raises(Cancelled):
+            async for _ in stream:
+                pass
+        return await other.result()
+
+    deltas = _run(scheduler, main)
+    assert "".join(d.text for d in deltas) == LONG + "\n<|im_end|>"
+    assert model.sizes[-1] == 1
+
+
+def test_error(tiny_tokenizer, scripted_lm):
+    """A failing step fails the jobs in the batch; the scheduler keeps going."""
+    model = scripted_lm(LONG)
+    calls = []
+
+    def flaky(**kwargs):
+        calls.append(None)
+        if len(calls) == 3:
+            raise RuntimeError("oops")
+        return model(**kwargs)
+
+    flaky.device = model.device
+    flaky.forward = flaky
+    scheduler = _scheduler(tiny_tokenizer, flaky)
+
+    async def main():
+        with pytest.raises(RuntimeError):
+            await scheduler.submit(_prompt(tiny_tokenizer, "Q"), 200).result()
+        return await scheduler.submit(_prompt(tiny_tokenizer, "Q"), 200).result()
+
+    deltas = _run(scheduler, main)
+    assert "".join(d.text for d in deltas) == LONG + "\n<|im_end|>"
+
+
+def test_samples(tiny_tokenizer, scripted_lm):
+    """Samples of a prompt join together, once there's room for all of them."""
+    model = BatchSizes(scripted_lm(LONG))
+    scheduler = _scheduler(tiny_tokenizer, model, max_batch_size=3)
+
+    async def main():
+        with pytest.raises(ValueError):
+            scheduler.submit_samples(_prompt(tiny_tokenizer, "Q"), 200, 4)
+        first = scheduler.submit(_prompt(tiny_tokenizer, "Q1"), 200)
+        samples = scheduler.submit_samples(_prompt(tiny_tokenizer, "Q2"), 200, 3)
+        return await asyncio.gather(first.result(), *(job.result() for job in samples))
+
+    for deltas in _run(scheduler, main):
+        assert "".join(d.text for d in deltas) == LONG + "\n<|im_end|>"
+    assert max(model.sizes) == 3
+
+
+def test_stop_timeout(tiny_tokenizer, scripted_lm):
+    """Stopping waits for the current step, but not forever."""
+    model = scripted_lm(LONG)
+    stepping, release = threading.Event(), threading.Event()
+
+    def slow(**kwargs):
+        stepping.set()
+        release.wait()
+        return model(**kwargs)
+
+    slow.device = model.device
+    slow.forward = slow
+    scheduler = _scheduler(tiny_tokenizer, slow)
+    scheduler.start()
+
+    async def main():
+        job = scheduler.submit(_prompt(tiny_tokenizer, "Q"), 200)
+        await asyncio.get_running_loop().run_in_executor(None, stepping.wait)
+        started = time.perf_counter()
+        scheduler.stop(timeout=0.1)
+        assert time.perf_counter() - started < 1
+        release.set()
+        with pytest.raises(Cancelled):
+            await job.result()
+
+    asyncio.run(main())
@@ -0,0 +1,103 @@
+import asyncio
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+from fastapi.testclient import TestClient
+
+from src.generate.llm import LLM
+from . import __main__ as server_main
+from .__main__ import GenerateRequest, Server, _respond
+from .cli import ServerConfig
+
+FAST = "fake://?tps=0&prefill_ms=0"
+# Some 1s a response: long enough for other requests to pile up.
+SLOW = "fake://?tps=50&prefill_ms=0&length=50&length_sigma=0"
+
+CONVERSATION = [{"role": "user", "content": "How many files are there?"}]
+
+
+def _server(model_name: str, **kwargs) -> Server:
+    return Server(ServerConfig(model_name=model_name, chat_template="chatml", **kwargs))
+
+
+def _wait(condition, timeout: float = 10.0):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        assert time.perf_counter() < deadline, "Timed out"
+        time.sleep(0.01)
+
+
+def test_stream():
+    """The deltas of `/generate/stream` add up to the response of `/generate`."""
+    body = {"conversation": CONVERSATION, "max_new_tokens": 4000}
+    with TestClient(_server(FAST).app) as client:
+        response = client.post("/generate", json=body)
+        assert response.status_code == 200
+        expected = response.json()
+
+        response = client.post("/generate/stream", json=body)
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        lines = [json.loads(line) for line in response.text.splitlines()]
+
+    assert expected["response"] == LLM(FAST).generate(CONVERSATION, max_new_tokens=4000)
+    assert "".join(line["text"] for line in lines) == expected["response"]
+    assert sum(line["n_tokens"] for line in lines) == expected["n_tokens"]
+    assert {line["index"] for line in lines} == {0}
+    # Only `<thought>`, upfront, is forced whole.
+    assert lines[0]["text"] == "<thought>" and lines[0]["forced"]
+    assert not any(line["forced"] for line in lines[1:])
+    assert lines[-1]["state"] == "DONE"
+
+
+def test_disconnect(monkeypatch):
+    """A client gone before the end of `/generate`: 499, and the job leaves the batch."""
+    monkeypatch.setattr(server_main, "DISCONNECT_POLL_INTERVAL", 0.05)
+    server = _server(SLOW)
+    gone = asyncio.Event()
+
+    async def is_disconnected():
+        return gone.is_set()
+
+    async def main():
+        jobs = await server._submit(GenerateRequest(conversation=CONVERSATION, max_new_tokens=4000))
+        respond = asyncio.ensure_future(_respond(jobs, SimpleNamespace(is_disconnected=is_disconnected)))
+        while server.scheduler.batch_size == 0:
+            await asyncio.sleep(0.01)
+        gone.set()
+        return jobs, await respond
+
+    with TestClient(server.app):
+        jobs, response = asyncio.run(main())
+        assert response.status_code == 499
+        assert all(job.cancelled for job in jobs)
+        _wait(lambda: server.scheduler.batch_size == 0)
+        assert server.metrics.snapshot()["requests"]["cancelled"] == 1
+
+
+def test_queue_full():
+    """Past `max_queued` requests waiting for a place in the batch: 429."""
+    server = _server(SLOW, max_batch_size=1, max_queued=1)
+    body = {"conversation": CONVERSATION, "max_new_tokens": 4000}
+    with TestClient(server.app) as client:
+        statuses = []
+
+        def post():
+            statuses.append(client.post("/generate", json=body).status_code)
+
+        running = threading.Thread(target=post)
+        running.start()
+        _wait(lambda: client.get("/health").json()["batch_size"] == 1)
+        queued = threading.Thread(target=post)
+        queued.start()
+        _wait(lambda: client.get("/health").json()["queue_depth"] == 1)
+
+        response = client.post("/generate", json=body)
+        assert response.status_code == 429
+        assert response.json() == {"detail": "1 requests already queued"}
+
+        running.join()
+        queued.join()
+        assert statuses == [200, 200]
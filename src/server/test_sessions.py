@@ -0,0 +1,52 @@
+import pytest
+
+from src.generate.backends.fake import byte_level_tokenizer
+from .sessions import IncrementalPrompt, SessionStore
+
+
+def _turns(n):
+    conversation = [{"role": "system", "content": "You are an IPython REPL assistant."}]
+    for i in range(n):
+        conversation += [
+            {"role": "user", "content": f"<output>line {i}\n  héllo 🎉</output>"},
+            {"role": "assistant", "content": f"<thought>Step {i}</thought>\n```python\nprint({i})\n```\n"},
+        ]
+    return conversation
+
+
+@pytest.mark.parametrize("fake", [False, True])
+def test_incremental_prompt(tiny_tokenizer, fake):
+    tokenizer = byte_level_tokenizer() if fake else tiny_tokenizer
+    assert IncrementalPrompt.supported(tokenizer)
+
+    prompt = IncrementalPrompt(tokenizer)
+    conversation = _turns(6)
+    # Growing, rewound, then rewritten in the middle (e.g. compacted).
+    versions = [conversation[:i] for i in range(1, len(conversation) + 1)]
+    versions += [conversation[:4], conversation[:9]]
+    edited = list(conversation)
+    edited[3] = {"role": "user", "content": "<output>[... truncated ...]</output>"}
+    versions.append(edited)
+    for version in versions:
+        expected = tokenizer.apply_chat_template(version, add_generation_prompt=True)
+        assert prompt.tokens(version) == expected
+
+
+def test_store(tiny_tokenizer):
+    store = SessionStore(tiny_tokenizer, max_sessions=2)
+    first = store.create(_turns(1))
+    assert first.prompt is not None
+    first.append(_turns(2)[3:])
+    assert first.conversation == _turns(2)
+    with pytest.raises(ValueError):
+        first.rewind(10)
+    first.rewind(3)
+    assert first.conversation == _turns(1)
+
+    second = store.create([])
+    store.get(first.id)
+    store.create([])
+    # The least recently used one is gone.
+    with pytest.raises(KeyError):
+        store.get(second.id)
+    assert store.get(first.id) is first
@@ -2,8 +2,8 @@
 Session = (roughly) an ordered collection of events + metadata.
 """
 
-from dataclasses import dataclass
-from typing import List, Optional
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
 
 from .events import EventBody
 
@@ -19,3 +19,50 @@ class Session:
     # For now, just body.
     # But going to be hard to have back-refs without IDs.
     events: List[SessionEvent]
+
+    # Event ID -> index of its first occurrence in `events`: for `ResumeFrom`.
+    # Kept up to date as events are appended; rebuilt if they're changed otherwise.
+    _index: Dict[str, int] = field(default_factory=dict, init=False, repr=False, compare=False)
+    # The list indexed, how many of its events, and the last one: to tell appends apart.
+    _indexed: Optional[List[SessionEvent]] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+    _n_indexed: int = field(default=0, init=False, repr=False, compare=False)
+    _last_indexed: Optional[SessionEvent] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+
+    def append(self, event: SessionEvent):
+        self.events.append(event)
+        self._update_index()
+
+    def index_of(self, event_id: str) -> Optional[int]:
+        """Index of the first event with this ID, if any."""
+        self._update_index()
+        i = self._index.get(event_id)
+        if i is None or self.events[i].event_id == event_id:
+            return i
+        # Changed in place, at the same length.
+        self._reindex()
+        return self._index.get(event_id)
+
+    def _update_index(self):
+        """Index events appended since last time, or all of them if it wasn't just appends."""
+        n = self._n_indexed
+        if (
+            self._indexed is not self.events
+            or len(self.events) < n
+            or (n and self.events[n - 1] is not self._last_indexed)
+        ):
+            self._reindex()
+            return
+        for i in range(n, len(self.events)):
+            self._index.setdefault(self.events[i].event_id, i)
+        self._n_indexed = len(self.events)
+        self._last_indexed = self.events[-1] if self.events else None
+
+    def _reindex(self):
+        self._index = {}
+        self._n_indexed = 0
+        self._indexed = self.events
+        self._update_index()